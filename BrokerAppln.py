@@ -30,6 +30,7 @@ from topic_selector import TopicSelector
 
 # Now import our CS6381 Middleware
 from CS6381_MW.BrokerMW import BrokerMW
+from CS6381_MW.AsyncMW import AsyncBrokerMW
 # We also need the message formats to handle incoming responses.
 from CS6381_MW import discovery_pb2
 
@@ -53,6 +54,18 @@ class BrokerAppln():
         self.topiclist = None
         self.lookup = None
         self.dissemination = None
+        self.zero_copy = False
+        self.flavor = "poller"
+        self.forwarding = "python"
+        self.capture = False
+        self.drain_batch = 1
+        self.drain_budget = 1.0
+        self.load_interval = 0
+        self.workers = 1
+        self.io_threads = 1
+        self.snapshot = False
+        self.warm_standby = False
+        self.session_timeout = 10.0
         self.mw_obj = None
         self.logger = logger
 
@@ -72,6 +85,18 @@ class BrokerAppln():
             config.read(args.config)
             self.lookup = config["Discovery"]["Strategy"]
             self.dissemination = config["Dissemination"]["Strategy"]
+            self.zero_copy = config.getboolean("Transport", "ZeroCopy", fallback=False)
+            self.flavor = config.get("Middleware", "Flavor", fallback="poller")
+            self.forwarding = config.get("Broker", "Forwarding", fallback="python")
+            self.capture = config.getboolean("Broker", "Capture", fallback=False)
+            self.drain_batch = config.getint("Broker", "DrainBatch", fallback=1)
+            self.drain_budget = config.getfloat("Broker", "DrainBudget", fallback=1.0)
+            self.load_interval = config.getfloat("Broker", "LoadReport", fallback=0)
+            self.workers = config.getint("Broker", "Workers", fallback=1)
+            self.io_threads = config.getint("Broker", "IoThreads", fallback=1)
+            self.snapshot = config.getboolean("Broker", "Snapshot", fallback=False)
+            self.warm_standby = config.getboolean("Broker", "WarmStandby", fallback=False)
+            self.session_timeout = config.getfloat("Broker", "SessionTimeout", fallback=10.0)
 
             self.logger.debug("BrokerAppln::configure - creating topic list")
             
@@ -79,11 +104,14 @@ class BrokerAppln():
             # setup the middleware object
             self.logger.debug(
                 "BrokerAppln::configure - creating middleware object")
-            self.mw_obj = BrokerMW(self.logger)
+            self.mw_obj = AsyncBrokerMW(self.logger) if self.flavor == "asyncio" else BrokerMW(self.logger)
             self.logger.debug("BrokerAppln::driver - upcall handler")
             self.mw_obj.set_upcall_handle(self)
             # pass remainder of args to the m/w object
-            self.mw_obj.configure(args, self.topiclist)
+            self.mw_obj.configure(args, self.zero_copy, self.forwarding, self.capture,
+                                  self.drain_batch, self.drain_budget, self.load_interval,
+                                  self.workers, self.io_threads, self.snapshot, self.warm_standby,
+                                  session_timeout=self.session_timeout)
             self.ts = self.mw_obj.get_topics()
             self.logger.info("BrokerAppln::configure - completed")
         except Exception as e:
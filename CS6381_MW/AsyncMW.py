@@ -0,0 +1,272 @@
+###############################################
+#
+# Purpose: asyncio flavor of the Publisher, Subscriber, Broker and
+# Discovery middleware, built on zmq.asyncio
+#
+###############################################
+
+# The regular middleware objects each run a blocking zmq.Poller loop and wait
+# for ZooKeeper with time.sleep polling loops (set_req, wait_group_creation,
+# ensure_quorum, ...). That takes a whole thread per role.
+#
+# The classes here keep all the message handling of the regular ones and only
+# replace the two blocking parts:
+#
+# (1) The ZooKeeper waits become coroutines. A kazoo watch resolves an asyncio
+#     future (kazoo calls back in its own thread, so we go through
+#     call_soon_threadsafe), so a wait costs nothing while it waits and ends as
+#     soon as the znode shows up instead of on the next sleep tick.
+#     configure_async() awaits everything the regular configure() would have
+#     slept for and then runs it; its loops then find their znodes in place.
+#
+# (2) The event loop awaits a zmq.asyncio.Poller on the very same sockets.
+#     Upcall timeouts are kept as absolute wakeups (as PublisherMW.event_loop
+#     does) so handling a message does not push a pending timer back.
+#
+# Many roles can then share one thread:
+#
+#     await asyncio.gather(pub.configure_async(...), sub.configure_async(...))
+#     await asyncio.gather(pub.event_loop_async(0), sub.event_loop_async(0))
+#
+# For a single role the synchronous configure() and event_loop() wrappers run
+# the coroutines to completion, so an application can use these classes as
+# drop in replacements ([Middleware] Flavor=asyncio in config.ini).
+
+import time  # for the wakeup times
+import inspect  # to pick arguments out of the ones meant for configure()
+import asyncio  # for the event loop
+import threading  # to tell kazoo's thread that a wait is over
+import zmq
+import zmq.asyncio
+
+from kazoo.client import KazooClient
+from kazoo.exceptions import NoNodeError
+
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.SubscriberMW import SubscriberMW
+from CS6381_MW.BrokerMW import BrokerMW
+from CS6381_MW.DiscoveryMW import DiscoveryMW
+
+
+########################################
+# ZooKeeper waits as coroutines
+########################################
+def _settle(loop, future, result=None, error=None):
+    # runs in kazoo's thread; the future may only be touched from its loop
+    def settle():
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    if not loop.is_closed():
+        loop.call_soon_threadsafe(settle)
+
+
+async def start_zk(zk, timeout=15):
+    ''' connect a kazoo client without blocking the event loop '''
+    event = zk.start_async()
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, event.wait, timeout):
+        zk.stop()
+        raise TimeoutError("start_zk: connection to ZooKeeper timed out")
+
+
+async def wait_exists(zk, path):
+    ''' wait until a znode exists and return its stat '''
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    settled = threading.Event()  # kazoo watches are one shot; we stop re-arming once set
+
+    def check(event=None):
+        if not settled.is_set():
+            zk.exists_async(path, watch=check).rawlink(on_result)
+
+    def on_result(result):
+        try:
+            stat = result.get()
+        except Exception as e:
+            settled.set()
+            _settle(loop, future, error=e)
+            return
+        if stat is not None:
+            settled.set()
+            _settle(loop, future, stat)
+
+    check()
+    return await future
+
+
+async def wait_children(zk, path, count):
+    ''' wait until a znode has at least count children and return them '''
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    settled = threading.Event()  # as in wait_exists
+
+    def check(event=None):
+        if not settled.is_set():
+            zk.get_children_async(path, watch=check).rawlink(on_result)
+
+    def on_result(result):
+        try:
+            children = result.get()
+        except NoNodeError:
+            # not there yet; try again once it is
+            zk.exists_async(path, watch=check)
+            return
+        except Exception as e:
+            settled.set()
+            _settle(loop, future, error=e)
+            return
+        if len(children) >= count:
+            settled.set()
+            _settle(loop, future, children)
+
+    check()
+    return await future
+
+
+########################################
+# event loop on zmq.asyncio
+#
+# Mixed into the middleware flavors below, which each provide handlers():
+# socket -> method handling an incoming message on it
+########################################
+class AsyncEventLoop():
+    # secs between wakeups when the appln has no timer pending and the
+    # middleware has deferred work to pick up
+    idle_wakeup = 0.1
+    # max messages handled per socket and wakeup; a wakeup of the asyncio
+    # poller costs far more than one of zmq.Poller, so we drain what is ready
+    drain = 64
+
+    def configure(self, *args, **kwargs):
+        ''' run configure_async to completion for a single role process '''
+        asyncio.run(self.configure_async(*args, **kwargs))
+
+    def event_loop(self, timeout=None):
+        ''' run event_loop_async to completion for a single role process '''
+        try:
+            asyncio.run(self.event_loop_async(timeout))
+        except KeyboardInterrupt:
+            # as SubscriberMW.event_loop does, so recorders and pipelines are wound down
+            self.logger.info("{}::event_loop - Ctrl-C received".format(type(self).__name__))
+            self.disable_event_loop()
+
+    async def event_loop_async(self, timeout=None):
+        try:
+            self.logger.info("{}::event_loop_async - run the event loop".format(type(self).__name__))
+            # shadow our sockets as asyncio sockets; they share the underlying zmq socket
+            poller = zmq.asyncio.Poller()
+            dispatch = {}
+            for socket, handler in self.handlers().items():
+                shadow = zmq.asyncio.Socket.from_socket(socket)
+                poller.register(shadow, zmq.POLLIN)
+                dispatch[shadow] = (socket, handler)
+            deferred = getattr(self, "run_deferred", None)
+
+            wakeup = None if timeout is None else time.monotonic() + timeout / 1000.0
+            while self.handle_events:
+                if deferred is not None:
+                    deferred()
+                if wakeup is not None:
+                    timeout = max(0, int((wakeup - time.monotonic()) * 1000))
+                elif deferred is not None:
+                    timeout = int(self.idle_wakeup * 1000)
+                else:
+                    timeout = None
+                events = dict(await poller.poll(timeout=timeout))
+
+                if not events:
+                    if wakeup is None:
+                        continue  # just an idle wakeup
+                    timeout = self.upcall_obj.invoke_operation()
+                    wakeup = None if timeout is None else time.monotonic() + timeout / 1000.0
+                    continue
+
+                for shadow in events:
+                    socket, handler = dispatch[shadow]
+                    for _ in range(self.drain):
+                        timeout = handler()
+                        if timeout is not None:
+                            due = time.monotonic() + timeout / 1000.0
+                            wakeup = due if wakeup is None else min(wakeup, due)
+                        if not self.handle_events or not socket.get(zmq.EVENTS) & zmq.POLLIN:
+                            break
+                # let the other roles sharing this thread have a turn
+                await asyncio.sleep(0)
+
+            self.logger.info("{}::event_loop_async - out of the event loop".format(type(self).__name__))
+        except Exception as e:
+            raise e
+
+
+########################################
+# the middleware flavors
+########################################
+class AsyncPublisherMW(AsyncEventLoop, PublisherMW):
+    async def configure_async(self, args, topiclist, zero_copy=False):
+        self.zk = KazooClient(hosts=args.zookeeper)
+        await start_zk(self.zk)
+        # set_req would sleep until there is a discovery leader
+        await wait_exists(self.zk, "/leader")
+        PublisherMW.configure(self, args, topiclist, zero_copy)
+
+    def handlers(self):
+        return {self.req: self.handle_reply, self.pub: self.recv_subscription}
+
+
+class AsyncSubscriberMW(AsyncEventLoop, SubscriberMW):
+    async def configure_async(self, args, *rest, **kwargs):
+        self.zk = KazooClient(hosts=args.zookeeper)
+        await start_zk(self.zk)
+        await wait_exists(self.zk, "/leader")
+        SubscriberMW.configure(self, args, *rest, **kwargs)
+
+    def handlers(self):
+        handlers = {self.req: self.handle_reply, self.snap: self.recv_snapshot}
+        # with decode workers the SUB socket belongs to the receive thread
+        if not self.workers:
+            handlers[self.sub] = self.recv_data
+        return handlers
+
+
+class AsyncBrokerMW(AsyncEventLoop, BrokerMW):
+    async def configure_async(self, args, *rest, **kwargs):
+        # the ZK client is ours to create, with the session timeout meant for configure()
+        bound = inspect.signature(BrokerMW.configure).bind(self, args, *rest, **kwargs)
+        bound.apply_defaults()
+        self.zk = KazooClient(hosts=args.zookeeper, timeout=bound.arguments["session_timeout"])
+        await start_zk(self.zk)
+        # wait_group_creation and set_req would sleep for these
+        await asyncio.gather(wait_exists(self.zk, "/brokers/group"),
+                             wait_exists(self.zk, "/leader"))
+        BrokerMW.configure(self, args, *rest, **kwargs)
+
+    def handlers(self):
+        handlers = {self.req: self.handle_reply}
+        # with proxy devices the data sockets belong to the proxy threads
+        if self.forwarder is None and not self.workers:
+            handlers[self.sub] = self.recv_data
+            handlers[self.pub] = self.recv_subscription
+        if self.snap is not None:
+            handlers[self.snap] = self.serve_snapshot
+        return handlers
+
+
+class AsyncDiscoveryMW(AsyncEventLoop, DiscoveryMW):
+    async def configure_async(self, args, *rest, **kwargs):
+        self.zk = KazooClient(hosts=args.zookeeper)
+        await start_zk(self.zk)
+        # announce ourselves and wait for the quorum instead of polling for it
+        self.zk.create("/discovery/" + args.name, ephemeral=True, makepath=True)
+        await wait_children(self.zk, "/discovery", args.quorum)
+        DiscoveryMW.configure(self, args, *rest, **kwargs)
+
+    def ensure_quorum(self, name):
+        # the quorum was already awaited in configure_async
+        self.create_leader(name)
+
+    def handlers(self):
+        return {self.rep: self.handle_request, self.sub: self.recv_from_leader}
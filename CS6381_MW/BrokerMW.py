@@ -23,6 +23,7 @@
 import os     # for OS functions
 import sys    # for syspath and system exception
 import time   # for sleep
+import queue  # for work handed over by the ZK watch callbacks
 import logging  # for logging. Use it in place of print statements.
 import zmq  # ZMQ sockets
 import json
@@ -34,6 +35,12 @@ from kazoo.recipe.watchers import DataWatch
 
 # import serialization logic
 from CS6381_MW import discovery_pb2
+from CS6381_MW.Common import BATCH_TOPIC, FLAG_BATCH, FLAG_FULL, FLAG_DELTA, pack_header
+from CS6381_MW.Common import payload_values, payload_count, channel_topic
+from CS6381_MW.ContentFilter import ContentFilter
+from CS6381_MW.ProxyForwarder import ProxyForwarder
+from CS6381_MW.HashRing import HashRing
+from CS6381_MW.SnapshotCache import SnapshotCache, SNAPSHOT_MARKER
 # from CS6381_MW import topic_pb2  # you will need this eventually
 
 # import any other packages you need.
@@ -58,12 +65,68 @@ class BrokerMW():
         self.groups = 0
         self.order = -1
         self.topiclist = None
+        self.topics = set()  # our group's topics, for filtering batched frames
+        self.batch_topic = bytes(BATCH_TOPIC, "utf-8")
+        self.copy = True  # False to forward frames without copying them into python
+        self.forwarder = None  # ZMQ proxy device doing the forwarding, if not done in python
+        self.forwarded = 0  # messages forwarded in python
+        self.endpoints = set()  # publisher endpoints our SUB socket(s) are connected to
+        self.drain_batch = 1  # max messages forwarded per wakeup of the poller
+        self.drain_budget = 0.001  # max secs spent forwarding per wakeup
+        self.drain_sizes = {}  # messages forwarded in a wakeup -> number of such wakeups
+        # downstream interest, learned from the subscriptions arriving on our XPUB
+        self.verboser = False  # True if we also hear about every unsubscribe
+        self.subscribers = {}  # topic -> number of downstream subscriptions, filtered ones included
+        self.suppressed_since = {}  # topic -> time it lost its last subscriber
+        self.suppressed_secs = {}  # topic -> total secs it had no subscriber
+        self.unwanted = 0  # messages that arrived for topics nobody downstream wants
+        self.ignored_subs = 0  # downstream subscriptions to topics outside our group
+        self.deferred = queue.SimpleQueue()  # work handed to the event loop by ZK watch callbacks
+        self.idle_timeout = 100  # msecs between wakeups to pick up deferred work
+        self.group_no = None
+        self.is_leader = False  # True if we are the leader (the forwarding broker) of our group
+        # per topic load, reported to /brokers/load/<group> for the discovery leader
+        self.load_interval = 0  # secs between load reports, 0 = never
+        self.last_load_report = None
+        self.load = {}  # topic -> [messages, bytes] since the last report
+        self.load_snapshot = {}  # (proxy, topic frame) -> (messages, bytes) at the last report
+        # partitioned forwarding, only with more than one worker
+        self.workers = []  # one proxy device per worker
+        self.shares = []  # topics forwarded by each worker
+        self.ports = []  # port of each worker's PUB socket
+        self.ring = None  # hash ring picking the worker of a topic
+        # last value / history cache served to joining subscribers
+        self.cache = None
+        self.snap = None  # ROUTER socket serving snapshots of the cache
+        self.snapshot_port = None
+        # warm standby: a broker that is not its group's leader still receives
+        # the group's traffic, so it can take over without a cold start
+        self.warm_standby = False
+        self.warm = set()  # topics we subscribed upstream only to stay warm
+        self.warm_grace = 5.0  # secs a new leader stays subscribed to all topics
+        self.release_at = None  # when to drop the warm subscriptions nobody claimed
+        self.buffered = 0  # messages taken in while standing by
+        # ZK only reports a crashed leader gone once its session expired, up to
+        # session_timeout secs after the crash; we cannot see that part
+        self.session_timeout = 10.0
+        self.notified_at = None  # when ZK told us our group's leader node was gone
+        self.takeovers = []  # secs from that notification to forwarding as the new leader
+        # content filters the subscribers registered (see ContentFilter.py)
+        self.filter_specs = {}  # subscriber -> its filter specs, as read from /filters
+        self.watched_filters = set()  # subscribers whose /filters node we watch
+        self.filters = {}  # topic -> {filter id: ContentFilter}
+        self.channel_subs = {}  # filtered channel -> number of downstream subscriptions
+        self.filtered_subs = {}  # topic -> number of those on its channels
+        self.unbatched = 0  # publications taken out of batches for filtered subscribers only
+        self.matched = 0  # publications sent on filtered channels
 
     ########################################
     # configure/initialize
     ########################################
 
-    def configure(self, args):
+    def configure(self, args, zero_copy=False, forwarding="python", capture=False,
+                  drain_batch=1, drain_budget=1.0, load_interval=0, workers=1, io_threads=1,
+                  snapshot=False, warm_standby=False, session_timeout=10.0):
         '''Initialize the object'''
         try:
             self.logger.info("BrokerMW::configure")
@@ -72,44 +135,161 @@ class BrokerMW():
             self.addr = args.addr
             self.name = args.name
             self.groups = args.groups
-            # get ZMQ context
+            # with zero copy we forward the received zmq.Frames as they are
+            self.copy = not zero_copy
+            # python forwarding drains up to drain_batch messages (or drain_budget
+            # msecs worth) per wakeup before it goes back to the poller
+            self.drain_batch = max(1, drain_batch)
+            self.drain_budget = drain_budget / 1000.0
+            self.load_interval = load_interval
+            self.last_load_report = time.monotonic()
+            self.warm_standby = warm_standby
+            self.session_timeout = session_timeout
+            # get ZMQ context; with several workers more I/O threads pay off
             self.logger.debug("BrokerMW::configure: obtain ZMQ context")
-            context = zmq.Context()
+            context = zmq.Context(io_threads=max(1, io_threads))
             self.poller = zmq.Poller()
+            self.logger.debug("BrokerMW::configure: obtain REQ socket")
+            self.req = context.socket(zmq.REQ)
+            self.poller.register(self.req, zmq.POLLIN)
+            if snapshot:
+                self.cache = SnapshotCache()
+                # the proxies only see the traffic on their capture sockets
+                capture = True
+            if forwarding == "proxy" and self.groups > 1 and workers <= 1:
+                # the proxy passes every downstream subscription upstream, topics
+                # of other groups included, which undoes the group partitioning
+                self.logger.warning("BrokerMW::configure: proxy forwarding cannot keep to our group's topics, "
+                                    "forwarding in python instead")
+                forwarding = "python"
+            if workers > 1:
+                self.create_workers(context, workers, capture)
+            else:
+                self.create_sockets(context, forwarding, capture)
+            if self.load_interval and (self.forwarder is not None or self.workers) and not capture:
+                self.logger.warning("BrokerMW::configure: the proxy only counts topic loads with Capture on")
+            if snapshot:
+                # the snapshot channel goes on the port after our PUB port(s)
+                self.snapshot_port = self.port + len(self.ports)
+                self.logger.debug("BrokerMW::configure: serve snapshots on port {}".format(self.snapshot_port))
+                self.snap = context.socket(zmq.ROUTER)
+                self.snap.bind("tcp://*:" + str(self.snapshot_port))
+                self.poller.register(self.snap, zmq.POLLIN)
+
+            # the asyncio flavor hands us a client it already connected
+            if self.zk is None:
+                self.logger.debug("BrokerMW::configure: creating ZK client")
+                # a crashed leader is only noticed once its session expires
+                self.zk = KazooClient(hosts=args.zookeeper, timeout=session_timeout)
+            self.zk.start()
+            self.wait_group_creation()
+            self.order = self.assignOrder(0)
+            self.group_no = self.order % self.groups
+            self.broker_leader()
+            self.set_req()
 
+            self.logger.info("BrokerMW::configure completed")
+        except Exception as e:
+            raise e
+
+    ########################################
+    # sockets of a single forwarder
+    ########################################
+    def create_sockets(self, context, forwarding, capture):
+        try:
             # now aquire the sockets
-            # REQ socket to talk to discovery service
-            # PUB socket to publish to subscribers
-            # SUB socket to receive from publishers
+            # XPUB socket to publish to subscribers
+            # XSUB socket to receive from publishers
+            #
+            # With XPUB/XSUB the subscriptions of our subscribers travel upstream:
+            # we only subscribe to a topic at the publishers while someone
+            # downstream wants it, so unwanted topics never leave the publisher.
             self.logger.debug(
-                "BrokerMW::configure: obtain REQ, PUB, and SUB socket")
-            self.req = context.socket(zmq.REQ)
-            self.pub = context.socket(zmq.PUB)
-            self.sub = context.socket(zmq.SUB)
+                "BrokerMW::create_sockets: obtain XPUB and XSUB socket")
+            self.pub = context.socket(zmq.XPUB)
+            self.sub = context.socket(zmq.XSUB)
+            # hear about every (un)subscribe, not only the first and last per topic,
+            # so that we can count subscribers
+            if hasattr(zmq, "XPUB_VERBOSER"):
+                self.pub.setsockopt(zmq.XPUB_VERBOSER, 1)
+                self.verboser = True
+            else:
+                self.pub.setsockopt(zmq.XPUB_VERBOSE, 1)
 
             # register our sockets iwth th poller
             self.logger.debug(
-                "BrokerMW::configure: register the REQ and SUB sockets with the poller")
-            self.poller.register(self.req, zmq.POLLIN)
-            self.poller.register(self.sub, zmq.POLLIN)
-
-            
+                "BrokerMW::create_sockets: register the SUB sockets with the poller")
+            if forwarding == "proxy":
+                # the proxy device moves SUB -> PUB traffic in its own thread; we
+                # only keep the discovery traffic in python
+                self.logger.debug("BrokerMW::create_sockets: forwarding through a ZMQ proxy")
+                self.forwarder = ProxyForwarder(context, self.sub, self.pub, self.logger, capture,
+                                                observer=self.cache and self.cache.observe)
+            else:
+                self.poller.register(self.sub, zmq.POLLIN)
+                # subscriptions from downstream arrive on the XPUB socket
+                self.poller.register(self.pub, zmq.POLLIN)
 
             # need to do both publisher and subscriber binding
-            self.logger.debug("BrokerMW::configure: bind to the PUB")
+            self.logger.debug("BrokerMW::create_sockets: bind to the PUB")
             bind_string = "tcp://*:" + str(self.port)
             self.pub.bind(bind_string)
+            self.ports = [self.port]
+        except Exception as e:
+            raise e
 
-            self.logger.debug("BrokerMW::configure: creating ZK client")
-            self.zk = KazooClient(hosts=args.zookeeper)
-            self.zk.start()
-            self.wait_group_creation()
-            self.order = self.assignOrder(self.groups)
-            self.group_no = self.order % self.groups
-            self.broker_leader()
-            self.set_req()
+    ########################################
+    # partitioned forwarding
+    #
+    # With more than one worker the group's topics are split across the
+    # workers, each a proxy device with its own SUB/PUB pair and thread, its
+    # PUB bound to port + i. zmq.proxy runs without the GIL, so the workers
+    # use as many cores and the context's io_threads share the socket I/O.
+    # The hash ring picks the worker of a topic, so a change of our topics
+    # only moves the topics concerned. Subscribers connect to every port
+    # listed in our leader znode.
+    #
+    # A worker subscribes to its share upfront. Were its sockets XSUB/XPUB,
+    # the proxy would pass every downstream subscription on to the
+    # publishers and each worker would forward every topic. So the
+    # subscription awareness of the single forwarder is not kept here.
+    ########################################
+    def create_workers(self, context, count, capture):
+        try:
+            self.logger.info("BrokerMW::create_workers: {} forwarding workers".format(count))
+            self.ring = HashRing(range(count), load_factor=None)
+            for i in range(count):
+                sub = context.socket(zmq.SUB)
+                pub = context.socket(zmq.PUB)
+                pub.bind("tcp://*:" + str(self.port + i))
+                self.workers.append(ProxyForwarder(context, sub, pub, self.logger, capture,
+                                                   observer=self.cache and self.cache.observe))
+                self.shares.append(set())
+                self.ports.append(self.port + i)
+        except Exception as e:
+            raise e
 
-            self.logger.info("BrokerMW::configure completed")
+    def update_shares(self):
+        '''subscribe every worker to its share of our topics'''
+        try:
+            for i, worker in enumerate(self.workers):
+                share = {topic for topic in self.topics if self.ring.lookup(topic) == i}
+                if i == 0:
+                    # batched frames mix topics; one worker forwards them whole
+                    share.add(BATCH_TOPIC)
+                added, removed = share - self.shares[i], self.shares[i] - share
+                if not added and not removed:
+                    continue
+                self.logger.info("BrokerMW::update_shares: worker {} added {} removed {}".format(
+                    i, sorted(added), sorted(removed)))
+
+                def resubscribe(sub, pub):
+                    for topic in added:
+                        sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+                    for topic in removed:
+                        sub.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+                worker.reconfigure(resubscribe)
+                self.shares[i] = share
         except Exception as e:
             raise e
 
@@ -130,18 +310,37 @@ class BrokerMW():
             raise e
 
     def setWatch(self):
-        @self.zk.DataWatch("/broker/group/{}".format(self.order))
+        @self.zk.DataWatch("/brokers/group/{}/leader".format(self.group_no))
         def watch_broker(data, stat):
-            if data is None:
+            if data is None and not self.is_leader:
+                self.notified_at = time.monotonic()
                 self.logger.info(
                     "BrokerMW::watch_broker: broker node deleted, attempting to become leader")
-                self.broker_leader(self.name)
+                self.broker_leader()
+                if self.is_leader:
+                    self.defer(self.promote)
+
+        # discovery migrates topics between groups by rewriting the group nodes
+        @self.zk.DataWatch("/brokers/group/{}".format(self.group_no))
+        def watch_group(data, stat):
+            if data:
+                topics = json.loads(data.decode("utf-8"))["topics"]
+                self.defer(lambda: self.update_topics(topics))
 
         @self.zk.DataWatch("/leader")
         def watch_leader(data, stat):
             self.logger.info("BrokerMW::watch_leader: leader node changed")
             self.set_req()
 
+        # subscribers register their content filters here
+        self.zk.ensure_path("/filters")
+
+        @self.zk.ChildrenWatch("/filters")
+        def watch_filters(children):
+            for child in set(children) - self.watched_filters:
+                self.watched_filters.add(child)
+                self.watch_filter(child)
+
         @self.zk.ChildrenWatch("/publisher")
         def watch_pubs(children):
             # self.set_req()
@@ -152,16 +351,15 @@ class BrokerMW():
                 path = "/publisher/" + child
                 data, _ = self.zk.get(path)
                 publishers.append(json.loads(data.decode("utf-8")))
-                self.logger.info("DiscoveryMW::watch_pubs: {}".format(publishers))
-                self.upcall_obj.update_publishers_info(publishers)
+            self.logger.info("BrokerMW::watch_pubs: {}".format(publishers))
+            # connecting touches the SUB socket, so the event loop does it
+            self.defer(lambda: self.upcall_obj.handle_subscription(publishers))
 
     def assignOrder(self, number):
         # assign a number to itself from path /brokers/order
         try:
-            number = 0
-
             self.zk.create("/brokers/order/{}".format(number),
-                           value={self.name}, ephemeral=True, makepath=True)
+                           value=self.name.encode("utf-8"), ephemeral=True, makepath=True)
             self.logger.info(
                 "BrokerMW::assignOrder: assigned order {}".format(number))
             return number
@@ -170,7 +368,7 @@ class BrokerMW():
         except Exception as e:
             raise e
 
-    def wait_group_creation(self, name):
+    def wait_group_creation(self):
         try:
             self.logger.info("BrokerMW::wait_group_creation")
             while (self.zk.exists("/brokers/group") == None):
@@ -184,12 +382,16 @@ class BrokerMW():
     def broker_leader(self):
         try:
             self.logger.info("BrokerMW::broker_leader")
-            addr = {"id": self.name, "addr": self.addr, "port": self.port}
+            # only python forwarding applies content filters (see set_filters)
+            addr = {"id": self.name, "addr": self.addr, "port": self.port, "ports": self.ports,
+                    "snapshot": self.snapshot_port,
+                    "filters": self.forwarder is None and not self.workers}
             data = json.dumps(addr)
             self.logger.info(
                 "BrokerMW::broker_leader: attempting to create leader node for group {}".format(self.group_no))
-            self.zk.create("/broker/group/{}/leader".format(self.group_no),
-                           value=data, ephemeral=True, makepath=True)
+            self.zk.create("/brokers/group/{}/leader".format(self.group_no),
+                           value=data.encode("utf-8"), ephemeral=True, makepath=True)
+            self.is_leader = True
             self.logger.info("BrokerMW::broker_leader: created leader node")
             return
         except NodeExistsError:
@@ -200,32 +402,242 @@ class BrokerMW():
 
  
     def get_topics(self):
-        while (self.zk.exists("/broker/group/{}".format(self.group_no)) != None):
+        # discovery writes the topics of every group (see DiscoveryMW.create_broker_groups)
+        while (self.zk.exists("/brokers/group/{}".format(self.group_no)) == None):
             time.sleep(1)
-        data, _ = self.zk.get("/broker/group/{}".format(self.group_no))
+        data, _ = self.zk.get("/brokers/group/{}".format(self.group_no))
         topics = json.loads(data.decode("utf-8"))['topics']
         self.topiclist = topics
-        for topic in topics:
-                self.sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+        self.topics = set(topics)
+        # we no longer subscribe upstream on our own; every topic of the group is
+        # suppressed until a subscriber asks for it (see recv_subscription).
+        # The proxy device forwards the subscriptions by itself.
+        now = time.monotonic()
+        self.suppressed_since = {topic: now for topic in topics}
+        if self.workers:
+            self.update_shares()
+            for worker in self.workers:
+                worker.start()
+        elif self.forwarder is not None:
+            self.forwarder.start()
+        if self.warm_standby and not self.is_leader:
+            self.warm_up(self.topics | {BATCH_TOPIC})
         return topics
+
+    ########################################
+    # warm standby
+    #
+    # Subscribers only connect to the leader of a group, so with XPUB/XSUB
+    # nothing reaches a standby broker and a new leader would start cold:
+    # nothing subscribed upstream and an empty snapshot cache. A warm standby
+    # subscribes upstream to all the group's topics itself and feeds its cache
+    # (see forward), without sending anything on.
+    #
+    # On taking over, the subscribers reconnect and subscribe again. Topics
+    # they claim pass from the warm set to the normal subscription count;
+    # after warm_grace secs we drop the upstream subscriptions nobody
+    # claimed. The workers are subscribed to all their topics anyway, and a
+    # proxy hides the downstream subscriptions from us, so there the warm
+    # subscriptions stay.
+    ########################################
+    def warm_up(self, topics):
+        try:
+            if self.workers:
+                return
+            topics = {topic for topic in topics if not self.subscribers.get(topic)} - self.warm
+            if not topics:
+                return
+            self.logger.info("BrokerMW::warm_up: standing by for {}".format(sorted(topics)))
+            ops = [b"\x01" + topic.encode("utf-8") for topic in topics]
+
+            def subscribe(sub, pub):
+                for op in ops:
+                    sub.send(op)
+            self.with_sockets(subscribe)
+            self.warm |= topics
+        except Exception as e:
+            raise e
+
+    def release_warm(self, topics):
+        '''drop warm upstream subscriptions'''
+        try:
+            topics = set(topics) & self.warm
+            if not topics:
+                return
+            self.logger.info("BrokerMW::release_warm: unsubscribing from {}".format(sorted(topics)))
+            ops = [b"\x00" + topic.encode("utf-8") for topic in topics]
+
+            def unsubscribe(sub, pub):
+                for op in ops:
+                    sub.send(op)
+            self.with_sockets(unsubscribe)
+            self.warm -= topics
+            now = time.monotonic()
+            for topic in topics:
+                if topic in self.topics:
+                    self.suppressed_since.setdefault(topic, now)
+        except Exception as e:
+            raise e
+
+    def watch_filter(self, name):
+        '''follow the filters of a subscriber, which it may rewrite'''
+        @self.zk.DataWatch("/filters/" + name)
+        def watch(data, stat):
+            if data is None:
+                if self.filter_specs.pop(name, None) is None:
+                    return
+            else:
+                self.filter_specs[name] = json.loads(data.decode("utf-8"))
+            filters = {}
+            for subscriber, specs in self.filter_specs.items():
+                for spec in specs:
+                    try:
+                        content_filter = ContentFilter(spec)
+                    except (KeyError, ValueError) as e:
+                        self.logger.warning("BrokerMW::watch_filter: ignoring a filter of {} - {}".format(subscriber, e))
+                        continue
+                    filters.setdefault(content_filter.topic, {})[content_filter.fid] = content_filter
+            self.defer(lambda: self.set_filters(filters))
+
+    def set_filters(self, filters):
+        '''take over the content filters of all subscribers'''
+        self.filters = filters
+        self.logger.info("BrokerMW::set_filters: {} filters on {} topics".format(
+            sum(len(by_id) for by_id in filters.values()), len(filters)))
+        if filters and (self.forwarder is not None or self.workers):
+            # our leader node says so, and the subscribers test the plain topics themselves
+            self.logger.warning("BrokerMW::set_filters: content filters need python forwarding, ignoring them")
+
+    def promote(self):
+        '''we just became our group's leader'''
+        try:
+            takeover = time.monotonic() - self.notified_at
+            self.takeovers.append(takeover)
+            # the detection of a crash comes on top; the subscribers' failover gap covers it all
+            self.logger.info("BrokerMW::promote: took over group {} {:.3f} secs after ZK reported its leader gone "
+                             "(plus up to {} secs session timeout to detect a crash), {} messages buffered".format(
+                                 self.group_no, takeover, self.session_timeout, self.buffered))
+            if self.warm and self.forwarder is None:
+                self.release_at = time.monotonic() + self.warm_grace
+        except Exception as e:
+            raise e
+
+    ########################################
+    # take on the topics discovery assigned to our group now
+    #
+    # Discovery migrates a topic make-before-break: the new group gets it
+    # first and the old one gives it up only after a handoff period. So we
+    # subscribe upstream to an added topic right away if anyone downstream
+    # already asked for it, and unsubscribe from a removed one.
+    ########################################
+    def update_topics(self, topics):
+        try:
+            topics = set(topics)
+            added, removed = topics - self.topics, self.topics - topics
+            if not added and not removed:
+                return
+            self.logger.info("BrokerMW::update_topics: group {} added {} removed {}".format(
+                self.group_no, sorted(added), sorted(removed)))
+            self.topics = topics
+            self.topiclist = sorted(topics)
+            if self.cache is not None:
+                self.cache.forget(bytes(topic, "utf-8") for topic in removed)
+            if self.workers:
+                self.update_shares()
+                return
+            ops = [b"\x01" + topic.encode("utf-8") for topic in added if self.subscribers.get(topic)]
+            ops += [b"\x00" + topic.encode("utf-8") for topic in removed if self.subscribers.get(topic)]
+
+            def resubscribe(sub, pub):
+                for op in ops:
+                    sub.send(op)
+            if ops:
+                self.with_sockets(resubscribe)
+            self.release_warm(removed)
+            if self.warm_standby and not self.is_leader:
+                self.warm_up(added)
+            for topic in added:
+                if self.subscribers.get(topic):
+                    self.resume_topic(topic)
+                else:
+                    self.suppressed_since[topic] = time.monotonic()
+            for topic in removed:
+                self.resume_topic(topic)
+        except Exception as e:
+            raise e
+
+    ########################################
+    # run func(sub, pub) on our data sockets
+    #
+    # While a proxy device forwards for us it owns these sockets, so it is
+    # stopped around the change. With workers func runs on every pair.
+    ########################################
+    def with_sockets(self, func):
+        if self.workers:
+            for worker in self.workers:
+                worker.reconfigure(func)
+        elif self.forwarder is not None:
+            self.forwarder.reconfigure(func)
+        else:
+            func(self.sub, self.pub)
          
+    ########################################
+    # hand work over to the event loop thread
+    #
+    # ZK watch callbacks run in kazoo's own thread. Anything that touches our
+    # ZMQ sockets is queued here and run by the event loop between events,
+    # along with the periodic load report.
+    ########################################
+    def defer(self, func):
+        self.deferred.put(func)
+
+    def run_deferred(self):
+        while not self.deferred.empty():
+            self.deferred.get_nowait()()
+        if self.release_at is not None and time.monotonic() >= self.release_at:
+            self.release_at = None
+            self.release_warm(self.warm)
+        if (self.load_interval and self.is_leader
+                and time.monotonic() - self.last_load_report >= self.load_interval):
+            self.report_load()
+
     ########################################
     # run event loop 
+    #
+    # As in PublisherMW, the appln's timeout is kept as an absolute wakeup
+    # and we wake up now and then for the deferred work.
     ########################################
     def event_loop(self, timeout=None):
         try:
             self.logger.info("BrokerMW::event_loop")
+            wakeup = None if timeout is None else time.monotonic() + timeout / 1000.0
             while self.handle_events:
+                self.run_deferred()
+                if wakeup is None:
+                    timeout = self.idle_timeout
+                else:
+                    timeout = max(0, int((wakeup - time.monotonic()) * 1000))
                 events = dict(self.poller.poll(timeout))
                 
                 if not events:
+                    if wakeup is None:
+                        continue  # just an idle wakeup
                     timeout = self.upcall_obj.invoke_operation()
+                    wakeup = None if timeout is None else time.monotonic() + timeout / 1000.0
+                    continue
                 elif self.req in events:
                     timeout = self.handle_reply()
                 elif self.sub in events:
                     timeout = self.recv_data()
+                elif self.pub in events:
+                    timeout = self.recv_subscription()
+                elif self.snap in events:
+                    timeout = self.serve_snapshot()
                 else:
                     raise Exception("BrokerMW::event_loop: unknown event after poll")
+                if timeout is not None:
+                    due = time.monotonic() + timeout / 1000.0
+                    wakeup = due if wakeup is None else min(wakeup, due)
             self.logger.info("BrokerMW::event_loop: event loop terminated")
             
         except Exception as e:
@@ -244,6 +656,9 @@ class BrokerMW():
                 timeout = self.upcall_obj.register_response(disc_resp.register_resp)
             elif (disc_resp.msg_type == discovery_pb2.TYPE_ISREADY):
                 timeout = self.upcall_obj.isready_response(disc_resp.isready_resp)
+            else:
+                timeout = None
+            return timeout
         except Exception as e:
             raise e
         
@@ -251,22 +666,279 @@ class BrokerMW():
     def subscribe(self, publist):
         try:
             self.logger.info("BrokerMW::subscribe")
-            for pub in publist:
-                addr = "tcp://" + pub['addr'] + ":" + str(pub['port'])
-                self.logger.info("BrokerMW::subscribe: subscribing to {}".format(addr))
-                self.sub.connect(addr)
+            # the watch hands us all publishers every time; connecting an endpoint
+            # twice would get us its messages twice
+            wanted = {"tcp://" + pub['addr'] + ":" + str(pub['port']) for pub in publist}
+            added, removed = wanted - self.endpoints, self.endpoints - wanted
+            if not added and not removed:
+                return
+
+            def connect(sub, pub):
+                for addr in added:
+                    self.logger.info("BrokerMW::subscribe: connecting to {}".format(addr))
+                    sub.connect(addr)
+                for addr in removed:
+                    self.logger.info("BrokerMW::subscribe: disconnecting from {}".format(addr))
+                    sub.disconnect(addr)
+            self.with_sockets(connect)
+            self.endpoints = wanted
         except Exception as e:
             raise e
         
+    ########################################
+    # forward what the publishers sent us
+    #
+    # The poller told us there is at least one message. Rather than going back
+    # to the poller after each one, we keep draining without blocking until the
+    # socket is empty, drain_batch messages are done or the time budget is up.
+    ########################################
     def recv_data(self):
         try:
-            msg = self.sub.recv_multipart()
-            self.logger.debug("BrokerMW::recv_data - received data: %s", msg)
-            self.pub.send_multipart(msg)
-            
+            deadline = time.perf_counter() + self.drain_budget
+            count = 0
+            while count < self.drain_batch:
+                try:
+                    msg = self.sub.recv_multipart(zmq.NOBLOCK, copy=self.copy)
+                except zmq.Again:
+                    break
+                self.forward(msg)
+                count += 1
+                if time.perf_counter() >= deadline:
+                    break
+            self.drain_sizes[count] = self.drain_sizes.get(count, 0) + 1
+
             self.logger.debug("BrokerMW::recv_data - done disseminating publisher data")
         except Exception as e:
             raise e
+
+    def forward(self, msg):
+        '''send one received message on to the subscribers'''
+        self.logger.debug("BrokerMW::forward - received data: %s", msg)
+        topic = msg[0] if self.copy else msg[0].bytes
+        name = topic.decode("utf-8")
+        ours = name in self.topics or topic == self.batch_topic
+        if not ours or not self.subscribers.get(name):
+            if ours and name in self.warm:
+                # standing by: keep the cache warm for a takeover
+                self.buffer(msg)
+                return
+            # sent before our unsubscribe reached the publisher (or the topic moved
+            # to another group); XPUB would drop it anyway
+            self.unwanted += 1
+            return
+        if topic == self.batch_topic:
+            msg = self.filter_batch(msg)
+            if msg is None:
+                return
+        else:
+            self.count_load(name, sum(len(frame) for frame in msg))
+            if self.cache is not None:
+                self.cache.update(*(msg if self.copy else [frame.bytes for frame in msg]))
+        # with only filtered subscribers XPUB drops the message itself
+        self.pub.send_multipart(msg, copy=self.copy)
+        self.forwarded += 1
+        if name in self.filters:
+            live = self.live_filters(name)
+            if live:
+                pub = discovery_pb2.Publication()
+                pub.ParseFromString(msg[2] if self.copy else msg[2].buffer)
+                self.send_matches(live, pub, msg[1], msg[2])
+
+    ########################################
+    # content filtered channels
+    #
+    # A publication of a topic somebody subscribed to with a filter is parsed
+    # and sent once more on the channel of every filter its newest sample
+    # matches. The frames are the same, only the topic frame differs.
+    ########################################
+    def live_filters(self, topic):
+        '''the filters of a topic that have subscribers'''
+        return [content_filter for content_filter in self.filters.get(topic, {}).values()
+                if self.channel_subs.get(content_filter.channel)]
+
+    def send_matches(self, live, pub, header, payload):
+        values = payload_values(pub)
+        for content_filter in live:
+            if content_filter.matches(values):
+                self.pub.send_multipart([content_filter.channel_raw, header, payload], copy=self.copy)
+                self.matched += 1
+
+    def buffer(self, msg):
+        '''take in a message of a topic we stand by for'''
+        self.buffered += 1
+        if self.cache is None:
+            return
+        frames = msg if self.copy else [frame.bytes for frame in msg]
+        if frames[0] == self.batch_topic:
+            self.cache.observe(frames)
+        else:
+            self.cache.update(*frames)
+
+    ########################################
+    # serve a snapshot of the cache
+    #
+    # A subscriber asks with the topics it wants (one frame each) and gets
+    # back the cached frames of those, see SnapshotCache.
+    ########################################
+    def serve_snapshot(self):
+        try:
+            frames = self.snap.recv_multipart()
+            identity, topics = frames[0], frames[2:]
+            reply = self.cache.snapshot(topic for topic in topics if topic.decode("utf-8") in self.topics)
+            self.logger.debug("BrokerMW::serve_snapshot - {} frames for {} topics".format(len(reply) // 3, len(topics)))
+            self.snap.send_multipart([identity, b"", SNAPSHOT_MARKER] + reply)
+            return None
+        except Exception as e:
+            raise e
+
+    ########################################
+    # handle a subscribe or unsubscribe from downstream
+    #
+    # The first subscriber of a topic makes us subscribe to it at the
+    # publishers and the last one leaving unsubscribes us again. Only topics
+    # of our group (and batched frames) are passed upstream.
+    ########################################
+    def recv_subscription(self):
+        try:
+            frame = self.pub.recv()
+            if not frame:
+                return None
+            subscribe, name = frame[0] == 1, frame[1:].decode("utf-8")
+            # a filtered channel counts as interest in its topic
+            topic = channel_topic(name)
+            if topic != name:
+                count = self.channel_subs.get(name, 0)
+                self.channel_subs[name] = count + 1 if subscribe else (max(0, count - 1) if self.verboser else 0)
+                self.filtered_subs[topic] = self.filtered_subs.get(topic, 0) + self.channel_subs[name] - count
+                frame = frame[:1] + topic.encode("utf-8")
+            # we count the subscribers of every topic, ours or not: a topic that
+            # migrates to our group must know whether anyone already wants it
+            count = self.subscribers.get(topic, 0)
+            if subscribe:
+                self.subscribers[topic] = count + 1
+                first, last = count == 0, False
+            else:
+                # without XPUB_VERBOSER we only hear about the last unsubscribe
+                remaining = count - 1 if self.verboser else 0
+                self.subscribers[topic] = max(0, remaining)
+                first, last = False, count > 0 and remaining <= 0
+            if topic not in self.topics and topic != BATCH_TOPIC:
+                self.ignored_subs += 1
+                return None
+            if first:
+                self.logger.info("BrokerMW::recv_subscription: first subscriber of {}".format(topic))
+                if topic in self.warm:
+                    # already subscribed upstream while standing by
+                    self.warm.discard(topic)
+                else:
+                    self.sub.send(frame)
+                self.resume_topic(topic)
+            elif last:
+                self.logger.info("BrokerMW::recv_subscription: last subscriber of {} left".format(topic))
+                self.sub.send(frame)
+                if topic in self.topics:
+                    self.suppressed_since[topic] = time.monotonic()
+            return None
+        except Exception as e:
+            raise e
+
+    def resume_topic(self, topic):
+        '''end the suppression of a topic, if it was suppressed'''
+        since = self.suppressed_since.pop(topic, None)
+        if since is not None:
+            self.suppressed_secs[topic] = self.suppressed_secs.get(topic, 0.0) + time.monotonic() - since
+
+    def subscription_stats(self):
+        '''downstream interest and how long topics were suppressed; the
+        publishers count the suppressed messages and bytes themselves'''
+        now = time.monotonic()
+        suppressed = dict(self.suppressed_secs)
+        for topic, since in self.suppressed_since.items():
+            suppressed[topic] = suppressed.get(topic, 0.0) + now - since
+        return {"subscribers": dict(self.subscribers),
+                "suppressed_now": sorted(self.suppressed_since),
+                "suppressed_secs": suppressed,
+                "unwanted": self.unwanted, "ignored_subscriptions": self.ignored_subs}
+
+    ########################################
+    # keep only the publications of our group's topics in a batch
+    #
+    # returns the frames to forward (unchanged if nothing was dropped) or
+    # None if no publication in the batch belongs to us
+    ########################################
+    def filter_batch(self, msg):
+        batch = discovery_pb2.PublicationBatch()
+        batch.ParseFromString(msg[2] if self.copy else msg[2].buffer)
+        keep = [pub for pub in batch.pubs if pub.topic in self.topics]
+        if not keep:
+            return None
+        unbatch = set()
+        for pub in keep:
+            self.count_load(pub.topic, pub.ByteSize())
+            if self.cache is not None:
+                self.cache.add_publication(pub)
+            live = self.live_filters(pub.topic) if pub.topic in self.filters else None
+            if live:
+                # a match leaves the batch as a message of its own
+                header = pack_header(payload_count(pub), pub.seq, FLAG_FULL if pub.full else FLAG_DELTA)
+                self.send_matches(live, pub, header, pub.SerializeToString())
+                if self.filtered_subs.get(pub.topic, 0) >= self.subscribers.get(pub.topic, 0):
+                    # nobody takes the topic unfiltered, so it need not ride along
+                    unbatch.add(pub.topic)
+        if unbatch:
+            before = len(keep)
+            keep = [pub for pub in keep if pub.topic not in unbatch]
+            self.unbatched += before - len(keep)
+            if not keep:
+                return None
+        if len(keep) == len(batch.pubs):
+            return msg
+        filtered = discovery_pb2.PublicationBatch()
+        filtered.pubs.extend(keep)
+        return [msg[0], pack_header(len(keep), 0, FLAG_BATCH), filtered.SerializeToString()]
+
+    ########################################
+    # per topic load
+    #
+    # Python forwarding counts what it forwards. The proxy counts on its
+    # capture socket, where batched frames cannot be split by topic.
+    ########################################
+    def count_load(self, topic, size):
+        load = self.load.setdefault(topic, [0, 0])
+        load[0] += 1
+        load[1] += size
+
+    def report_load(self):
+        try:
+            now = time.monotonic()
+            elapsed = max(now - self.last_load_report, 1e-6)
+            self.last_load_report = now
+            proxies = self.workers or ([self.forwarder] if self.forwarder is not None else [])
+            if proxies:
+                counts = {}
+                for i, proxy in enumerate(proxies):
+                    for topic, (msgs, size) in list(proxy.topics.items()):
+                        last = self.load_snapshot.get((i, topic), (0, 0))
+                        count = counts.setdefault(topic.decode("utf-8", "replace"), [0, 0])
+                        count[0] += msgs - last[0]
+                        count[1] += size - last[1]
+                        self.load_snapshot[(i, topic)] = (msgs, size)
+            else:
+                counts, self.load = self.load, {}
+            rates = {topic: [msgs / elapsed, size / elapsed]
+                     for topic, (msgs, size) in counts.items() if topic != BATCH_TOPIC}
+            report = json.dumps({"broker": self.name, "time": time.time(),
+                                 "interval": elapsed, "topics": rates}).encode("utf-8")
+            path = "/brokers/load/{}".format(self.group_no)
+            try:
+                self.zk.set(path, report)
+            except NoNodeError:
+                self.zk.create(path, value=report, ephemeral=True, makepath=True)
+            self.logger.info("BrokerMW::report_load - group {} forwards {:.1f} msgs/s {:.1f} bytes/s over {} topics".format(
+                self.group_no, sum(r[0] for r in rates.values()), sum(r[1] for r in rates.values()), len(rates)))
+        except Exception as e:
+            raise e
+
     ########################################
     # set upcall handle
     #
@@ -285,4 +957,23 @@ class BrokerMW():
     def disable_event_loop (self):
         ''' disable event loop '''
         self.handle_events = False
+        if self.workers:
+            for i, worker in enumerate(self.workers):
+                worker.stop()
+                self.logger.info("BrokerMW::disable_event_loop: worker {} stats = {}".format(i, worker.stats()))
+        elif self.forwarder is not None:
+            self.forwarder.stop()
+            self.logger.info("BrokerMW::disable_event_loop: forwarder stats = {}".format(self.forwarder.stats()))
+        else:
+            self.logger.info("BrokerMW::disable_event_loop: forwarded {} messages, messages per wakeup = {}".format(
+                self.forwarded, dict(sorted(self.drain_sizes.items()))))
+            self.logger.info("BrokerMW::disable_event_loop: subscription stats = {}".format(self.subscription_stats()))
+        if self.cache is not None:
+            self.logger.info("BrokerMW::disable_event_loop: snapshot cache stats = {}".format(self.cache.stats()))
+        if self.filters:
+            self.logger.info("BrokerMW::disable_event_loop: sent {} publications on filtered channels, took {} out of batches".format(
+                self.matched, self.unbatched))
+        if self.warm_standby:
+            self.logger.info("BrokerMW::disable_event_loop: buffered {} messages standing by, takeovers after notification (secs) = {}".format(
+                self.buffered, ["{:.3f}".format(secs) for secs in self.takeovers]))
 
@@ -15,3 +15,120 @@
 # the role we are playing and any other common things that we need across
 # all our middleware objects. Make sure then to import this file in those files once
 # some content is added here that is needed by others. 
+
+import sys  # for the byte order of raw series
+import array  # for the values of raw series
+import struct  # for the header frame
+
+from CS6381_MW import discovery_pb2  # for the code tables of the categorical topics
+
+# Topic frame used for batched publications (see PublicationBatch in discovery.proto).
+# A batch can mix several topics, so it cannot be filtered by ZMQ prefix matching;
+# subscribers and brokers subscribe to this frame and filter the contents themselves.
+BATCH_TOPIC = "__batch__"
+
+# Topic frames of the content filtered channels start with this mark (see
+# CS6381_MW/ContentFilter.py), so no plain topic is a prefix of them.
+FILTER_MARK = "#"
+
+# Every publication travels as three frames: [topic, header, payload]. The
+# header is a fixed size struct with the number of samples in the payload, the
+# sequence number and flags, so that receivers can accept or drop a message
+# before paying for the protobuf parse of its payload. For a batch the count is
+# the number of publications in it and the sequence number is unused.
+HEADER = struct.Struct("!IQB")
+FLAG_FULL = 0x01  # the payload carries the whole history window
+FLAG_DELTA = 0x02  # the publisher runs in delta mode (see PublisherMW.fill_publication)
+FLAG_BATCH = 0x04  # the payload is a PublicationBatch
+
+# Payload type of every topic, i.e., which field of the Publication carries its
+# samples (see discovery.proto). Topics not listed here travel as strings in "data".
+PAYLOAD_STRING = "data"
+PAYLOAD_DOUBLE = "doubles"
+PAYLOAD_INT = "ints"
+PAYLOAD_CODE = "codes"
+
+TOPIC_PAYLOAD = {"weather": PAYLOAD_CODE,
+                 "humidity": PAYLOAD_DOUBLE,
+                 "airquality": PAYLOAD_CODE,
+                 "light": PAYLOAD_INT,
+                 "pressure": PAYLOAD_INT,
+                 "temperature": PAYLOAD_INT,
+                 "sound": PAYLOAD_INT,
+                 "altitude": PAYLOAD_INT,
+                 "location": PAYLOAD_CODE}
+
+# Code tables of the categorical topics, from their enums in discovery.proto;
+# a sample is sent as its index here, which is its enum value
+TOPIC_CODES = {"weather": discovery_pb2.Weather.keys(),
+               "airquality": discovery_pb2.AirQuality.keys(),
+               "location": discovery_pb2.Location.keys()}
+
+# array module typecodes used to keep the history of each payload type
+PAYLOAD_TYPECODE = {PAYLOAD_STRING: None,
+                    PAYLOAD_DOUBLE: "d",
+                    PAYLOAD_INT: "q",
+                    PAYLOAD_CODE: "I"}
+
+
+def payload_kind(topic):
+    ''' the Publication field that carries samples of this topic '''
+    return TOPIC_PAYLOAD.get(topic, PAYLOAD_STRING)
+
+
+def payload_values(message):
+    ''' the samples of a received Publication: its repeated field, or an
+    array decoded from the raw block of a full window (see discovery.proto) '''
+    kind = message.WhichOneof("payload")
+    if kind is None:
+        return message.data
+    series = getattr(message, kind)
+    if not series.raw:
+        return series.values
+    values = array.array(PAYLOAD_TYPECODE[kind])
+    values.frombytes(series.raw)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def payload_count(message):
+    ''' the number of samples of a Publication, without decoding them '''
+    kind = message.WhichOneof("payload")
+    if kind is None:
+        return len(message.data)
+    series = getattr(message, kind)
+    if not series.raw:
+        return len(series.values)
+    return len(series.raw) // array.array(PAYLOAD_TYPECODE[kind]).itemsize
+
+
+def raw_series(window):
+    ''' the raw block of a window of typed samples (an array or a memoryview of one) '''
+    if sys.byteorder == "little":
+        return window.tobytes()
+    values = array.array(window.format, window) if isinstance(window, memoryview) else array.array(window.typecode, window)
+    values.byteswap()
+    return values.tobytes()
+
+
+def pack_header(count, seq, flags):
+    ''' the header frame of a message '''
+    return HEADER.pack(count, seq, flags)
+
+
+def unpack_header(frame):
+    ''' (count, seq, flags) of a header frame '''
+    return HEADER.unpack(frame)
+
+
+def filter_channel(topic, fid):
+    ''' topic frame of the channel carrying the matches of a content filter '''
+    return "{}{}{}{}".format(FILTER_MARK, topic, FILTER_MARK, fid)
+
+
+def channel_topic(name):
+    ''' the topic of a content filtered channel, or the name itself for a plain topic '''
+    if not name.startswith(FILTER_MARK):
+        return name
+    return name[1:].rsplit(FILTER_MARK, 1)[0]
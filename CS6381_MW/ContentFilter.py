@@ -0,0 +1,114 @@
+###############################################
+#
+# Purpose: Predicates on the samples of a topic that a subscriber registers,
+# so that brokers forward it only the publications it wants
+#
+###############################################
+
+# ZMQ filters on topic prefixes only, so a subscriber that wants, say, a
+# temperature above 90 still receives and parses every temperature sample.
+# Instead it registers a predicate on the newest sample of the topic:
+#
+#   range  min <= sample <= max, either bound may be left out
+#   eq     sample == value
+#   in     sample in values
+#
+# Categorical topics take the names of their codes (see TOPIC_CODES) and
+# the predicate is compiled to the codes, so nothing is decoded to test it.
+#
+# Subscribers publish their predicates to /filters/<name> in ZooKeeper. The
+# broker serving the topic tests every publication against the predicates
+# somebody subscribed to and sends the matching ones once more on the
+# predicate's own channel, a topic frame of "#<topic>#<id>" (see
+# filter_channel). The id hashes the predicate, so subscribers asking for the
+# same thing share a channel. The leading mark keeps the prefix match of a
+# plain "temperature" subscription off the channels.
+
+import hashlib  # for ids that are stable across processes
+import json
+
+from CS6381_MW.Common import TOPIC_CODES, PAYLOAD_STRING, payload_kind, filter_channel
+
+OPS = ("range", "eq", "in")
+
+
+class ContentFilter():
+    ########################################
+    # constructor
+    #
+    # spec: {"topic": ..., "op": "range", "min": ..., "max": ...},
+    #       {"topic": ..., "op": "eq", "value": ...} or
+    #       {"topic": ..., "op": "in", "values": [...]}
+    #
+    # raises ValueError for a predicate that cannot apply to the topic
+    ########################################
+    def __init__(self, spec):
+        self.topic = spec["topic"]
+        self.op = spec.get("op")
+        if self.op not in OPS:
+            raise ValueError("ContentFilter: unknown op {} for {}".format(self.op, self.topic))
+        kind = payload_kind(self.topic)
+        codes = TOPIC_CODES.get(self.topic)
+        if self.op == "range":
+            if codes is not None:
+                raise ValueError("ContentFilter: categorical topic {} has no range".format(self.topic))
+            if spec.get("min") is None and spec.get("max") is None:
+                raise ValueError("ContentFilter: range on {} without bounds".format(self.topic))
+            self.min = None if spec.get("min") is None else float(spec["min"])
+            self.max = None if spec.get("max") is None else float(spec["max"])
+            self.spec = {"topic": self.topic, "op": self.op, "min": self.min, "max": self.max}
+        else:
+            values = [spec["value"]] if self.op == "eq" else list(spec["values"])
+            if codes is not None:
+                unknown = [value for value in values if value not in codes]
+                if unknown:
+                    raise ValueError("ContentFilter: {} has no {}".format(self.topic, unknown))
+                self.values = frozenset(codes.index(value) for value in values)
+            elif kind == PAYLOAD_STRING:
+                values = [str(value) for value in values]
+                self.values = frozenset(values)
+            else:
+                values = [float(value) for value in values]
+                self.values = frozenset(values)
+            self.spec = {"topic": self.topic, "op": self.op}
+            self.spec.update({"value": values[0]} if self.op == "eq" else {"values": sorted(set(values))})
+        canonical = json.dumps(self.spec, sort_keys=True)
+        self.fid = hashlib.md5(canonical.encode("utf-8")).hexdigest()[:8]
+        self.channel = filter_channel(self.topic, self.fid)
+        self.channel_raw = bytes(self.channel, "utf-8")
+
+    ########################################
+    # "topic:range:min:max", "topic:eq:value" or "topic:in:v1,v2,..."
+    # as given on the command line; an empty bound is left open
+    ########################################
+    @classmethod
+    def parse(cls, text):
+        parts = text.split(":")
+        if len(parts) < 3:
+            raise ValueError("ContentFilter: cannot parse {}".format(text))
+        topic, op = parts[0], parts[1]
+        if op == "range":
+            bounds = (parts[2:] + [""])[:2]
+            return cls({"topic": topic, "op": op, "min": bounds[0] or None, "max": bounds[1] or None})
+        if op == "eq":
+            return cls({"topic": topic, "op": op, "value": ":".join(parts[2:])})
+        return cls({"topic": topic, "op": op, "values": ":".join(parts[2:]).split(",")})
+
+    ########################################
+    # does the newest sample of a payload (see payload_values) match
+    ########################################
+    def matches(self, values):
+        if not len(values):
+            return False
+        sample = values[0]
+        if self.op != "range":
+            return sample in self.values
+        try:
+            sample = float(sample)
+        except ValueError:
+            return False
+        return ((self.min is None or sample >= self.min)
+                and (self.max is None or sample <= self.max))
+
+    def __repr__(self):
+        return "ContentFilter({})".format(json.dumps(self.spec, sort_keys=True))
@@ -22,12 +22,15 @@
 import os     # for OS functions
 import sys    # for syspath and system exception
 import time   # for sleep
+import threading  # for the handoff timer of topic migrations
 import logging  # for logging. Use it in place of print statements.
 import zmq  # ZMQ sockets
 import json  # for json serialization/deserialization
 
 # import serialization logic
 from CS6381_MW import discovery_pb2
+from CS6381_MW.HashRing import HashRing, moved_topics
+from CS6381_MW.Rebalancer import Rebalancer
 
 # import the Kazoo package
 from kazoo.client import KazooClient
@@ -56,14 +59,29 @@ class DiscoveryMW():
         self.pub = None  # handle publishing from leader to replicas
         self.sub = None  # handle receiving info from leader
         self.name = None
+        self.is_leader = False  # True once we created /leader
+        # load driven rebalancing of the broker groups, done by the leader
+        self.rebalancer = None
+        self.cooldown = 30.0  # min secs between two rebalancing decisions
+        self.handoff = 2.0  # secs both groups forward a migrating topic
+        self.loads = {}  # broker group -> its last load report
+        self.load_seen = {}  # broker group -> when (our monotonic clock) its last report arrived
+        self.load_watched = set()  # broker groups whose load reports we watch
+        self.rebalance_lock = threading.Lock()  # kazoo callbacks vs the handoff timer
+        self.migrating = False  # a handoff is in progress
+        self.last_rebalance = None
+        self.pending_effect = None  # load before the last migration, to log its effect
 
     ########################################
     # configure/initialize
     ########################################
-    def configure(self, args):
+    def configure(self, args, threshold=1.5, cooldown=30.0, handoff=2.0, max_moves=2):
         '''Initialize the object'''
         try:
             self.logger.info("DiscoveryMW::configure")
+            self.rebalancer = Rebalancer(threshold, max_moves)
+            self.cooldown = cooldown
+            self.handoff = handoff
 
             # retrieve our advertised ip addr and publication port num
             self.port = args.port
@@ -98,8 +116,10 @@ class DiscoveryMW():
 
             self.bind_string = "tcp://*:" + str(self.port + 1)
             self.pub.bind(self.bind_string)
-            self.logger.debug("DiscoveryMW::configure: create ZK client")
-            self.zk = KazooClient(hosts=args.zookeeper)
+            # the asyncio flavor hands us a client it already connected
+            if self.zk is None:
+                self.logger.debug("DiscoveryMW::configure: create ZK client")
+                self.zk = KazooClient(hosts=args.zookeeper)
             # establishing quorum
             self.quorum = args.quorum
             self.ensure_quorum(args.name)
@@ -145,6 +165,8 @@ class DiscoveryMW():
             self.logger.info("DiscoveryMW::watch_pubs: {}".format(publishers))
             self.upcall_obj.update_publisher_info(publishers)
             return
+
+        self.watch_loads()
     ###############################################
     # create leader else wait until leader is done
     ###############################################
@@ -179,6 +201,7 @@ class DiscoveryMW():
                     {"name": name, "rep_addr": rep_addr, "pub_addr": pub_addr})
                 self.zk.create(
                     "/leader", value=meta_str.encode("utf-8"), ephemeral=True, makepath=True)
+                self.is_leader = True
                 self.logger.info("DiscoveryMW::create_leader: leader created")
             except NodeExistsError:
                 self.logger.info(
@@ -193,26 +216,208 @@ class DiscoveryMW():
         except Exception as e:
             raise e
         
-    def create_broker_groups(self, topiclist):
+    ########################################
+    # assign the topics to the broker groups
+    #
+    # /brokers/group holds the ring parameters and /brokers/group/<g> the
+    # topics of group g (its leader broker lives at /brokers/group/<g>/leader).
+    # Topics are placed on a consistent hash ring (see HashRing), so running
+    # with a different number of groups only moves about 1/N of the topics.
+    # Every discovery node computes the same assignment; only the changes
+    # are written. Once the groups exist with the same count, the assignment
+    # belongs to the load driven rebalancing (see rebalance) and is kept.
+    ########################################
+    def create_broker_groups(self, topiclist, weights=None):
         try:
             self.logger.info("DiscoveryMW::create_broker_groups: topiclist = {}".format(
                 topiclist))
-            # create a group for each topic with data being number of groups
-            self.zk.create("/brokers/group", value=self.groups,makepath=True)
-            steps = topiclist.len() / self.groups
-            for i in range(self.groups):
-                topics = topiclist[i * steps: (i + 1) * steps]
-                data = json.dumps({"topics": topics})
-                self.logger.info("DiscoveryMW::create_broker_groups: topics = {}".format(topics))
-                self.zk.create("/brokers/group/{}".format(i), value=data.encode('utf-8'), makepath=True)
-                
-                
-        except NodeExistsError:
-            self.logger.info("DiscoveryMW::create_broker_groups: node already exists")
-            return
+            self.zk.ensure_path("/brokers/group")
+
+            # what the groups held before, to report what moved
+            before = {}
+            for child in self.zk.get_children("/brokers/group"):
+                data, _ = self.zk.get("/brokers/group/{}".format(child))
+                if data:
+                    before[int(child)] = json.loads(data.decode("utf-8"))["topics"]
+            data, _ = self.zk.get("/brokers/group")
+            if data and json.loads(data.decode("utf-8")).get("groups") == self.groups \
+                    and set(before) == set(range(self.groups)):
+                self.logger.info("DiscoveryMW::create_broker_groups: keeping the existing {} groups".format(self.groups))
+                return before
+
+            ring = HashRing(range(self.groups))
+            assignment = ring.assign(topiclist, weights)
+            meta = json.dumps({"groups": self.groups, "vnodes": ring.vnodes,
+                               "load_factor": ring.load_factor})
+            self.zk.set("/brokers/group", meta.encode("utf-8"))
+            moved = moved_topics(before, assignment)
+            if before:
+                self.logger.info("DiscoveryMW::create_broker_groups: {} of {} topics moved: {}".format(
+                    len(moved), len(topiclist), moved))
+
+            for group, topics in assignment.items():
+                self.logger.info("DiscoveryMW::create_broker_groups: group {} topics = {}".format(group, topics))
+                if before.get(group) == topics:
+                    continue
+                data = json.dumps({"topics": topics}).encode("utf-8")
+                path = "/brokers/group/{}".format(group)
+                try:
+                    self.zk.create(path, value=data, makepath=True)
+                except NodeExistsError:
+                    self.zk.set(path, data)
+            # groups we no longer have, along with their leader nodes
+            for group in before:
+                if group not in assignment:
+                    self.logger.info("DiscoveryMW::create_broker_groups: removing group {}".format(group))
+                    self.zk.delete("/brokers/group/{}".format(group), recursive=True)
+            return assignment
         except Exception as e:
             raise e
 
+    ########################################
+    # load driven rebalancing of the broker groups
+    #
+    # The leader broker of every group reports its per topic rates to
+    # /brokers/load/<g>. On every report the discovery leader checks the
+    # skew across the groups with a live report and, past the threshold,
+    # migrates the topics the Rebalancer picks. A migration is
+    # make-before-break:
+    #   (1) the topic is added to the new group and marked draining in the
+    #       old one, which keeps forwarding it meanwhile
+    #   (2) after the handoff period the old group drops it
+    # Subscribers are connected to every group leader, so during the handoff
+    # they may see a publication twice but never miss one. A leader taking
+    # over finishes the handoffs its predecessor left behind.
+    ########################################
+    def watch_loads(self):
+        self.zk.ensure_path("/brokers/load")
+
+        @self.zk.ChildrenWatch("/brokers/load")
+        def watch_groups(children):
+            for group in set(children) - self.load_watched:
+                self.load_watched.add(group)
+                self.watch_load(group)
+
+    def watch_load(self, group):
+        @self.zk.DataWatch("/brokers/load/{}".format(group))
+        def watch(data, stat):
+            if data is None:
+                self.loads.pop(int(group), None)
+                self.load_seen.pop(int(group), None)
+                return
+            self.loads[int(group)] = json.loads(data.decode("utf-8"))
+            # the report's own time is the broker's clock; we only trust ours
+            self.load_seen[int(group)] = time.monotonic()
+            self.rebalance()
+
+    def read_groups(self):
+        '''group -> data of its znode (topics and the ones draining)'''
+        groups = {}
+        for child in self.zk.get_children("/brokers/group"):
+            data, _ = self.zk.get("/brokers/group/{}".format(child))
+            if data:
+                groups[int(child)] = json.loads(data.decode("utf-8"))
+        return groups
+
+    def write_group(self, group, data):
+        self.zk.set("/brokers/group/{}".format(group), json.dumps(data).encode("utf-8"))
+
+    def rebalance(self):
+        try:
+            with self.rebalance_lock:
+                if not self.is_leader or self.migrating:
+                    return
+                groups = self.read_groups()
+                if any(data.get("draining") for data in groups.values()):
+                    self.logger.info("DiscoveryMW::rebalance: finishing a handoff left behind")
+                    self.finish_handoff(groups)
+                    return
+
+                # only groups with a live broker can take topics: one that
+                # missed three of its report intervals is taken for dead
+                now = time.monotonic()
+                live = {group: report for group, report in self.loads.items()
+                        if group in groups and now - self.load_seen[group] <= 3 * report["interval"]}
+                if len(live) < 2:
+                    return
+                assignment = {group: groups[group]["topics"] for group in live}
+                rates = {}
+                for group, report in live.items():
+                    for topic, (msgs, size) in report["topics"].items():
+                        if topic in assignment[group]:
+                            rates[topic] = msgs
+                loads = Rebalancer.loads(assignment, rates)
+                imbalance = Rebalancer.imbalance(loads)
+                total = sum(loads.values())
+
+                # log what the last migration did once every report covers the time after it
+                if self.pending_effect is not None and all(
+                        self.load_seen[group] - report["interval"] >= self.pending_effect["done"]
+                        for group, report in live.items()):
+                    self.logger.info("DiscoveryMW::rebalance: metric effect imbalance {:.2f} -> {:.2f} total {:.1f} -> {:.1f} msgs/s".format(
+                        self.pending_effect["imbalance"], imbalance, self.pending_effect["total"], total))
+                    self.pending_effect = None
+
+                if self.last_rebalance is not None and time.monotonic() - self.last_rebalance < self.cooldown:
+                    return
+                moves = self.rebalancer.plan(assignment, rates)
+                if not moves:
+                    return
+                predicted = {group: list(topics) for group, topics in assignment.items()}
+                for topic, src, dst in moves:
+                    predicted[src].remove(topic)
+                    predicted[dst].append(topic)
+                self.logger.info("DiscoveryMW::rebalance: metric decision imbalance {:.2f} (threshold {}) -> predicted {:.2f} total {:.1f} msgs/s moves {}".format(
+                    imbalance, self.rebalancer.threshold, Rebalancer.imbalance(Rebalancer.loads(predicted, rates)),
+                    total, [(topic, src, dst, round(rates[topic], 1)) for topic, src, dst in moves]))
+
+                # make: the new groups take the topics, the old ones keep them draining
+                changed = set()
+                for topic, src, dst in moves:
+                    groups[dst]["topics"] = sorted(set(groups[dst]["topics"]) | {topic})
+                    groups[src]["draining"] = sorted(set(groups[src].get("draining", [])) | {topic})
+                    changed.update((src, dst))
+                for group in changed:
+                    self.write_group(group, groups[group])
+                self.migrating = True
+                self.last_rebalance = time.monotonic()
+                self.pending_effect = {"imbalance": imbalance, "total": total}
+                timer = threading.Timer(self.handoff, self.end_handoff)
+                timer.daemon = True
+                timer.start()
+        except Exception as e:
+            raise e
+
+    def end_handoff(self):
+        ''' body of the handoff timer '''
+        try:
+            with self.rebalance_lock:
+                self.finish_handoff(self.read_groups())
+                self.migrating = False
+        except Exception as e:
+            # the draining topics are still in the group nodes; try again after
+            # another handoff period while we lead, else leave it to the next leader
+            if self.is_leader:
+                self.logger.error("DiscoveryMW::end_handoff: {}, retrying in {} secs".format(e, self.handoff))
+                timer = threading.Timer(self.handoff, self.end_handoff)
+                timer.daemon = True
+                timer.start()
+            else:
+                self.logger.error("DiscoveryMW::end_handoff: {}, no longer the leader".format(e))
+                self.migrating = False
+
+    def finish_handoff(self, groups):
+        # break: the old groups drop their draining topics
+        for group, data in groups.items():
+            draining = set(data.get("draining", []))
+            if draining:
+                data["topics"] = sorted(set(data["topics"]) - draining)
+                data["draining"] = []
+                self.write_group(group, data)
+                self.logger.info("DiscoveryMW::finish_handoff: group {} handed off {}".format(group, sorted(draining)))
+        if self.pending_effect is not None:
+            self.pending_effect["done"] = time.monotonic()
+
     #################################################################
     # run the event loop where we expect to receive a reply to a sent request
     #################################################################
@@ -0,0 +1,114 @@
+###############################################
+#
+# Purpose: Consistent hash ring assigning topics to broker groups
+#
+###############################################
+
+# Slicing the topic list into contiguous ranges, one per group, moves almost
+# every topic to another group when the number of groups changes. Here every
+# group owns vnodes points on a hash ring and a topic goes to the group owning
+# the first point at or after the topic's own hash. Adding or removing a group
+# only moves the topics falling between its points and their predecessors,
+# about 1/N of them.
+#
+# With few topics the plain ring is lumpy, and nothing keeps the hot topics
+# from landing in the same group. So the assignment uses bounded loads: a
+# group takes at most load_factor * mean worth of topic weight (one per
+# topic unless weights are given, e.g. message rates) and a topic whose group
+# is full walks on to the next group along the ring. Topics are placed
+# heaviest first so the hot ones spread out before the cold ones fill in.
+#
+# The hash is md5 rather than hash(), which is salted per process: every
+# discovery replica and broker has to agree on the ring.
+
+import bisect  # to find a topic's point on the ring
+import hashlib  # for a hash that is stable across processes
+
+
+def ring_hash(key):
+    ''' position of a key on the ring '''
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing():
+    ########################################
+    # constructor
+    #
+    # groups:      ids of the broker groups (e.g. range(n))
+    # vnodes:      points per group on the ring
+    # load_factor: max load of a group relative to the mean, None for the plain ring
+    ########################################
+    def __init__(self, groups, vnodes=64, load_factor=1.25):
+        if load_factor is not None and load_factor < 1:
+            raise ValueError("HashRing: load_factor must be at least 1")
+        self.groups = list(groups)
+        self.vnodes = vnodes
+        self.load_factor = load_factor
+        points = sorted((ring_hash("{}#{}".format(group, i)), group)
+                        for group in self.groups for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [group for _, group in points]
+
+    ########################################
+    # groups in the order a key visits them, starting at its point
+    ########################################
+    def walk(self, key):
+        if not self.hashes:
+            return
+        start = bisect.bisect_left(self.hashes, ring_hash(key))
+        seen = set()
+        for i in range(len(self.owners)):
+            group = self.owners[(start + i) % len(self.owners)]
+            if group not in seen:
+                seen.add(group)
+                yield group
+                if len(seen) == len(self.groups):
+                    return
+
+    def lookup(self, key):
+        ''' group of a key on the plain ring, ignoring loads '''
+        return next(self.walk(key), None)
+
+    ########################################
+    # assign topics to groups
+    #
+    # weights: topic -> load (default 1 per topic)
+    #
+    # returns group -> sorted list of topics, with every group present
+    ########################################
+    def assign(self, topics, weights=None):
+        weights = weights or {}
+        assignment = {group: [] for group in self.groups}
+        if not self.groups:
+            return assignment
+        weight = {topic: max(0.0, float(weights.get(topic, 1.0))) for topic in set(topics)}
+        capacity = None
+        if self.load_factor is not None:
+            total = sum(weight.values())
+            # never below the heaviest topic, or it would fit nowhere
+            capacity = max(self.load_factor * total / len(self.groups),
+                           max(weight.values(), default=0))
+        load = {group: 0.0 for group in self.groups}
+        for topic in sorted(weight, key=lambda t: (-weight[t], t)):
+            chosen = None
+            for group in self.walk(topic):
+                if capacity is None or load[group] + weight[topic] <= capacity:
+                    chosen = group
+                    break
+            if chosen is None:
+                # everything is at capacity; take the least loaded group
+                chosen = min(self.groups, key=lambda g: (load[g], str(g)))
+            assignment[chosen].append(topic)
+            load[chosen] += weight[topic]
+        for group in assignment:
+            assignment[group].sort()
+        return assignment
+
+
+########################################
+# topics that changed group between two assignments
+########################################
+def moved_topics(before, after):
+    owner = {topic: group for group, topics in before.items() for topic in topics}
+    return sorted(topic for group, topics in after.items()
+                  for topic in topics if topic in owner and owner[topic] != group)
@@ -0,0 +1,138 @@
+###############################################
+#
+# Purpose: Constant memory, log bucketed (HDR style) histogram used to
+# keep latency percentiles over long runs
+#
+###############################################
+
+# Values are non-negative integers (we record latencies in microseconds). The
+# first 2^sub_bits values each get their own bucket. Above that every power of
+# two range [2^k, 2^(k+1)) is split into 2^(sub_bits-1) equal buckets, so the
+# relative error of a reported value is at most 2^-(sub_bits-1) (about 1.6% for
+# the default of 7 bits) while the number of buckets only grows with the log of
+# the largest value. The bucket of a value is found with a couple of shifts.
+#
+# Values above the highest trackable one are clamped into the last bucket; the
+# exact max is kept on the side.
+
+import array  # for the bucket counts
+
+
+class Histogram():
+    ########################################
+    # constructor
+    #
+    # sub_bits: bits of precision per power of two range
+    # highest:  highest trackable value (default: an hour in microseconds)
+    ########################################
+    def __init__(self, sub_bits=7, highest=3600 * 1000 * 1000):
+        if sub_bits < 2:
+            raise ValueError("Histogram: sub_bits must be at least 2")
+        self.sub_bits = sub_bits
+        self.sub_count = 1 << sub_bits  # values with a bucket of their own
+        self.half = self.sub_count >> 1  # buckets per power of two range above that
+        self.highest = highest
+        self.counts = array.array("Q", bytes(8 * (self.index(highest) + 1)))
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    ########################################
+    # bucket of a value and the range of values a bucket covers
+    ########################################
+    def index(self, value):
+        if value < self.sub_count:
+            return value
+        shift = value.bit_length() - self.sub_bits
+        return self.sub_count + (shift - 1) * self.half + ((value >> shift) - self.half)
+
+    def bucket_range(self, index):
+        ''' lowest and highest value that fall in a bucket '''
+        if index < self.sub_count:
+            return index, index
+        shift, sub = divmod(index - self.sub_count, self.half)
+        shift += 1
+        low = (sub + self.half) << shift
+        return low, low + (1 << shift) - 1
+
+    ########################################
+    # record a value (count times)
+    ########################################
+    def record(self, value, count=1):
+        value = max(0, int(value))
+        self.counts[self.index(min(value, self.highest))] += count
+        self.total += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    ########################################
+    # value below which p percent of the recorded values fall
+    #
+    # Reported as the highest value of the bucket (never under-reports), but
+    # never above the exact max.
+    ########################################
+    def percentile(self, p):
+        return self.percentiles([p])[p]
+
+    def percentiles(self, ps):
+        ''' several percentiles in one pass over the buckets '''
+        result = {}
+        if not self.total:
+            return {p: None for p in ps}
+        pending = sorted(ps)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if not count:
+                continue
+            seen += count
+            while pending and seen >= self._rank(pending[0]):
+                result[pending.pop(0)] = min(self.bucket_range(index)[1], self.max)
+            if not pending:
+                break
+        for p in pending:
+            result[p] = self.max
+        return result
+
+    def _rank(self, p):
+        # number of values at or below the p-th percentile (at least one)
+        return max(1, int(p / 100.0 * self.total + 0.5))
+
+    def mean(self):
+        return self.sum / self.total if self.total else None
+
+    ########################################
+    # add the counts of another histogram of the same shape
+    ########################################
+    def merge(self, other):
+        if (other.sub_bits, other.highest) != (self.sub_bits, self.highest):
+            raise ValueError("Histogram: cannot merge histograms of different shape")
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+        self.sum += other.sum
+        if other.total:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    ########################################
+    # compact, json friendly dump holding only the non-empty buckets
+    ########################################
+    def dump(self):
+        return {"sub_bits": self.sub_bits, "highest": self.highest,
+                "total": self.total, "sum": self.sum, "min": self.min, "max": self.max,
+                "buckets": [[index, count] for index, count in enumerate(self.counts) if count]}
+
+    @classmethod
+    def load(cls, data):
+        ''' rebuild a histogram from what dump() returned '''
+        hist = cls(data["sub_bits"], data["highest"])
+        for index, count in data["buckets"]:
+            hist.counts[index] = count
+        hist.total, hist.sum = data["total"], data["sum"]
+        hist.min, hist.max = data["min"], data["max"]
+        return hist
@@ -0,0 +1,88 @@
+###############################################
+#
+# Purpose: Fixed capacity history store used for the per-topic
+# sliding window of samples
+#
+###############################################
+
+# The publisher keeps the last h_size samples of every topic and ships the whole
+# window with each publication. Keeping that window in a python list with
+# insert(0, x) and pop() costs O(h_size) per sample, so instead we keep a
+# preallocated ring.
+#
+# The ring is stored twice back to back ("mirrored"): every sample is written at
+# slot i and at slot i + capacity. Samples are written at decreasing indices so
+# that the window, newest sample first, is always the single contiguous slice
+# slots[head:head + count]. Appending is O(1) and exporting the window is one
+# slice (or, for array backed numeric topics, a zero-copy memoryview).
+
+import array  # for the typed backing store of numeric topics
+
+
+class HistoryBuffer():
+    ########################################
+    # constructor
+    #
+    # capacity: max number of samples retained
+    # typecode: array module typecode (e.g. 'd' or 'q') for numeric topics,
+    #           None to hold arbitrary python objects such as strings
+    ########################################
+    def __init__(self, capacity, typecode=None):
+        if capacity < 1:
+            raise ValueError("HistoryBuffer: capacity must be at least 1")
+        self.capacity = capacity  # max number of samples we retain
+        self.typecode = typecode  # None for a list backed store
+        self.head = 0  # slot holding the newest sample
+        self.count = 0  # number of valid samples
+        if typecode is None:
+            self.slots = [None] * (2 * capacity)
+        else:
+            self.slots = array.array(typecode, bytes(
+                array.array(typecode).itemsize * 2 * capacity))
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        ''' true once capacity samples have been seen '''
+        return self.count == self.capacity
+
+    ########################################
+    # add the newest sample, evicting the oldest one when full
+    ########################################
+    def append(self, value):
+        self.head -= 1
+        if self.head < 0:
+            self.head = self.capacity - 1
+        self.slots[self.head] = value
+        self.slots[self.head + self.capacity] = value
+        if self.count < self.capacity:
+            self.count += 1
+
+    ########################################
+    # add several samples given oldest first
+    ########################################
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def newest(self):
+        ''' the most recently appended sample '''
+        if self.count == 0:
+            raise IndexError("HistoryBuffer: empty")
+        return self.slots[self.head]
+
+    ########################################
+    # the window, newest sample first
+    #
+    # Array backed buffers return a memoryview over the store (no copy), so
+    # the result is only valid until the next append.
+    ########################################
+    def view(self):
+        if self.typecode is None:
+            return self.slots[self.head:self.head + self.count]
+        return memoryview(self.slots)[self.head:self.head + self.count]
@@ -0,0 +1,170 @@
+###############################################
+#
+# Purpose: Buffered, asynchronous recorder of the measured latencies
+#
+###############################################
+
+# Opening, appending to and closing the output file for every received message
+# puts filesystem syscalls on the receive path and inflates the very latency we
+# are measuring. Instead the receive path only appends to two in-memory columns
+# (time, latency). Full batches are handed to a background thread which writes
+# them out.
+#
+# Memory is bounded: at most max_batches batches wait for the writer. If the
+# writer falls that far behind, new batches are dropped and counted rather than
+# blocking the receive path.
+#
+# A partial batch is handed over by the writer thread itself once it is
+# flush_interval old, so an idle or low-rate subscriber still gets its samples
+# written out about once a flush_interval. A lock guards the columns against
+# that hand over; the receive path takes it uncontended almost always.
+#
+# Two output formats are supported:
+#   csv:    the "Time,Latency" file we always produced
+#   binary: a columnar file. A header line (MAGIC) is followed by blocks, each
+#           a "<4sI" block header (BLOCK_MAGIC, n) and then n doubles of times
+#           and n doubles of latencies. read_binary() loads it back.
+
+import csv  # for the csv format
+import array  # for the in-memory columns
+import queue  # to hand batches to the writer
+import struct  # for the block headers of the binary format
+import threading  # for the writer thread
+import time  # for the flush interval
+
+MAGIC = b"CS6381LAT1\n"
+BLOCK_MAGIC = b"LATB"
+BLOCK_HEADER = struct.Struct("<4sI")
+
+FORMATS = ("csv", "binary")
+
+
+class LatencyRecorder():
+    ########################################
+    # constructor
+    #
+    # filename:       output file, truncated on start
+    # fmt:            "csv" or "binary"
+    # batch:          samples per batch handed to the writer
+    # max_batches:    max batches waiting for the writer
+    # flush_interval: secs after which a partial batch is handed over anyway
+    ########################################
+    def __init__(self, filename, fmt="csv", batch=4096, max_batches=64, flush_interval=1.0):
+        if fmt not in FORMATS:
+            raise ValueError("LatencyRecorder: unknown format {}".format(fmt))
+        self.filename = filename
+        self.fmt = fmt
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue(maxsize=max_batches)  # batches waiting for the writer
+        self.times = array.array("d")  # column of receive times of the current batch
+        self.latencies = array.array("d")  # column of latencies of the current batch
+        self.last_flush = None  # time the current batch was started
+        self.lock = threading.Lock()  # guards the columns, shared with the writer's timed flush
+        self.thread = None
+        self.file = None
+        self.recorded = 0  # samples handed to the writer
+        self.written = 0  # samples written out
+        self.dropped = 0  # samples dropped because the writer fell behind
+
+    ########################################
+    # truncate the output file and start the writer thread
+    ########################################
+    def start(self):
+        if self.fmt == "csv":
+            self.file = open(self.filename, "w", newline='')
+            csv.writer(self.file).writerow(["Time", "Latency"])
+        else:
+            self.file = open(self.filename, "wb")
+            self.file.write(MAGIC)
+        self.last_flush = time.monotonic()
+        self.thread = threading.Thread(target=self.writer, name="LatencyRecorder", daemon=True)
+        self.thread.start()
+
+    ########################################
+    # record one sample; called on the receive path
+    ########################################
+    def record(self, when, latency):
+        with self.lock:
+            self.times.append(when)
+            self.latencies.append(latency)
+            full = len(self.times) >= self.batch
+        if full:
+            self.flush()
+
+    ########################################
+    # hand the current batch, if any, to the writer
+    ########################################
+    def flush(self):
+        with self.lock:
+            self.last_flush = time.monotonic()
+            if not self.times:
+                return
+            batch = (self.times, self.latencies)
+            self.times, self.latencies = array.array("d"), array.array("d")
+            try:
+                self.pending.put_nowait(batch)
+                self.recorded += len(batch[0])
+            except queue.Full:
+                self.dropped += len(batch[0])
+
+    ########################################
+    # flush what is left and wait for the writer to finish
+    ########################################
+    def close(self):
+        if self.thread is None:
+            return
+        self.flush()
+        self.pending.put(None)  # tells the writer we are done
+        self.thread.join()
+        self.thread = None
+        self.file.close()
+
+    def stats(self):
+        ''' counters of the recorder '''
+        return {"recorded": self.recorded, "written": self.written, "dropped": self.dropped}
+
+    ########################################
+    # body of the writer thread; when no batch arrives within the flush
+    # interval it hands over the partial one itself
+    ########################################
+    def writer(self):
+        while True:
+            try:
+                batch = self.pending.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if time.monotonic() - self.last_flush >= self.flush_interval:
+                    self.flush()
+                continue
+            if batch is None:
+                break
+            times, latencies = batch
+            if self.fmt == "csv":
+                csv.writer(self.file).writerows(zip(times, latencies))
+            else:
+                self.file.write(BLOCK_HEADER.pack(BLOCK_MAGIC, len(times)))
+                times.tofile(self.file)
+                latencies.tofile(self.file)
+            # keep the file usable even if we get killed before close()
+            self.file.flush()
+            self.written += len(times)
+
+
+########################################
+# load a binary recording as two arrays (times, latencies)
+########################################
+def read_binary(filename):
+    times, latencies = array.array("d"), array.array("d")
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("read_binary: {} is not a latency recording".format(filename))
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if not header:
+                break
+            magic, n = BLOCK_HEADER.unpack(header)
+            if magic != BLOCK_MAGIC:
+                raise ValueError("read_binary: corrupt block in {}".format(filename))
+            times.fromfile(f, n)
+            latencies.fromfile(f, n)
+    return times, latencies
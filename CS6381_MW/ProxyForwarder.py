@@ -0,0 +1,193 @@
+###############################################
+#
+# Purpose: Forward a broker's SUB -> PUB traffic with a ZMQ proxy device
+# running in a background thread
+#
+###############################################
+
+# Forwarding in python costs a poll, a recv_multipart, a send_multipart and the
+# upcall machinery per message. zmq.proxy_steerable does the same loop inside
+# libzmq, so the interpreter is out of the data path altogether.
+#
+# The proxy thread owns the SUB (frontend) and PUB (backend) sockets while it
+# runs, and ZMQ sockets must not be used by two threads at once. Anything that
+# has to touch them (connecting to a new publisher, changing subscriptions) goes
+# through reconfigure(): we TERMINATE the proxy over its control socket, apply
+# the change in the calling thread and start the proxy again. Messages arriving
+# in between simply wait in the SUB socket's queue.
+#
+# With capture enabled, the proxy also copies every message to a capture
+# socket and a statistics thread counts messages and bytes per topic from it.
+# That costs one extra copy per message inside libzmq, so it is optional. An
+# observer, if given, is also handed every captured message in that thread.
+#
+# libzmq's proxy sends to the capture socket blocking, so a PUSH socket would
+# hold up the forwarding whenever the python thread falls behind. The capture
+# socket is therefore a PUB with a bounded queue (capture_hwm): once the
+# statistics thread is that far behind, captured copies are dropped, never
+# the forwarded messages. We learn how many the proxy forwarded from its
+# STATISTICS command whenever we stop it, in frames; the difference to the
+# frames we captured is reported as dropped_frames.
+
+import struct  # for the counters of the proxy's STATISTICS reply
+import threading  # for the proxy and statistics threads
+import time  # for the report interval
+import zmq
+
+
+class ProxyForwarder():
+    ########################################
+    # constructor
+    #
+    # context:  ZMQ context of the sockets
+    # frontend: SUB socket receiving from the publishers
+    # backend:  PUB socket serving the subscribers
+    # logger:   logger of the owning middleware object
+    # capture:  count traffic per topic through a capture socket
+    # report_interval: secs between statistics reports (with capture)
+    # observer: called with the frames of every captured message
+    # capture_hwm: max captured messages waiting for the statistics thread
+    ########################################
+    def __init__(self, context, frontend, backend, logger, capture=False, report_interval=10, observer=None,
+                 capture_hwm=10000):
+        self.context = context
+        self.frontend = frontend
+        self.backend = backend
+        self.logger = logger
+        self.capture = capture
+        self.report_interval = report_interval
+        self.observer = observer
+        self.capture_hwm = capture_hwm
+        self.tag = "{:x}".format(id(self))
+        self.control_addr = None  # fresh for every start, a closed inproc endpoint may linger
+        self.capture_addr = "inproc://proxy-capture-" + self.tag
+        self.control = None  # our end of the proxy's control socket
+        self.thread = None
+        self.stats_thread = None
+        self.running = False
+        self.restarts = 0  # times the proxy was restarted to reconfigure it
+        self.messages = 0  # messages seen on the capture socket
+        self.bytes = 0
+        self.topics = {}  # topic -> [messages, bytes]
+        self.frames = 0  # frames seen on the capture socket
+        self.proxied = 0  # frames the proxy took in on both sockets, as of its last stop
+
+    ########################################
+    # start the proxy (and the statistics thread)
+    ########################################
+    def start(self):
+        if self.running:
+            return
+        self.control_addr = "inproc://proxy-control-{}-{}".format(self.tag, self.restarts)
+        self.control = self.context.socket(zmq.PAIR)
+        self.control.bind(self.control_addr)
+        if self.capture and self.stats_thread is None:
+            ready = threading.Event()
+            self.stats_thread = threading.Thread(target=self.count, args=(ready,),
+                                                 name="ProxyForwarder-stats", daemon=True)
+            self.stats_thread.start()
+            ready.wait()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(ready,), name="ProxyForwarder", daemon=True)
+        self.thread.start()
+        ready.wait()
+        self.running = True
+
+    def run(self, ready):
+        ''' body of the proxy thread '''
+        control = self.context.socket(zmq.PAIR)
+        control.connect(self.control_addr)
+        capture = None
+        if self.capture:
+            # a PUB drops what does not fit in its queue instead of blocking the proxy
+            capture = self.context.socket(zmq.PUB)
+            capture.setsockopt(zmq.SNDHWM, self.capture_hwm)
+            capture.connect(self.capture_addr)
+        ready.set()
+        try:
+            zmq.proxy_steerable(self.frontend, self.backend, capture, control)
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            control.close()
+            if capture is not None:
+                capture.close(linger=0)
+
+    ########################################
+    # stop the proxy; the sockets are ours again afterwards
+    ########################################
+    def stop(self):
+        if not self.running:
+            return
+        if self.capture:
+            # frontend and backend frames in, out of the 8 counters (in/out frames and bytes per side)
+            self.control.send(b"STATISTICS")
+            counters = [struct.unpack("=Q", frame)[0] for frame in self.control.recv_multipart()]
+            self.proxied += counters[0] + counters[4]
+        self.control.send(b"TERMINATE")
+        self.thread.join()
+        self.control.close()
+        self.control = None
+        self.thread = None
+        self.running = False
+
+    ########################################
+    # run func(frontend, backend) with the proxy out of the way
+    ########################################
+    def reconfigure(self, func):
+        was_running = self.running
+        self.stop()
+        try:
+            func(self.frontend, self.backend)
+        finally:
+            if was_running:
+                self.restarts += 1
+                self.start()
+
+    def count(self, ready):
+        ''' body of the statistics thread '''
+        sub = self.context.socket(zmq.SUB)
+        sub.setsockopt(zmq.RCVHWM, self.capture_hwm)
+        sub.setsockopt(zmq.SUBSCRIBE, b"")
+        sub.bind(self.capture_addr)
+        ready.set()
+        last_report = time.monotonic()
+        poller = zmq.Poller()
+        poller.register(sub, zmq.POLLIN)
+        try:
+            while True:
+                if dict(poller.poll(timeout=1000)):
+                    # drain what is queued rather than polling once per message
+                    for _ in range(self.capture_hwm):
+                        try:
+                            frames = sub.recv_multipart(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        size = sum(len(frame) for frame in frames)
+                        self.messages += 1
+                        self.frames += len(frames)
+                        self.bytes += size
+                        topic = self.topics.setdefault(frames[0], [0, 0])
+                        topic[0] += 1
+                        topic[1] += size
+                        if self.observer is not None:
+                            try:
+                                self.observer(frames)
+                            except Exception as e:
+                                self.logger.error("ProxyForwarder::count - observer failed: {}".format(e))
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    self.logger.info("ProxyForwarder::count - {}".format(self.stats()))
+        except zmq.ContextTerminated:
+            sub.close()
+
+    def stats(self):
+        ''' counters of the forwarder '''
+        stats = {"running": self.running, "restarts": self.restarts,
+                 "messages": self.messages, "bytes": self.bytes,
+                 "topics": {topic.decode("utf-8", "replace"): list(counts)
+                            for topic, counts in list(self.topics.items())}}
+        if self.capture:
+            # only exact once the proxy is stopped and we caught up with the capture queue
+            stats["dropped_frames"] = max(0, self.proxied - self.frames)
+        return stats
@@ -31,6 +31,7 @@ import logging # for logging. Use it in place of print statements.
 import zmq  # ZMQ sockets
 import json
 import timeit # for timing
+import queue # for handing work from ZK watch threads to the event loop
 
 from kazoo.client import KazooClient
 from kazoo.exceptions import NodeExistsError, NoNodeError
@@ -38,6 +39,9 @@ from kazoo.recipe.election import Election
 from kazoo.recipe.watchers import DataWatch
 # import serialization logic
 from CS6381_MW import discovery_pb2
+from CS6381_MW.HistoryBuffer import HistoryBuffer
+from CS6381_MW.Common import BATCH_TOPIC, TOPIC_CODES, PAYLOAD_STRING, PAYLOAD_TYPECODE, payload_kind, payload_count, raw_series
+from CS6381_MW.Common import FLAG_FULL, FLAG_DELTA, FLAG_BATCH, pack_header
 #from CS6381_MW import topic_pb2  # you will need this eventually
 
 # import any other packages you need.
@@ -53,7 +57,7 @@ class PublisherMW ():
   def __init__ (self, logger):
     self.logger = logger  # internal logger for print statements
     self.req = None # will be a ZMQ REQ socket to talk to Discovery service
-    self.pub = None # will be a ZMQ PUB socket for dissemination
+    self.pub = None # will be a ZMQ XPUB socket for dissemination
     self.poller = None # used to wait on incoming replies
     self.addr = None # our advertised IP address
     self.port = None # port num where we are going to publish our topics
@@ -63,13 +67,35 @@ class PublisherMW ():
     self.name = None
     self.discovery = None #string of discovery service address to disconnect from
     self.topiclist = None #list of topics to publish
-    self.history = None #dictionary with key = topic and value = list of messages of size N
+    self.history = None #dictionary with key = topic and value = HistoryBuffer of the last N messages
+    self.payload = None #dictionary with key = topic and value = Publication field carrying its samples
+    self.codes = None #dictionary with key = categorical topic and value = label to code mapping
     self.h_size = None #size of history
+    self.owners = {} #cached topic ownership, key = topic and value = name of the owning publisher
+    self.owner_stats = None #counters describing how the cached ownership view evolved
+    self.owner_zxid = {} #key = topic and value = mzxid of the ownership znode we last saw (None = no node)
+    self.owner_writes = {} #key = topic and value = when (monotonic) we created its ownership znode
+    self.delta = False #send only the newest sample plus a sequence number instead of the whole window
+    self.resync = None #in delta mode, send a full window every resync samples
+    self.seq = None #dictionary with key = topic and value = sequence number of the last sample sent
+    self.since_full = None #dictionary with key = topic and value = samples sent since the last full window
+    self.resync_pending = set () #topics for which a subscriber asked for a full window
+    self.batch_size = 1 #max publications per frame, 1 disables batching
+    self.batch_window = 0 #max secs a publication may wait in a batch, 0 = flush every tick
+    self.batch = None #PublicationBatch being filled
+    self.batch_start = None #time the first publication of the pending batch was added
+    self.batch_topic = bytes (BATCH_TOPIC, "utf-8")
+    self.deferred = queue.SimpleQueue () #work handed to the event loop by ZK watch callbacks
+    self.idle_timeout = 100 #msecs to poll for when the appln has no timer running
+    self.copy = True #False to send without copying our buffers into ZMQ
+    self.wanted = set () #topic prefixes somebody downstream subscribed to
+    self.wanted_cache = {} #key = topic frame and value = whether any prefix in wanted matches it
+    self.suppressed = {} #key = topic and value = [messages, bytes] sent while nobody subscribed
 
   ########################################
   # configure/initialize
   ########################################
-  def configure (self, args, topiclist):
+  def configure (self, args, topiclist, zero_copy=False):
     ''' Initialize the object '''
 
     try:
@@ -77,14 +103,35 @@ class PublisherMW ():
       # Here we initialize any internal variables
       self.logger.info ("PublisherMW::configure")
 
-      self.logger.debug("PublisherMW::configure: creating ZK client")
-      self.zk = KazooClient(hosts=args.zookeeper)
+      # the asyncio flavor hands us a client it already connected
+      if self.zk is None:
+        self.logger.debug("PublisherMW::configure: creating ZK client")
+        self.zk = KazooClient(hosts=args.zookeeper)
       # First retrieve our advertised IP addr and the publication port num
       self.port = args.port
       self.addr = args.addr
       self.name = args.name
       self.h_size = args.h_size
       self.topiclist = topiclist
+      # numeric and categorical topics keep their history in typed arrays that are
+      # shipped as packed repeated fields
+      self.payload = {topic: payload_kind (topic) for topic in topiclist}
+      self.codes = {topic: {label: code for code, label in enumerate (labels)}
+                    for topic, labels in TOPIC_CODES.items ()}
+      self.history = {topic: HistoryBuffer (self.h_size, PAYLOAD_TYPECODE[self.payload[topic]])
+                      for topic in topiclist}
+      self.owners = {}
+      self.owner_stats = {"changes": 0, "skipped": 0, "last_staleness": 0.0, "max_staleness": 0.0}
+      self.delta = args.delta
+      self.resync = args.resync if args.resync > 0 else 10 * self.h_size
+      self.seq = {topic: 0 for topic in topiclist}
+      # start out due for a full window so that the very first frame is one
+      self.since_full = {topic: self.resync for topic in topiclist}
+      self.batch_size = args.batch_size
+      self.batch_window = args.batch_window / 1000.0
+      self.batch = discovery_pb2.PublicationBatch ()
+      # with zero copy, ZMQ references our serialized buffers instead of copying them
+      self.copy = not zero_copy
       # Next get the ZMQ context
       self.logger.debug ("PublisherMW::configure - obtain ZMQ context")
       context = zmq.Context ()  # returns a singleton object
@@ -93,18 +140,20 @@ class PublisherMW ():
       self.logger.debug ("PublisherMW::configure - obtain the poller")
       self.poller = zmq.Poller ()
       
-      # Now acquire the REQ and PUB sockets
+      # Now acquire the REQ and XPUB sockets
       # REQ is needed because we are the client of the Discovery service
-      # PUB is needed because we publish topic data
-      self.logger.debug ("PublisherMW::configure - obtain REQ and PUB sockets")
+      # XPUB is needed because we publish topic data. It sends like a PUB
+      # socket but also tells us what the brokers subscribe to, so that we
+      # can count the traffic dropped because nobody wants it.
+      self.logger.debug ("PublisherMW::configure - obtain REQ and XPUB sockets")
       self.req = context.socket (zmq.REQ)
-      self.pub = context.socket (zmq.PUB)
+      self.pub = context.socket (zmq.XPUB)
 
       # Since are using the event loop approach, register the REQ socket for incoming events
-      # Note that nothing ever will be received on the PUB socket and so it does not make
-      # any sense to register it with the poller for an incoming message.
-      self.logger.debug ("PublisherMW::configure - register the REQ socket for incoming replies")
+      # and the XPUB socket for incoming subscriptions
+      self.logger.debug ("PublisherMW::configure - register the REQ and XPUB sockets for incoming messages")
       self.poller.register (self.req, zmq.POLLIN)
+      self.poller.register (self.pub, zmq.POLLIN)
       
       # Now connect ourselves to the discovery service. Recall that the IP/port were
       # supplied in our argument parsing. Best practices of ZQM suggest that the
@@ -126,13 +175,11 @@ class PublisherMW ():
       @self.zk.DataWatch("/leader")
       def watch_leader(data, stat):
         self.logger.info("PublisherMW::watch_leader: leader node changed")
-        meta = json.loads(self.zk.get("/leader")[0].decode('utf-8'))
-        self.logger.info("PublisherMW::watch_leader: disconnecting req and redirecting to new leader")
-        if self.discovery != None:
-          self.req.disconnect(self.discovery)
-        self.req.connect(meta["rep_addr"])
-        self.discovery = meta["rep_addr"]
-        self.logger.info("Successfully connected to new leader")
+        if data is None:
+          return
+        meta = json.loads(data.decode('utf-8'))
+        # the REQ socket belongs to the event loop thread, so let it reconnect
+        self.defer(lambda: self.connect_discovery(meta["rep_addr"]))
         
       self.logger.info("PublisherMW::configure completed")
       
@@ -145,22 +192,108 @@ class PublisherMW ():
     for topic in topiclist:
       self.logger.info("PublisherMW::try_leader: trying to become leader for topic: " + topic)
       try:
+        self.owner_writes[topic] = time.monotonic()
         self.zk.create("/{}".format(topic), value=self.name.encode('utf'), ephemeral=True, makepath=True)
         self.logger.info("PublisherMW::try_leader: successfully became leader for topic: " + topic)
       except NodeExistsError:
+        self.owner_writes.pop(topic, None)
         self.logger.info("PublisherMW::try_leader: failed to become leader for topic: " + topic)
       except Exception as e:
         raise e
       
   def setWatch(self):
     for topic in self.topiclist:
+      self.watch_topic(topic)
+      if self.delta:
+        self.watch_resync(topic)
+
+  ########################################
+  # watch the ownership znode of a topic
+  #
+  # The DataWatch fires once right away with the current owner and then on
+  # every change, so the ownership table is filled from ZK pushes and the
+  # dissemination path never has to read ZK itself.
+  ########################################
+  def watch_topic(self, topic):
+    @self.zk.DataWatch("/{}".format(topic))
+    def watch_owner(data, stat):
+      owner = data.decode("utf-8") if data is not None else None
+      self.update_owner(topic, owner, stat)
       # watch for if the leader node is deleted
-      @self.zk.DataWatch("/{}".format(topic))
-      def watch_topic(data, stat):
-        if data is None:
-          self.logger.info("PublisherMW::watch_topic: leader node for topic: " + topic + " deleted")
-          self.try_leader([topic])    
-          
+      if data is None:
+        self.logger.info("PublisherMW::watch_topic: leader node for topic: " + topic + " deleted")
+        self.try_leader([topic])
+
+  ########################################
+  # update the cached ownership table
+  #
+  # staleness is how long after our own write of the znode we heard about
+  # it, i.e., how far our cached view lagged behind. Only our own writes
+  # are timed: both ends are then on our clock, whereas stat.mtime is the
+  # ZK server's. The first fire of the watch reports the node as it was
+  # and is no change at all, so it is not timed either.
+  ########################################
+  def update_owner(self, topic, owner, stat):
+    zxid = stat.mzxid if stat is not None else None
+    changed = topic in self.owner_zxid and self.owner_zxid[topic] != zxid
+    self.owner_zxid[topic] = zxid
+    if self.owners.get(topic) != owner:
+      self.owner_stats["changes"] += 1
+      self.logger.info("PublisherMW::update_owner: topic {} now owned by {}".format(topic, owner))
+      if owner == self.name and self.delta:
+        # the subscribers hold the window of the previous owner; our deltas
+        # would not follow it, so we start with a full window
+        self.resync_pending.add(topic)
+    self.owners[topic] = owner
+    written = self.owner_writes.pop(topic, None) if owner is not None else None
+    if changed and written is not None and owner == self.name:
+      staleness = time.monotonic() - written
+      self.owner_stats["last_staleness"] = staleness
+      self.owner_stats["max_staleness"] = max(self.owner_stats["max_staleness"], staleness)
+
+  def ownership_stats(self):
+    ''' return a copy of the ownership counters '''
+    return dict(self.owner_stats)
+
+  ########################################
+  # watch for resync requests on a topic
+  #
+  # In delta mode a subscriber that sees a gap in the sequence numbers
+  # touches /resync/<topic>; we answer with a full window on the next send.
+  ########################################
+  def watch_resync(self, topic):
+    self.zk.ensure_path("/resync/{}".format(topic))
+
+    @self.zk.DataWatch("/resync/{}".format(topic))
+    def watch_request(data, stat):
+      if data:
+        self.logger.info("PublisherMW::watch_resync: {} asked for a full window of {}".format(data.decode("utf-8"), topic))
+        self.resync_pending.add(topic)
+
+
+  ########################################
+  # hand work over to the event loop thread
+  #
+  # ZK watch callbacks run in kazoo's own thread. Anything that touches our
+  # ZMQ sockets is queued here and run by the event loop between ticks.
+  ########################################
+  def defer(self, func):
+    self.deferred.put(func)
+
+  def run_deferred(self):
+    while not self.deferred.empty():
+      self.deferred.get_nowait()()
+
+  def connect_discovery(self, rep_addr):
+    if rep_addr == self.discovery:
+      return
+    self.logger.info("PublisherMW::connect_discovery: disconnecting req and redirecting to new leader")
+    if self.discovery != None:
+      self.req.disconnect(self.discovery)
+    self.req.connect(rep_addr)
+    self.discovery = rep_addr
+    self.logger.info("Successfully connected to new leader")
+
   def set_req(self):
     self.zk.start()
     try:
@@ -168,6 +301,7 @@ class PublisherMW ():
         time.sleep(1)
       meta = json.loads(self.zk.get("/leader")[0].decode('utf-8'))
       self.req.connect(meta["rep_addr"])
+      self.discovery = meta["rep_addr"]
       self.logger.debug("Successfully connected to leader")
         
     except Exception as e:
@@ -185,9 +319,22 @@ class PublisherMW ():
       # we are using a class variable called "handle_events" which is set to
       # True but can be set out of band to False in order to exit this forever
       # loop
+      # the appln tells us through its return value when it wants control back.
+      # We keep that as an absolute wakeup time so that handling a reply (or
+      # any other event) in between does not push the appln's timer back.
+      wakeup = None if timeout is None else time.monotonic () + timeout / 1000.0
       while self.handle_events:  # it starts with a True value
-        # poll for events. We give it an infinite timeout.
+        # first run whatever the ZK watch callbacks handed over to us. They run in
+        # kazoo's thread and must not touch our ZMQ sockets themselves.
+        self.run_deferred ()
+
+        # poll for events until the appln's timer is due. If the appln has no
+        # timer we still wake up now and then to pick up deferred work.
         # The return value is a socket to event mask mapping
+        if wakeup is None:
+          timeout = self.idle_timeout
+        else:
+          timeout = max (0, int ((wakeup - time.monotonic ()) * 1000))
         events = dict (self.poller.poll (timeout=timeout))
 
         # Unlike the previous starter code, here we are never returning from
@@ -198,16 +345,25 @@ class PublisherMW ():
         # check if a timeout has occurred. We know this is the case when
         # the event mask is empty
         if not events:
+          if wakeup is None:
+            continue  # just an idle wakeup
           # timeout has occurred so it is time for us to make appln-level
           # method invocation. Make an upcall to the generic "invoke_operation"
           # which takes action depending on what state the application
           # object is in.
           timeout = self.upcall_obj.invoke_operation ()
+          wakeup = None if timeout is None else time.monotonic () + timeout / 1000.0
           
         elif self.req in events:  # this is the only socket on which we should be receiving replies
 
           # handle the incoming reply from remote entity and return the result
           timeout = self.handle_reply ()
+          if timeout is not None:
+            due = time.monotonic () + timeout / 1000.0
+            wakeup = due if wakeup is None else min (wakeup, due)
+
+        elif self.pub in events:  # a broker (un)subscribed
+          self.recv_subscription ()
           
         else:
           raise Exception ("Unknown event after poll")
@@ -352,36 +508,157 @@ class PublisherMW ():
     try:
       self.logger.debug ("PublisherMW::disseminate")
       if (topic not in self.history):
-          self.history[topic] = []
-      self.history[topic].insert(0, data)
-      if (len(self.history[topic]) > self.h_size ):
-        self.history[topic].pop()
-      # Now use the protobuf logic to encode the info and send it.  But for now
-      # we are simply sending the string to make sure dissemination is working.
-      data, _ = self.zk.get("/{}".format(topic))
-      if data.decode("utf-8") == self.name:        
-        send_str = topic + ":" + data
-        
-        #EDIT: building the protobuf message 
-        send_msg = discovery_pb2.Publication()
-        send_msg.timestamp = time.monotonic()
-        send_msg.topic = topic
-        send_msg.data[:] = self.history[topic]
-        
-        self.logger.debug ("PublisherMW::disseminate - {}".format (send_str))
-        # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
-        # a real string
-        buf2send = send_msg.SerializeToString ()
-        self.logger.debug ("Stringified serialized buf = {}".format (buf2send))
-        # send the info as bytes. See how we are providing an encoding of utf-8
-        self.pub.send_multipart ([bytes(send_str, "utf-8"), buf2send])
+        self.payload[topic] = payload_kind (topic)
+        self.history[topic] = HistoryBuffer (self.h_size, PAYLOAD_TYPECODE[self.payload[topic]])
+      # categorical samples are kept and sent as their code
+      if (topic in self.codes):
+        data = self.codes[topic][data]
+      # O(1) ring update; the window is exported newest first in one slice
+      self.history[topic].append (data)
+      # Ownership comes from the table kept up to date by our ZK watches.
+      if self.owners.get(topic) != self.name:
+        self.owner_stats["skipped"] += 1
+        self.logger.debug("Not leader, cancel publishing.")
+        return
+
+      if self.batch_size > 1:
+        # fill the publication in place inside the pending batch frame
+        if not self.batch.pubs:
+          self.batch_start = time.monotonic ()
+        self.fill_publication (self.batch.pubs.add (), topic, data)
+        if (len (self.batch.pubs) >= self.batch_size or
+            (self.batch_window > 0 and time.monotonic () - self.batch_start >= self.batch_window)):
+          self.flush ()
       else:
-        self.logger.info("Not leader, cancel publishing.")
+        send_msg = discovery_pb2.Publication()
+        self.fill_publication (send_msg, topic, data)
+        self.send_publication (send_msg)
 
       self.logger.debug ("PublisherMW::disseminate complete")
     except Exception as e:
       raise e
-            
+
+  ########################################
+  # populate a publication for the newest sample of a topic
+  ########################################
+  def fill_publication (self, send_msg, topic, data):
+    self.seq[topic] += 1
+    self.since_full[topic] += 1
+
+    #EDIT: building the protobuf message 
+    send_msg.timestamp = time.monotonic()
+    send_msg.topic = topic
+    send_msg.seq = self.seq[topic]
+    send_msg.pub_id = self.name
+    # numeric topics go into the series of their payload type
+    kind = self.payload[topic]
+    values = send_msg.data if kind == PAYLOAD_STRING else getattr (send_msg, kind).values
+    # in delta mode we only ship the newest sample unless a full window is
+    # due (periodically or because a subscriber reported a gap)
+    if (not self.delta or self.since_full[topic] >= self.resync or topic in self.resync_pending):
+      send_msg.full = True
+      if kind == PAYLOAD_STRING:
+        values.extend (self.history[topic].view ())
+      else:
+        # one copy of the typed window rather than a conversion per sample
+        getattr (send_msg, kind).raw = raw_series (self.history[topic].view ())
+      self.since_full[topic] = 0
+      self.resync_pending.discard (topic)
+    else:
+      values.append (data)
+
+  ########################################
+  # send a single publication under its own topic and header frames
+  ########################################
+  def send_publication (self, send_msg):
+    # The topic frame is just the topic name; the value lives in the typed payload
+    send_str = send_msg.topic
+    self.logger.debug ("PublisherMW::send_publication - {}".format (send_str))
+    # now let us stringify the buffer and print it. This is actually a sequence of bytes and not
+    # a real string
+    buf2send = send_msg.SerializeToString ()
+    # lazily formatted: the repr of a large window costs more than sending it
+    self.logger.debug ("Stringified serialized buf = %s", buf2send)
+    # the header lets receivers judge the message without parsing it
+    flags = (FLAG_FULL if send_msg.full else 0) | (FLAG_DELTA if self.delta else 0)
+    header = pack_header (payload_count (send_msg), send_msg.seq, flags)
+    # send the info as bytes. See how we are providing an encoding of utf-8
+    topic = bytes(send_str, "utf-8")
+    self.count_suppressed (topic, len (header) + len (buf2send))
+    self.pub.send_multipart ([topic, header, buf2send], copy=self.copy)
+
+  ########################################
+  # send whatever is pending in the batch as one frame
+  #
+  # A batch of one goes out as a regular publication so that receivers can
+  # still use ZMQ topic filtering for it.
+  ########################################
+  def flush (self):
+    try:
+      if not self.batch.pubs:
+        return
+      if len (self.batch.pubs) == 1:
+        self.send_publication (self.batch.pubs[0])
+      else:
+        self.logger.debug ("PublisherMW::flush - sending batch of {}".format (len (self.batch.pubs)))
+        header = pack_header (len (self.batch.pubs), 0, FLAG_BATCH)
+        buf2send = self.batch.SerializeToString ()
+        self.count_suppressed (self.batch_topic, len (header) + len (buf2send))
+        self.pub.send_multipart ([self.batch_topic, header, buf2send], copy=self.copy)
+      self.batch.Clear ()
+    except Exception as e:
+      raise e
+
+  ########################################
+  # subscriptions from downstream
+  #
+  # Without XPUB_VERBOSE the XPUB socket reports only the first subscribe
+  # and the last unsubscribe of a prefix, so it is enough to keep the set
+  # of prefixes somebody wants. A message whose topic matches none of them
+  # is dropped by the socket; we count it as suppressed traffic.
+  ########################################
+  def recv_subscription (self):
+    try:
+      frame = self.pub.recv ()
+      if not frame:
+        return
+      self.logger.debug ("PublisherMW::recv_subscription - {}".format (frame))
+      if frame[0] == 1:
+        self.wanted.add (frame[1:])
+      else:
+        self.wanted.discard (frame[1:])
+      self.wanted_cache.clear ()
+    except Exception as e:
+      raise e
+
+  def count_suppressed (self, topic, size):
+    ''' count a message that nobody downstream subscribed to '''
+    wanted = self.wanted_cache.get (topic)
+    if wanted is None:
+      wanted = any (topic.startswith (prefix) for prefix in self.wanted)
+      self.wanted_cache[topic] = wanted
+    if not wanted:
+      counts = self.suppressed.setdefault (topic.decode ("utf-8"), [0, 0])
+      counts[0] += 1
+      counts[1] += size
+
+  def suppression_stats (self):
+    ''' messages and bytes per topic that never left our socket '''
+    return {"messages": sum (counts[0] for counts in self.suppressed.values ()),
+            "bytes": sum (counts[1] for counts in self.suppressed.values ()),
+            "topics": {topic: list (counts) for topic, counts in self.suppressed.items ()}}
+
+  ########################################
+  # the application finished one tick of dissemination
+  #
+  # Without a time window, a batch covers exactly one tick. With a window,
+  # the batch is flushed once its oldest sample has waited long enough.
+  ########################################
+  def end_tick (self):
+    if self.batch_size > 1 and self.batch.pubs:
+      if (self.batch_window == 0 or time.monotonic () - self.batch_start >= self.batch_window):
+        self.flush ()
+
   ########################################
   # set upcall handle
   #
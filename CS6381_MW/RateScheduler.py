@@ -0,0 +1,104 @@
+###############################################
+#
+# Purpose: Drift free periodic scheduler used to pace dissemination
+#
+###############################################
+
+# Sleeping for 1/frequency after doing the work makes the real rate drift below
+# the requested one (the work and the oversleep add up every tick). Instead we
+# keep absolute deadlines start + k * period and wait until the next one.
+#
+# When we fall behind, ticks that are already due run back to back. How far we
+# may catch up is bounded like a token bucket: at most "burst" late ticks are
+# replayed, anything older is dropped (and counted) so that a long stall does
+# not turn into a flood of publications.
+#
+# Sleeping is coarse (tens of microseconds at best), so for the last stretch
+# before a deadline we spin. That lets us pace rates of 10 kHz and more.
+
+import time  # for the clock and sleep
+import math  # for sqrt
+
+
+class RateScheduler():
+    ########################################
+    # constructor
+    #
+    # rate:  ticks per second, may be fractional
+    # burst: max number of late ticks replayed back to back
+    # spin:  secs before a deadline at which we stop sleeping and spin
+    ########################################
+    def __init__(self, rate, burst=None, spin=0.0002):
+        if rate <= 0:
+            raise ValueError("RateScheduler: rate must be positive")
+        self.rate = rate
+        self.period = 1.0 / rate
+        # by default allow catching up on 50 msecs worth of ticks
+        self.burst = burst if burst is not None else max(1, int(rate * 0.05))
+        self.spin = spin
+        self.start_time = None  # time of the first deadline
+        self.next = None  # absolute deadline of the next tick
+        self.ticks = 0  # ticks run so far
+        self.skipped = 0  # ticks dropped because we were too far behind
+        self.last = None  # time the last tick ran
+        self.jitter_mean = 0.0  # running mean of the lateness of a tick
+        self.jitter_m2 = 0.0  # running sum of squares for the variance
+        self.jitter_max = 0.0
+
+    def start(self):
+        ''' the first tick is due right away '''
+        self.start_time = time.perf_counter()
+        self.next = self.start_time
+
+    ########################################
+    # secs until the next tick is due (0 if it already is)
+    #
+    # Also drops the ticks we can no longer catch up on.
+    ########################################
+    def delay(self):
+        now = time.perf_counter()
+        late = now - self.next
+        if late > self.burst * self.period:
+            missed = int(late / self.period) - self.burst
+            if missed > 0:
+                self.next += missed * self.period
+                self.skipped += missed
+        return max(0.0, self.next - now)
+
+    ########################################
+    # block until the next deadline and account for the tick
+    ########################################
+    def wait(self):
+        delay = self.delay()
+        if delay > self.spin:
+            time.sleep(delay - self.spin)
+        while time.perf_counter() < self.next:
+            pass
+        self.tick()
+
+    ########################################
+    # account for a tick that runs now
+    ########################################
+    def tick(self):
+        now = time.perf_counter()
+        lateness = now - self.next
+        self.ticks += 1
+        # Welford's running mean and variance of the lateness
+        diff = lateness - self.jitter_mean
+        self.jitter_mean += diff / self.ticks
+        self.jitter_m2 += diff * (lateness - self.jitter_mean)
+        self.jitter_max = max(self.jitter_max, lateness)
+        self.last = now
+        self.next += self.period
+
+    ########################################
+    # requested versus achieved rate and per tick jitter (in secs)
+    ########################################
+    def stats(self):
+        elapsed = (self.last - self.start_time) if self.ticks > 1 else 0.0
+        achieved = (self.ticks - 1) / elapsed if elapsed > 0 else 0.0
+        stddev = math.sqrt(self.jitter_m2 / self.ticks) if self.ticks else 0.0
+        return {"requested_rate": self.rate, "achieved_rate": achieved,
+                "ticks": self.ticks, "skipped": self.skipped,
+                "jitter_mean": self.jitter_mean, "jitter_stddev": stddev,
+                "jitter_max": self.jitter_max}
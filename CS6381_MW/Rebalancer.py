@@ -0,0 +1,73 @@
+###############################################
+#
+# Purpose: Decide which topics to migrate between broker groups when their
+# load skews
+#
+###############################################
+
+# The hash ring (see HashRing.py) spreads topics evenly by count, but the rates
+# of the topics are only known once traffic flows. Brokers report per topic
+# rates to /brokers/load/<g>; the discovery leader feeds them to plan() and
+# migrates what it returns.
+#
+# The plan moves as few topics as it can: while the busiest group is more than
+# threshold times the mean load, move the topic of the busiest group that
+# brings it closest to the least busy one without overshooting it. Topics with
+# no reported rate weigh nothing and stay where they are.
+
+class Rebalancer():
+    ########################################
+    # constructor
+    #
+    # threshold: max load of the busiest group relative to the mean
+    # max_moves: max topics migrated per decision
+    ########################################
+    def __init__(self, threshold=1.5, max_moves=2):
+        if threshold < 1:
+            raise ValueError("Rebalancer: threshold must be at least 1")
+        self.threshold = threshold
+        self.max_moves = max_moves
+
+    ########################################
+    # load of every group and the busiest load relative to the mean
+    ########################################
+    @staticmethod
+    def loads(assignment, rates):
+        return {group: sum(rates.get(topic, 0.0) for topic in topics)
+                for group, topics in assignment.items()}
+
+    @staticmethod
+    def imbalance(loads):
+        if not loads:
+            return 1.0
+        mean = sum(loads.values()) / len(loads)
+        return max(loads.values()) / mean if mean > 0 else 1.0
+
+    ########################################
+    # topics to migrate
+    #
+    # assignment: group -> topics
+    # rates:      topic -> load (e.g. messages per sec)
+    #
+    # returns a list of (topic, from group, to group), empty if the load is
+    # within the threshold or no move would help
+    ########################################
+    def plan(self, assignment, rates):
+        assignment = {group: list(topics) for group, topics in assignment.items()}
+        loads = self.loads(assignment, rates)
+        moves = []
+        while len(moves) < self.max_moves and self.imbalance(loads) > self.threshold:
+            hot = max(loads, key=lambda g: (loads[g], str(g)))
+            cold = min(loads, key=lambda g: (loads[g], str(g)))
+            gap = loads[hot] - loads[cold]
+            # moving more than the gap would just make cold the new hot group
+            candidates = [topic for topic in assignment[hot] if 0 < rates.get(topic, 0.0) < gap]
+            if not candidates:
+                break
+            topic = min(candidates, key=lambda t: (abs(gap / 2 - rates[t]), t))
+            assignment[hot].remove(topic)
+            assignment[cold].append(topic)
+            loads[hot] -= rates[topic]
+            loads[cold] += rates[topic]
+            moves.append((topic, hot, cold))
+        return moves
@@ -0,0 +1,164 @@
+###############################################
+#
+# Purpose: Per topic cache of the latest history window a broker forwarded,
+# served to subscribers that join late or come back after a failover
+#
+###############################################
+
+# A subscriber that just connected has nothing until the next publication of
+# each topic, and in delta mode nothing usable until the next full window
+# (every resync samples). The broker has seen all of it go by, so it keeps
+# per topic the last full window and the delta frames that followed it, as
+# the raw [header, payload] frames. Nothing is parsed on the forwarding
+# path except batches, which have to be split by topic.
+#
+# A snapshot is these frames replayed in order. The subscriber feeds them to
+# its normal receive path: the full window sets up its history and the deltas
+# bring it up to date, so its first sample is valid right away.
+#
+# Publishers send a full window only every resync samples (10 * h_size by
+# default), so the deltas in between can be many. Once a topic has more than
+# max_frames of them, we compact it: the deltas are applied to the full window
+# and the result replaces them all as a single full frame, as the publisher
+# would have sent it with the last delta. The frames are parsed only then,
+# once per max_frames deltas. We do not know the publisher's h_size. Its
+# first full windows are short while its history fills up, so until two full
+# windows in a row have the same length we keep every sample; that is at most
+# resync of them, as each full window starts the topic over. After that the
+# compacted window keeps as many samples as the full windows have;
+# subscribers cut it to their own h_size.
+#
+# The cache is filled by the event loop (python forwarding) or by the capture
+# threads of the proxies, and served by the event loop, hence the lock.
+
+import threading  # for the lock
+
+from CS6381_MW import discovery_pb2
+from CS6381_MW.Common import BATCH_TOPIC, FLAG_FULL, FLAG_DELTA, PAYLOAD_TYPECODE
+from CS6381_MW.Common import pack_header, unpack_header, payload_count, payload_values, raw_series
+from CS6381_MW.HistoryBuffer import HistoryBuffer
+
+# first frame of a snapshot reply; the cached frames follow as [topic, header, payload] triples
+SNAPSHOT_MARKER = b"SNAP"
+
+
+class SnapshotCache():
+    ########################################
+    # constructor
+    #
+    # max_frames: max delta frames kept after a full window. A topic going
+    # past it is compacted into a single full window.
+    ########################################
+    def __init__(self, max_frames=1024):
+        self.max_frames = max_frames
+        self.lock = threading.Lock()
+        self.batch_topic = bytes(BATCH_TOPIC, "utf-8")
+        self.frames = {}  # topic frame -> [(header, payload)], a full window first
+        self.full = {}  # topic frame -> samples in the last full window its publisher sent
+        self.window = {}  # topic frame -> samples to keep when compacting, None while they grow
+        self.requests = 0  # snapshots served
+        self.served = 0  # frames served in them
+        self.compactions = 0  # times a topic went past max_frames and was compacted
+        self.failed = 0  # topics dropped because their frames could not be compacted
+
+    ########################################
+    # keep a forwarded message
+    ########################################
+    def update(self, topic, header, payload):
+        count, seq, flags = unpack_header(header)
+        with self.lock:
+            if flags & FLAG_FULL:
+                self.window[topic] = count if self.full.get(topic) == count else None
+                self.full[topic] = count
+                self.frames[topic] = [(header, payload)]
+                return
+            frames = self.frames.get(topic)
+            if frames is None:
+                return  # deltas are of no use without the window they apply to
+            frames.append((header, payload))
+            if len(frames) > self.max_frames:
+                try:
+                    self.frames[topic] = [self.compact(frames, self.window.get(topic))]
+                    self.compactions += 1
+                except Exception:
+                    # a frame we cannot parse; wait for the next full window
+                    del self.frames[topic]
+                    self.failed += 1
+
+    ########################################
+    # apply the deltas to the full window they follow
+    #
+    # returns the (header, payload) of a full window holding the newest
+    # samples (at most size, all of them if size is None), with the sequence
+    # number and timestamp of the last delta
+    ########################################
+    def compact(self, frames, size):
+        full = discovery_pb2.Publication()
+        full.ParseFromString(frames[0][1])
+        kind = full.WhichOneof("payload")
+        values = payload_values(full)
+        if size is None:
+            size = len(values) + len(frames) - 1
+        window = HistoryBuffer(size, None if kind is None else PAYLOAD_TYPECODE[kind])
+        window.extend(reversed(values[:size]))
+        delta = discovery_pb2.Publication()
+        for header, payload in frames[1:]:
+            delta.ParseFromString(payload)
+            window.append(payload_values(delta)[0])
+        full.seq, full.timestamp = delta.seq, delta.timestamp
+        if kind is None:
+            del full.data[:]
+            full.data.extend(window.view())
+        else:
+            series = getattr(full, kind)
+            series.Clear()
+            series.raw = raw_series(window.view())
+        count, seq, flags = unpack_header(frames[0][0])
+        return pack_header(len(window), full.seq, flags), full.SerializeToString()
+
+    def add_publication(self, pub):
+        ''' keep a publication taken out of a batch, as a frame of its own '''
+        flags = FLAG_FULL if pub.full else FLAG_DELTA
+        self.update(bytes(pub.topic, "utf-8"), pack_header(payload_count(pub), pub.seq, flags),
+                    pub.SerializeToString())
+
+    def observe(self, frames):
+        ''' keep a message seen on a proxy's capture socket '''
+        if len(frames) != 3:
+            return
+        if frames[0] == self.batch_topic:
+            batch = discovery_pb2.PublicationBatch()
+            batch.ParseFromString(frames[2])
+            for pub in batch.pubs:
+                self.add_publication(pub)
+        else:
+            self.update(frames[0], frames[1], frames[2])
+
+    ########################################
+    # the cached frames of some topics, flattened into
+    # [topic, header, payload, topic, header, payload, ...]
+    ########################################
+    def snapshot(self, topics):
+        reply = []
+        with self.lock:
+            for topic in topics:
+                for header, payload in self.frames.get(topic, ()):
+                    reply.extend((topic, header, payload))
+            self.requests += 1
+            self.served += len(reply) // 3
+        return reply
+
+    def forget(self, topics):
+        ''' drop the topics that are no longer ours '''
+        with self.lock:
+            for topic in topics:
+                self.frames.pop(topic, None)
+                self.full.pop(topic, None)
+                self.window.pop(topic, None)
+
+    def stats(self):
+        ''' counters of the cache '''
+        with self.lock:
+            return {"topics": len(self.frames), "frames": sum(len(f) for f in self.frames.values()),
+                    "requests": self.requests, "served": self.served,
+                    "compactions": self.compactions, "failed": self.failed}
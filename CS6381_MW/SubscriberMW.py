@@ -42,8 +42,9 @@ import logging  # for logging. Use it in place of print statements.
 import zmq  # ZMQ sockets
 import timeit  # for latency measurement
 import signal  # for signal handling
-import csv  # for csv file writing
 import json
+import queue  # to hand frames from the receive thread to the decode workers
+import threading  # for the receive and decode threads
 
 from kazoo.client import KazooClient
 from kazoo.exceptions import NodeExistsError, NoNodeError
@@ -51,6 +52,12 @@ from kazoo.recipe.election import Election
 from kazoo.recipe.watchers import DataWatch
 # import serialization logic
 from CS6381_MW import discovery_pb2
+from CS6381_MW.HistoryBuffer import HistoryBuffer
+from CS6381_MW.LatencyRecorder import LatencyRecorder
+from CS6381_MW.Histogram import Histogram
+from CS6381_MW.Common import BATCH_TOPIC, PAYLOAD_STRING, PAYLOAD_TYPECODE, payload_values
+from CS6381_MW.Common import FLAG_DELTA, unpack_header
+from CS6381_MW.SnapshotCache import SNAPSHOT_MARKER
 
 
 class SubscriberMW():
@@ -68,29 +75,101 @@ class SubscriberMW():
         # self.start_time = None
         # self.reset_time = None
         self.filename = None
+        self.recorder = None  # buffers the latencies and writes them out in the background
+        self.start_time = None
+        self.histograms = {}  # (topic, pub_id) -> latency histogram in usecs
+        self.report_interval = 0  # secs between percentile reports, 0 = only at exit
+        self.last_report = None
+        self.hist_file = None  # where the histograms are dumped at exit
         self.zk = None
         self.discovery = None
+        self.endpoints = set()  # endpoints the SUB socket is connected to
+        self.pub_cache = {}  # /publisher child -> its decoded znode data
+        self.broker_cache = {}  # broker group -> decoded data of its leader znode
+        self.watched_groups = set()  # broker groups whose leader we watch
+        # snapshots of the brokers' caches, fetched when we (re)connect to a broker
+        self.context = None
+        self.snap = None  # PULL socket the fetch threads hand the snapshots to
+        self.snap_addr = "inproc://snapshot-{:x}".format(id(self))
+        self.snapshot_timeout = 1000  # msecs we wait for a broker's snapshot
+        # replayed: cached publications consumed, which record no latency
+        self.snapshot_stats = {"requests": 0, "replies": 0, "frames": 0, "timeouts": 0, "replayed": 0}
+        self.join_time = None  # when we (re)connected to a broker and have no valid sample yet
+        self.first_sample = []  # secs from (re)connecting to the first valid sample
+        # failover gap: the time a topic goes without a valid sample when its broker is lost
+        self.last_sample = {}  # topic -> time of its latest valid sample
+        self.outage = {}  # topic -> its last valid sample before its broker was lost
+        self.outage_gaps = {}  # topic -> secs without a valid sample, for the current outage
+        self.failover_gaps = []  # longest gap of every failover
+        # content filters (see ContentFilter.py): with brokers applying them the
+        # matches of a filtered topic come on the filters' channels instead of the topic
+        self.filters = {}  # topic -> [ContentFilter]
+        self.via_channels = set()  # filtered topics we currently get on channels only
+        self.channels_raw = set()  # topic frames of the channels of our filters
+        self.last_match = {}  # topic -> (pub_id, seq) of its latest match
+        self.unmatched = 0  # publications of filtered topics that matched none of our filters
 
         self.dissemination_method = None
         self.h_size = 0
+        self.name = None
+        self.windows = {}  # topic -> state of the history window rebuilt from delta frames
+        self.resync_requested = {}  # topic -> time we last asked for a full window
+        self.gaps = 0  # number of sequence gaps seen in delta frames
+        self.topics = None  # set of topics we are interested in
+        self.topics_raw = None  # the same as topic frames, for the exact match before parsing
+        self.rejected = {"topic": 0, "short": 0, "duplicate": 0}  # messages dropped before parsing, by reason
+        self.last_header = {}  # topic frame -> header frame of the last message we accepted
+        self.batch_topic = bytes(BATCH_TOPIC, "utf-8")
+        self.copy = True  # False to receive zmq.Frames instead of copies
+        self.lock = threading.Lock()  # guards the recorder and histograms shared by decode workers
+        # receive/decode pipeline, only used with decode workers
+        self.workers = 0  # number of decode workers, 0 = decode inline in the event loop
+        self.queue_size = 0  # max frames waiting in a worker queue before the receive thread stalls
+        self.queues = []  # one queue of frames/publications per worker
+        self.shards = {}  # topic -> index of the worker owning it
+        self.shards_raw = {}  # same, keyed by the topic frame
+        self.threads = []  # receive thread followed by the workers
+        self.stopping = threading.Event()
+        self.endpoint_ops = queue.SimpleQueue()  # (SUB socket method, arg) the thread owning the socket must apply
+        self.idle_timeout = 100  # msecs to poll for when the appln has no timer running
+        self.received = 0  # frames taken off the SUB socket by the receive thread
+        self.stalls = 0  # times the receive thread waited on a full queue
+        self.max_depth = []  # max depth seen per worker queue
+        self.processed = []  # items handled per worker
+        self.next_batch = 0  # worker the next batch frame goes to
     # configure/initialize
 
-    def configure(self, args, dissemination_method, topiclist):
+    def configure(self, args, dissemination_method, topiclist, zero_copy=False, recorder_format="csv",
+                  report_interval=0, workers=0, queue_size=10000, filters=()):
         try:
 
             self.logger.debug("SubscriberMW: configure")
             self.filename = args.filename
+            # with "none" only the histograms are kept, so memory and disk use stay constant
+            if recorder_format != "none":
+                self.logger.debug("SubscriberMW::configure: starting the {} latency recorder".format(recorder_format))
+                self.recorder = LatencyRecorder(self.filename, recorder_format)
+                self.recorder.start()
+            self.report_interval = report_interval
+            self.last_report = time.monotonic()
+            self.hist_file = os.path.splitext(self.filename)[0] + "_hist.json"
             self.h_size = args.h_size
+            self.name = args.name
+            # with zero copy we parse straight out of the ZMQ frame buffers
+            self.copy = not zero_copy
             self.dissemination_method = dissemination_method
             # # First retrieve our advertised IP addr and the subscriber port num
             # self.port = args.port
             # self.addr = args.addr
-            self.logger.debug("SubscriberMW::configure: creating ZK client")
-            self.zk = KazooClient(hosts=args.zookeeper)
+            # the asyncio flavor hands us a client it already connected
+            if self.zk is None:
+                self.logger.debug("SubscriberMW::configure: creating ZK client")
+                self.zk = KazooClient(hosts=args.zookeeper)
 
             # Next get the ZMQ context
             self.logger.debug("SubscriberMW: configure: obtain ZMQ context")
             context = zmq.Context()  # returns a singleton object
+            self.context = context
             # get the ZMQ poller object
             self.logger.debug("SubscriberMW: configure: obtain ZMQ poller")
             self.poller = zmq.Poller()
@@ -105,24 +184,59 @@ class SubscriberMW():
             # get the ZMQ poller object
             self.logger.debug("SubscriberMW: configure: obtain ZMQ poller")
             self.poller.register(self.req, zmq.POLLIN)
-            self.poller.register(self.sub, zmq.POLLIN)
-
+            # with decode workers the SUB socket belongs to the receive thread
+            self.workers = workers
+            if not self.workers:
+                self.poller.register(self.sub, zmq.POLLIN)
+            # snapshots fetched by other threads reach the event loop through here
+            self.snap = context.socket(zmq.PULL)
+            self.snap.bind(self.snap_addr)
+            self.poller.register(self.snap, zmq.POLLIN)
+
+            self.topics = set(topiclist)
+            for content_filter in filters:
+                self.filters.setdefault(content_filter.topic, []).append(content_filter)
+                self.channels_raw.add(content_filter.channel_raw)
+            self.topics_raw = {bytes(topic, "utf-8") for topic in topiclist}
+            # filtered topics too, until the brokers tell us they apply our filters
+            # (see update_channels)
             for topic in topiclist:
                 self.logger.debug("SubscriberMW: configure: subscribe to topic {}".format(topic))
                 self.sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+            # batches mix topics, so we take them all and filter the contents ourselves
+            self.sub.setsockopt_string(zmq.SUBSCRIBE, BATCH_TOPIC)
             # Now connect ourselves to the discovery service. Recall that the IP/port were
             # supplied in our argument parsing.
             self.logger.debug(
                 "SubscriberMW: configure: connect to discovery service")
             self.zk.start()
+            if filters:
+                self.register_filters()
 
             self.set_req()
 
+            if self.workers:
+                self.start_pipeline(topiclist, queue_size)
+
             self.logger.info("SubscriberMW::configure completed")
 
         except Exception as e:
             raise e
 
+    def register_filters(self):
+        '''publish our content filters to the brokers'''
+        try:
+            specs = [content_filter.spec for topic in sorted(self.filters) for content_filter in self.filters[topic]]
+            data = json.dumps(specs).encode("utf-8")
+            path = "/filters/" + self.name
+            self.logger.info("SubscriberMW::register_filters: {}".format(specs))
+            try:
+                self.zk.create(path, value=data, ephemeral=True, makepath=True)
+            except NodeExistsError:
+                self.zk.set(path, data)
+        except Exception as e:
+            raise e
+
     def set_req(self):
         try:
             while (self.zk.exists("/leader") == None):
@@ -147,35 +261,154 @@ class SubscriberMW():
 
             return
 
-        @self.zk.DataWatch("/broker")
-        def watch_broker(data, stat):
-            self.logger.info("SubscriberMW::watch_broker: broker node changed - {} and {}".format(self.dissemination_method, data))
-            if self.dissemination_method == "Broker" and data is not None:
-                meta = json.loads(self.zk.get("/broker")[0].decode('utf-8'))
-                self.logger.info("SubscriberMW::watch_broker: broker changed, re-subscribing to {}".format(meta["id"]))
-                self.subscribe([meta])
+        if self.dissemination_method == "Broker":
+            # every broker group has a leader forwarding its share of the topics. We
+            # connect to all of them and our subscriptions decide what we get, so a
+            # topic migrating between groups needs nothing from us.
+            self.zk.ensure_path("/brokers/group")
+
+            @self.zk.ChildrenWatch("/brokers/group")
+            def watch_groups(children):
+                for group in set(children) - self.watched_groups:
+                    self.watched_groups.add(group)
+                    self.watch_broker(group)
         if self.dissemination_method == "Direct":
             @self.zk.ChildrenWatch("/publisher")
             def watch_pubs(children):
-                # self.set_req()
-                    self.logger.info(
-                    "SubscriberMW::watch_pubs: publishers changed, re-subscribing")
-                    publishers = []
-                    for child in children:
-                        path = "/publisher/" + child
-                        data, _ = self.zk.get(path)
-                        publishers.append(json.loads(data.decode("utf-8")))
-                    self.logger.info("DiscoveryMW::watch_pubs: {}".format(publishers))
-                    self.upcall_obj.update_publishers_info(publishers)
+                # only the znodes of new publishers are read, the others come from our cache
+                children = set(children)
+                for child in set(self.pub_cache) - children:
+                    del self.pub_cache[child]
+                for child in children - set(self.pub_cache):
+                    try:
+                        data, _ = self.zk.get("/publisher/" + child)
+                    except NoNodeError:
+                        continue  # gone again before we got to it
+                    self.pub_cache[child] = json.loads(data.decode("utf-8"))
+                self.logger.info(
+                    "SubscriberMW::watch_pubs: publishers changed, {} known".format(len(self.pub_cache)))
+                self.upcall_obj.update_publishers_info(list(self.pub_cache.values()))
+
+    def watch_broker(self, group):
+        @self.zk.DataWatch("/brokers/group/{}/leader".format(group))
+        def watch_leader(data, stat):
+            if data is None:
+                if self.broker_cache.pop(group, None) is None:
+                    return
+                self.logger.info("SubscriberMW::watch_broker: group {} lost its broker".format(group))
+                self.start_failover(group)
+            else:
+                meta = json.loads(data.decode("utf-8"))
+                if self.broker_cache.get(group) == meta:
+                    return
+                self.broker_cache[group] = meta
+                self.logger.info("SubscriberMW::watch_broker: group {} served by {}".format(group, meta["id"]))
+                if self.join_time is None:
+                    self.join_time = time.monotonic()
+            # a broker with several forwarding workers serves on several ports
+            self.subscribe([dict(meta, port=port) for meta in self.broker_cache.values()
+                            for port in meta.get("ports", [meta["port"]])])
+            self.update_channels()
+            if data is not None and meta.get("snapshot"):
+                threading.Thread(target=self.fetch_snapshot, args=(meta,),
+                                 name="SubscriberMW-snapshot", daemon=True).start()
+
+    ########################################
+    # measure a failover
+    #
+    # From the loss of a group's broker we wait for the next live valid sample
+    # (not one replayed from a snapshot) of each of our topics the group
+    # serves. The gap of a topic runs from its last live sample before the
+    # loss, so it covers the detection of the loss, the takeover and the
+    # resubscription as the application sees them.
+    ########################################
+    def start_failover(self, group):
+        try:
+            data, _ = self.zk.get("/brokers/group/{}".format(group))
+            topics = set(json.loads(data.decode("utf-8"))["topics"])
+        except NoNodeError:
+            topics = set(self.topics)
+        with self.lock:
+            self.end_failover()
+            self.outage = {topic: self.last_sample[topic] for topic in topics if topic in self.last_sample}
+            self.outage_gaps = {}
+
+    def end_failover(self):
+        '''report the current outage; called with the lock held'''
+        if not self.outage and not self.outage_gaps:
+            return
+        if self.outage:
+            self.logger.warning("SubscriberMW::end_failover: no valid sample since the failover for {}".format(
+                sorted(self.outage)))
+        if self.outage_gaps:
+            gap = max(self.outage_gaps.values())
+            self.failover_gaps.append(gap)
+            self.logger.info("SubscriberMW::end_failover: failover gap {:.3f} secs, per topic {}".format(
+                gap, {topic: round(secs, 3) for topic, secs in sorted(self.outage_gaps.items())}))
+        self.outage = {}
+        self.outage_gaps = {}
+
+    ########################################
+    # fetch the cached history of our topics from a broker
+    #
+    # Runs in a thread of its own so that a slow or dead broker holds up
+    # nobody. The reply is handed over to the event loop through our PULL
+    # socket and goes through the normal receive path there.
+    ########################################
+    def fetch_snapshot(self, meta):
+        addr = "tcp://{}:{}".format(meta["addr"], meta["snapshot"])
+        req = self.context.socket(zmq.REQ)
+        push = self.context.socket(zmq.PUSH)
+        try:
+            req.connect(addr)
+            push.connect(self.snap_addr)
+            self.snapshot_stats["requests"] += 1
+            # a snapshot holds windows, not the matches of our filters
+            req.send_multipart([bytes(topic, "utf-8") for topic in sorted(self.topics - self.via_channels)])
+            if req.poll(timeout=self.snapshot_timeout):
+                push.send_multipart(req.recv_multipart())
+            else:
+                self.snapshot_stats["timeouts"] += 1
+                self.logger.warning("SubscriberMW::fetch_snapshot: no snapshot from {}".format(addr))
+        except Exception as e:
+            self.logger.error("SubscriberMW::fetch_snapshot: {} - {}".format(addr, e))
+        finally:
+            req.close(linger=0)
+            push.close()
+
+    def recv_snapshot(self):
+        '''replay a snapshot through the receive path'''
+        try:
+            frames = self.snap.recv_multipart()
+            if frames[0] != SNAPSHOT_MARKER:
+                return None
+            self.snapshot_stats["replies"] += 1
+            self.snapshot_stats["frames"] += (len(frames) - 1) // 3
+            for i in range(1, len(frames) - 2, 3):
+                topic, header, payload = frames[i:i + 3]
+                if not self.accept(topic, header):
+                    continue
+                if self.workers:
+                    self.queues[self.shards_raw.get(topic, 0)].put((topic, payload, True))
+                else:
+                    self.decode(topic, payload, replay=True)
+            return None
+        except Exception as e:
+            raise e
 
     def event_loop(self, timeout=None):
         try:
             self.logger.debug("SubscriberMW: event_loop - run the event loop")
             while self.handle_events:
+                # apply what the ZK watch callbacks handed over to us
+                self.run_deferred()
 
-                events = dict(self.poller.poll(timeout=(timeout)))
+                # without an appln timer we still wake up now and then for that
+                events = dict(self.poller.poll(timeout=(self.idle_timeout if timeout is None else timeout)))
                 # check if a timeout occurred.
                 if not events:
+                    if timeout is None:
+                        continue  # just an idle wakeup
                     # make an upcall ot the generic "invoke_operations"
                     timeout = self.upcall_obj.invoke_operation()
                 elif self.req in events:
@@ -183,6 +416,8 @@ class SubscriberMW():
                     timeout = self.handle_reply()
                 elif self.sub in events:
                     timeout = self.recv_data()  # handle the data
+                elif self.snap in events:
+                    timeout = self.recv_snapshot()
                 else:
                     raise Exception("Unknown event after poll")
             self.logger.info("SubscriberMW: event_loop: out of the event loop")
@@ -225,44 +460,394 @@ class SubscriberMW():
 
     
 
+    ########################################
+    # make the SUB socket connected to exactly the given publishers
+    #
+    # publist is the complete set we should be receiving from. We only connect
+    # to the endpoints we are not connected to yet and disconnect from the ones
+    # that are gone, so membership churn costs O(changes).
+    ########################################
     def subscribe(self, publist):
         try:
-            with open(self.filename, "w", newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow(["Time", "Latency"])
-
             self.logger.debug("SubscriberMW::subscribe")
-            self.start_time = timeit.default_timer()
-            self.logger.info("SubscriberMW::subscribe: {}".format(publist))
-            for pub in publist:
-                addr = "tcp://" + pub["addr"] + ":" + str(pub["port"])
+            # keep one time base for the whole run so recorded data survives membership changes
+            if self.start_time is None:
+                self.start_time = timeit.default_timer()
+            wanted = {"tcp://" + pub["addr"] + ":" + str(pub["port"]) for pub in publist}
+            for addr in wanted - self.endpoints:
                 self.logger.info("SubscriberMW::subscribe: connecting to {}".format(addr))
-                self.sub.connect(addr)
+                self.apply_endpoint(True, addr)
+            for addr in self.endpoints - wanted:
+                self.logger.info("SubscriberMW::subscribe: disconnecting from {}".format(addr))
+                self.apply_endpoint(False, addr)
+            self.endpoints = wanted
 
         except Exception as e:
             raise e
 
+    def apply_endpoint(self, connect, addr):
+        '''connect to or disconnect from an endpoint'''
+        self.apply_sub_op(self.sub.connect if connect else self.sub.disconnect, addr)
+
+    ########################################
+    # apply a method of the SUB socket
+    #
+    # We get here from ZK watch callbacks in kazoo's thread, and ZMQ sockets
+    # must not be used by two threads at once. So the call is queued for the
+    # thread polling the socket: the receive thread with decode workers,
+    # otherwise the event loop (see run_deferred).
+    ########################################
+    def apply_sub_op(self, func, arg):
+        self.endpoint_ops.put((func, arg))
+
+    def run_deferred(self):
+        '''apply the queued SUB socket calls in the event loop thread'''
+        if self.workers:
+            return
+        while not self.endpoint_ops.empty():
+            func, arg = self.endpoint_ops.get()
+            func(arg)
+
+    ########################################
+    # where the matches of our filtered topics come from
+    #
+    # Only brokers forwarding in python apply content filters, and they say
+    # so in their leader node. While every broker we know of does, we take
+    # our filtered topics on the filters' channels. Otherwise we take the
+    # plain topics and test them ourselves (see match).
+    ########################################
+    def update_channels(self):
+        if not self.filters or not self.broker_cache:
+            return
+        filtering = all(meta.get("filters") for meta in self.broker_cache.values())
+        wanted = set(self.filters) if filtering else set()
+        if wanted == self.via_channels:
+            return
+        self.logger.info("SubscriberMW::update_channels: filtered topics on channels = {}".format(sorted(wanted)))
+        # subscribe before unsubscribing; match() drops the duplicates in between
+        for topic in wanted - self.via_channels:
+            for content_filter in self.filters[topic]:
+                self.apply_sub_op(self.sub.subscribe, content_filter.channel)
+            self.apply_sub_op(self.sub.unsubscribe, topic)
+        for topic in self.via_channels - wanted:
+            self.apply_sub_op(self.sub.subscribe, topic)
+            for content_filter in self.filters[topic]:
+                self.apply_sub_op(self.sub.unsubscribe, content_filter.channel)
+        self.via_channels = wanted
+
     def recv_data(self):
         try:
-            data = self.sub.recv_multipart()
+            topic, header, payload = self.recv_frames()
+            if self.accept(topic, header):
+                self.decode(topic, payload)
+        except Exception as e:
+            raise e
+
+    def recv_frames(self):
+        '''receive one message and return its topic frame, header frame and payload'''
+        data = self.sub.recv_multipart(copy=self.copy)
+        if self.copy:
+            return data[0], data[1], data[2]
+        return data[0].bytes, data[1].bytes, data[2].buffer
+
+    ########################################
+    # decide on a message from its topic and header frames alone
+    #
+    # ZMQ subscriptions are prefix matches ("temp" also gets "temperature"),
+    # so the topic must match exactly. A full window shorter than our history
+    # size is of no use to us unless the publisher runs in delta mode, where
+    # it seeds the window that the following deltas extend.
+    #
+    # A message with the same header (sequence number included) as the last
+    # one we accepted on its topic is a duplicate, typically a snapshot frame
+    # we also got live or the other way round. The header does not name the
+    # publisher, so only such an exact repeat is dropped here; update_window
+    # deals with reordered frames once it knows who sent them.
+    ########################################
+    def accept(self, topic, header):
+        if topic == self.batch_topic or topic in self.channels_raw:
+            return True
+        if topic not in self.topics_raw:
+            self.rejected["topic"] += 1
+            return False
+        count, seq, flags = unpack_header(header)
+        if count < self.h_size and not flags & FLAG_DELTA:
+            self.rejected["short"] += 1
+            return False
+        if seq and self.last_header.get(topic) == header:
+            self.rejected["duplicate"] += 1
+            return False
+        self.last_header[topic] = header
+        return True
+
+    ########################################
+    # parse a received payload and hand over its publications
+    ########################################
+    def decode(self, topic, payload, replay=False):
+        if topic == self.batch_topic:
+            batch = discovery_pb2.PublicationBatch()
+            batch.ParseFromString(payload)
+            for message in batch.pubs:
+                # the broker sends the matches of filtered topics on their channels
+                if message.topic in self.topics and message.topic not in self.via_channels:
+                    self.dispatch(message, replay)
+        else:
             message = discovery_pb2.Publication()
-            message.ParseFromString(data[1])
+            message.ParseFromString(payload)
+            self.consume(message, replay)
+
+    def dispatch(self, message, replay=False):
+        '''consume a publication taken out of a batch, on the worker owning its topic'''
+        if self.workers:
+            self.queues[self.shards.get(message.topic, 0)].put((message, replay))
+        else:
+            self.consume(message, replay)
+
+    ########################################
+    # receive/decode pipeline
+    #
+    # A receive thread only drains the SUB socket and queues the raw frames.
+    # Decode workers parse them and consume the publications. Every topic is
+    # owned by one worker, so the history windows and histograms of a topic are
+    # only ever touched by one thread. Batch frames mix topics; they are spread
+    # over the workers round robin and the worker that parses one forwards each
+    # publication to the worker owning its topic.
+    #
+    # The queues themselves are unbounded so that forwarding never blocks a
+    # worker. Instead, the receive thread stops draining when the queue it
+    # feeds holds queue_size items. The backlog then builds up in ZMQ, just
+    # like it does without workers.
+    ########################################
+    def start_pipeline(self, topiclist, queue_size):
+        self.logger.info("SubscriberMW::start_pipeline: {} decode workers".format(self.workers))
+        self.queue_size = queue_size
+        self.queues = [queue.Queue() for _ in range(self.workers)]
+        self.max_depth = [0] * self.workers
+        self.processed = [0] * self.workers
+        for index, topic in enumerate(sorted(topiclist)):
+            self.shards[topic] = index % self.workers
+            self.shards_raw[bytes(topic, "utf-8")] = index % self.workers
+            for content_filter in self.filters.get(topic, ()):
+                self.shards_raw[content_filter.channel_raw] = index % self.workers
+        self.threads = [threading.Thread(target=self.receiver, name="SubscriberMW-recv", daemon=True)]
+        self.threads.extend(threading.Thread(target=self.worker, args=(index,),
+                                             name="SubscriberMW-decode-{}".format(index), daemon=True)
+                            for index in range(self.workers))
+        for thread in self.threads:
+            thread.start()
+
+    def receiver(self):
+        '''body of the receive thread'''
+        poller = zmq.Poller()
+        poller.register(self.sub, zmq.POLLIN)
+        while not self.stopping.is_set():
+            while not self.endpoint_ops.empty():
+                func, arg = self.endpoint_ops.get()
+                func(arg)
+            # wake up now and then to pick up new endpoints and to notice shutdown
+            if not poller.poll(timeout=100):
+                continue
+            topic, header, payload = self.recv_frames()
+            self.received += 1
+            if not self.accept(topic, header):
+                continue
+            if topic == self.batch_topic:
+                index = self.next_batch
+                self.next_batch = (index + 1) % self.workers
+            else:
+                index = self.shards_raw.get(topic, 0)
+            target = self.queues[index]
+            depth = target.qsize()
+            if depth >= self.queue_size:
+                self.stalls += 1
+                while target.qsize() >= self.queue_size and not self.stopping.is_set():
+                    time.sleep(0.0005)
+            target.put((topic, payload))
+            self.max_depth[index] = max(self.max_depth[index], depth + 1)
+
+    def worker(self, index):
+        '''body of a decode worker'''
+        source = self.queues[index]
+        while True:
+            item = source.get()
+            try:
+                if item is None:
+                    break
+                if isinstance(item[0], discovery_pb2.Publication):
+                    self.consume(*item)
+                else:
+                    self.decode(*item)
+                self.processed[index] += 1
+            except Exception as e:
+                self.logger.error("SubscriberMW::worker: decode worker {} - {}".format(index, e))
+            finally:
+                source.task_done()
+
+    def stop_pipeline(self):
+        '''stop receiving and let the workers finish what is queued'''
+        if not self.threads:
+            return
+        self.stopping.set()
+        self.threads[0].join()
+        # batches still being decoded may forward publications to any queue
+        while any(q.unfinished_tasks for q in self.queues):
+            time.sleep(0.01)
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads[1:]:
+            thread.join()
+        self.threads = []
+        self.report_pipeline()
+
+    def pipeline_stats(self):
+        '''queue depth and throughput counters of the pipeline'''
+        return {"received": self.received, "stalls": self.stalls,
+                "depth": [q.qsize() for q in self.queues],
+                "max_depth": list(self.max_depth), "processed": list(self.processed)}
+
+    def report_pipeline(self):
+        self.logger.info("SubscriberMW::report_pipeline: {}".format(self.pipeline_stats()))
+
+    ########################################
+    # handle one publication of a topic we subscribed to
+    #
+    # replay: the publication comes from a broker's snapshot, not live
+    ########################################
+    def consume(self, message, replay=False):
+        try:
             timestamp = message.timestamp
             topic = message.topic
-            data = message.data
-            if (len(data) >= self.h_size):
+            if topic in self.filters:
+                # a filtered topic delivers matching samples rather than windows
+                data = self.match(message)
+            else:
+                data = self.update_window(message)
+                if data is not None and len(data) < self.h_size:
+                    data = None
+            if data is not None:
                 data = data[:self.h_size]
                 recv_time = time.monotonic()
                 latency = recv_time - message.timestamp
-                data_point = ((recv_time - self.start_time), latency)
-                self.write_csv(self.filename, data_point)
+                with self.lock:
+                    if replay:
+                        # a cached publication from a snapshot is seconds old; it brings
+                        # the window up to date but says nothing about our latency
+                        self.snapshot_stats["replayed"] += 1
+                    else:
+                        if self.recorder is not None:
+                            self.recorder.record(recv_time - self.start_time, latency)
+                        self.record_latency(topic, message.pub_id, latency, recv_time)
+                        # an outage ends with live data, not with the stale samples of a snapshot
+                        self.last_sample[topic] = recv_time
+                        if topic in self.outage:
+                            self.outage_gaps[topic] = recv_time - self.outage.pop(topic)
+                            if not self.outage:
+                                self.end_failover()
+                    if self.join_time is not None:
+                        self.first_sample.append(recv_time - self.join_time)
+                        self.logger.info("SubscriberMW::consume: first valid sample {:.3f} secs after joining the broker".format(
+                            self.first_sample[-1]))
+                        self.join_time = None
                 self.logger.debug(
-                    "SubscriberMW::recv_data, value = {}: {}- {}".format(timestamp, topic, data))
+                    "SubscriberMW::recv_data, value = %s: %s- %s", timestamp, topic, data)
                 # print("Subscriber::recv_data, value = {}: {}- {}".format(timestamp, topic, data))
                 self.logger.debug("Time Received: {} \nTime Sent: {}\nLatency = {}".format(recv_time, message.timestamp , latency))
         except Exception as e:
             raise e
 
+    ########################################
+    # test a publication of a filtered topic against our filters
+    #
+    # A broker applying our filters already did, but without one (or on a
+    # batch) we get the whole topic. A publication matching several of our filters arrives
+    # on each of their channels; we take it once. Returns the newest sample
+    # or None.
+    ########################################
+    def match(self, message):
+        values = payload_values(message)
+        if not any(content_filter.matches(values) for content_filter in self.filters[message.topic]):
+            self.unmatched += 1
+            return None
+        key = (message.pub_id, message.seq)
+        if message.seq and self.last_match.get(message.topic) == key:
+            return None
+        self.last_match[message.topic] = key
+        return values[:1]
+
+    ########################################
+    # rebuild the history window of a topic
+    #
+    # Full frames carry the whole window and simply replace ours. Delta frames
+    # carry only the newest sample and must follow the previous sequence number
+    # of the same publisher; on a gap we drop them and ask for a full window.
+    # Returns the window (newest first, packed values for numeric and
+    # categorical topics) or None if nothing usable arrived.
+    ########################################
+    def update_window(self, message):
+        topic = message.topic
+        state = self.windows.get(topic)
+        if (state is not None and state["pub"] == message.pub_id and message.seq != 0
+                and message.seq <= state["seq"]):
+            # duplicate or reordered frame of a publisher we are in sync with
+            return None
+        if message.full:
+            # keep the frame itself; the ring is only built if deltas follow
+            self.windows[topic] = {"pub": message.pub_id, "seq": message.seq,
+                                   "frame": message, "hist": None}
+            return payload_values(message)
+        if (state is None or state["pub"] != message.pub_id
+                or message.seq != state["seq"] + 1):
+            self.request_resync(topic)
+            return None
+        if state["hist"] is None:
+            kind = state["frame"].WhichOneof("payload") or PAYLOAD_STRING
+            state["hist"] = HistoryBuffer(self.h_size, PAYLOAD_TYPECODE[kind])
+            state["hist"].extend(reversed(payload_values(state["frame"])[:self.h_size]))
+            state["frame"] = None
+        state["hist"].append(payload_values(message)[0])
+        state["seq"] = message.seq
+        return state["hist"].view()
+
+    ########################################
+    # keep the latency in the histogram of its topic and publisher
+    ########################################
+    def record_latency(self, topic, pub_id, latency, now):
+        hist = self.histograms.get((topic, pub_id))
+        if hist is None:
+            hist = self.histograms[(topic, pub_id)] = Histogram()
+        hist.record(latency * 1e6)
+        if self.report_interval and now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.report_percentiles()
+            if self.workers:
+                self.report_pipeline()
+
+    def report_percentiles(self):
+        '''log the latency percentiles (msecs) of every topic and publisher'''
+        for (topic, pub_id), hist in sorted(self.histograms.items()):
+            pct = hist.percentiles([50, 90, 99, 99.9])
+            self.logger.info(
+                "SubscriberMW::report_percentiles: {} from {}: n={} p50={:.3f} p90={:.3f} p99={:.3f} p99.9={:.3f} max={:.3f}".format(
+                    topic, pub_id, hist.total, pct[50] / 1e3, pct[90] / 1e3, pct[99] / 1e3, pct[99.9] / 1e3, hist.max / 1e3))
+
+    def dump_histograms(self):
+        '''write all the histograms to a compact json file'''
+        with open(self.hist_file, "w") as f:
+            json.dump([{"topic": topic, "pub_id": pub_id, "unit": "us", "hist": hist.dump()}
+                       for (topic, pub_id), hist in sorted(self.histograms.items())], f)
+        self.logger.info("SubscriberMW::dump_histograms: wrote {}".format(self.hist_file))
+
+    def request_resync(self, topic):
+        '''ask the publisher of a topic for a full window, at most once a second'''
+        now = time.monotonic()
+        if now - self.resync_requested.get(topic, float("-inf")) < 1.0:
+            return
+        self.resync_requested[topic] = now
+        self.gaps += 1
+        self.logger.info(
+            "SubscriberMW::request_resync: gap detected on {}, requesting full window".format(topic))
+        self.zk.set_async("/resync/{}".format(topic), self.name.encode("utf-8"))
+
     def set_upcall_handle(self, upcall_obj):
         '''set the upcall object'''
         try:
@@ -274,17 +859,27 @@ class SubscriberMW():
     def disable_event_loop(self):
         '''disable the event loop'''
         self.handle_events = False
-        # print("writing to file")
-
-        #     for x,y in self.latency:
-        #         writer.writerow([x,y])
-
-    def write_csv(self, file_name, data):
-        with open(file_name, "a", newline='') as f:
-            writer = csv.writer(f)
-            # print(data)
-            x, y = data
-            writer.writerow([x, y])
+        self.stop_pipeline()
+        self.logger.info("SubscriberMW::disable_event_loop: rejected before parsing = {}".format(self.rejected))
+        if self.filters:
+            self.logger.info("SubscriberMW::disable_event_loop: publications matching none of our filters = {}".format(
+                self.unmatched))
+        self.logger.info("SubscriberMW::disable_event_loop: snapshots = {}, secs to first valid sample = {}".format(
+            self.snapshot_stats, ["{:.3f}".format(secs) for secs in self.first_sample]))
+        with self.lock:
+            self.end_failover()
+        if self.failover_gaps:
+            self.logger.info("SubscriberMW::disable_event_loop: failover gaps (secs) = {}".format(
+                ["{:.3f}".format(secs) for secs in self.failover_gaps]))
+        # write out whatever latencies are still buffered
+        if self.recorder is not None:
+            self.recorder.close()
+            self.logger.info("SubscriberMW::disable_event_loop: recorder stats = {}".format(self.recorder.stats()))
+            self.recorder = None
+        if self.histograms:
+            self.report_percentiles()
+            self.dump_histograms()
+            self.histograms = {}
 
     # def interrupt_handler(self, signal, frame):
     #     print('Terminating... and printing to file')
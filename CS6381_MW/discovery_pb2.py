@@ -13,19 +13,25 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x19\x43S6381_MW/discovery.proto\"T\n\x0eRegistrantInfo\x12\n\n\x02id\x18\x01 \x01(\t\x12\x11\n\x04\x61\x64\x64r\x18\x02 \x01(\tH\x00\x88\x01\x01\x12\x11\n\x04port\x18\x03 \x01(\rH\x01\x88\x01\x01\x42\x07\n\x05_addrB\x07\n\x05_port\"T\n\x0bRegisterReq\x12\x13\n\x04role\x18\x01 \x01(\x0e\x32\x05.Role\x12\x1d\n\x04info\x18\x02 \x01(\x0b\x32\x0f.RegistrantInfo\x12\x11\n\ttopiclist\x18\x03 \x03(\t\"G\n\x0cRegisterResp\x12\x17\n\x06status\x18\x01 \x01(\x0e\x32\x07.Status\x12\x13\n\x06reason\x18\x02 \x01(\tH\x00\x88\x01\x01\x42\t\n\x07_reason\"\x0c\n\nIsReadyReq\"\x1d\n\x0bIsReadyResp\x12\x0e\n\x06status\x18\x01 \x01(\x08\"(\n\x13LookupPubByTopicReq\x12\x11\n\ttopiclist\x18\x01 \x03(\t\"8\n\x14LookupPubByTopicResp\x12 \n\x07publist\x18\x01 \x03(\x0b\x32\x0f.RegistrantInfo\"\xac\x01\n\x0c\x44iscoveryReq\x12\x1b\n\x08msg_type\x18\x01 \x01(\x0e\x32\t.MsgTypes\x12$\n\x0cregister_req\x18\x02 \x01(\x0b\x32\x0c.RegisterReqH\x00\x12\"\n\x0bisready_req\x18\x03 \x01(\x0b\x32\x0b.IsReadyReqH\x00\x12*\n\nlookup_req\x18\x04 \x01(\x0b\x32\x14.LookupPubByTopicReqH\x00\x42\t\n\x07\x43ontent\"\xb3\x01\n\rDiscoveryResp\x12\x1b\n\x08msg_type\x18\x01 \x01(\x0e\x32\t.MsgTypes\x12&\n\rregister_resp\x18\x02 \x01(\x0b\x32\r.RegisterRespH\x00\x12$\n\x0cisready_resp\x18\x03 \x01(\x0b\x32\x0c.IsReadyRespH\x00\x12,\n\x0blookup_resp\x18\x04 \x01(\x0b\x32\x15.LookupPubByTopicRespH\x00\x42\t\n\x07\x43ontent\"=\n\x0bPublication\x12\x11\n\ttimestamp\x18\x01 \x01(\x01\x12\r\n\x05topic\x18\x02 \x01(\t\x12\x0c\n\x04\x64\x61ta\x18\x03 \x01(\t*P\n\x04Role\x12\x10\n\x0cROLE_UNKNOWN\x10\x00\x12\x12\n\x0eROLE_PUBLISHER\x10\x01\x12\x13\n\x0fROLE_SUBSCRIBER\x10\x02\x12\r\n\tROLE_BOTH\x10\x03*\\\n\x06Status\x12\x12\n\x0eSTATUS_UNKNOWN\x10\x00\x12\x12\n\x0eSTATUS_SUCCESS\x10\x01\x12\x12\n\x0eSTATUS_FAILURE\x10\x02\x12\x16\n\x12STATUS_CHECK_AGAIN\x10\x03*y\n\x08MsgTypes\x12\x10\n\x0cTYPE_UNKNOWN\x10\x00\x12\x11\n\rTYPE_REGISTER\x10\x01\x12\x10\n\x0cTYPE_ISREADY\x10\x02\x12\x1c\n\x18TYPE_LOOKUP_PUB_BY_TOPIC\x10\x03\x12\x18\n\x14TYPE_LOOKUP_ALL_PUBS\x10\x04\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x19\x43S6381_MW/discovery.proto\"T\n\x0eRegistrantInfo\x12\n\n\x02id\x18\x01 \x01(\t\x12\x11\n\x04\x61\x64\x64r\x18\x02 \x01(\tH\x00\x88\x01\x01\x12\x11\n\x04port\x18\x03 \x01(\rH\x01\x88\x01\x01\x42\x07\n\x05_addrB\x07\n\x05_port\"T\n\x0bRegisterReq\x12\x13\n\x04role\x18\x01 \x01(\x0e\x32\x05.Role\x12\x1d\n\x04info\x18\x02 \x01(\x0b\x32\x0f.RegistrantInfo\x12\x11\n\ttopiclist\x18\x03 \x03(\t\"G\n\x0cRegisterResp\x12\x17\n\x06status\x18\x01 \x01(\x0e\x32\x07.Status\x12\x13\n\x06reason\x18\x02 \x01(\tH\x00\x88\x01\x01\x42\t\n\x07_reason\"\x0c\n\nIsReadyReq\"\x1d\n\x0bIsReadyResp\x12\x0e\n\x06status\x18\x01 \x01(\x08\"(\n\x13LookupPubByTopicReq\x12\x11\n\ttopiclist\x18\x01 \x03(\t\"8\n\x14LookupPubByTopicResp\x12 \n\x07publist\x18\x01 \x03(\x0b\x32\x0f.RegistrantInfo\"\xac\x01\n\x0c\x44iscoveryReq\x12\x1b\n\x08msg_type\x18\x01 \x01(\x0e\x32\t.MsgTypes\x12$\n\x0cregister_req\x18\x02 \x01(\x0b\x32\x0c.RegisterReqH\x00\x12\"\n\x0bisready_req\x18\x03 \x01(\x0b\x32\x0b.IsReadyReqH\x00\x12*\n\nlookup_req\x18\x04 \x01(\x0b\x32\x14.LookupPubByTopicReqH\x00\x42\t\n\x07\x43ontent\"\xb3\x01\n\rDiscoveryResp\x12\x1b\n\x08msg_type\x18\x01 \x01(\x0e\x32\t.MsgTypes\x12&\n\rregister_resp\x18\x02 \x01(\x0b\x32\r.RegisterRespH\x00\x12$\n\x0cisready_resp\x18\x03 \x01(\x0b\x32\x0c.IsReadyRespH\x00\x12,\n\x0blookup_resp\x18\x04 \x01(\x0b\x32\x15.LookupPubByTopicRespH\x00\x42\t\n\x07\x43ontent\"+\n\x0c\x44oubleSeries\x12\x0e\n\x06values\x18\x01 \x03(\x01\x12\x0b\n\x03raw\x18\x02 \x01(\x0c\"(\n\tIntSeries\x12\x0e\n\x06values\x18\x01 \x03(\x12\x12\x0b\n\x03raw\x18\x02 \x01(\x0c\")\n\nCodeSeries\x12\x0e\n\x06values\x18\x01 \x03(\r\x12\x0b\n\x03raw\x18\x02 \x01(\x0c\"\xcf\x01\n\x0bPublication\x12\x11\n\ttimestamp\x18\x01 \x01(\x01\x12\r\n\x05topic\x18\x02 \x01(\t\x12\x0c\n\x04\x64\x61ta\x18\x03 \x03(\t\x12\x0b\n\x03seq\x18\x04 \x01(\x04\x12\x0c\n\x04\x66ull\x18\x05 \x01(\x08\x12\x0e\n\x06pub_id\x18\x06 \x01(\t\x12 \n\x07\x64oubles\x18\x07 \x01(\x0b\x32\r.DoubleSeriesH\x00\x12\x1a\n\x04ints\x18\x08 \x01(\x0b\x32\n.IntSeriesH\x00\x12\x1c\n\x05\x63odes\x18\t \x01(\x0b\x32\x0b.CodeSeriesH\x00\x42\t\n\x07payload\".\n\x10PublicationBatch\x12\x1a\n\x04pubs\x18\x01 \x03(\x0b\x32\x0c.Publication*P\n\x04Role\x12\x10\n\x0cROLE_UNKNOWN\x10\x00\x12\x12\n\x0eROLE_PUBLISHER\x10\x01\x12\x13\n\x0fROLE_SUBSCRIBER\x10\x02\x12\r\n\tROLE_BOTH\x10\x03*\\\n\x06Status\x12\x12\n\x0eSTATUS_UNKNOWN\x10\x00\x12\x12\n\x0eSTATUS_SUCCESS\x10\x01\x12\x12\n\x0eSTATUS_FAILURE\x10\x02\x12\x16\n\x12STATUS_CHECK_AGAIN\x10\x03*y\n\x08MsgTypes\x12\x10\n\x0cTYPE_UNKNOWN\x10\x00\x12\x11\n\rTYPE_REGISTER\x10\x01\x12\x10\n\x0cTYPE_ISREADY\x10\x02\x12\x1c\n\x18TYPE_LOOKUP_PUB_BY_TOPIC\x10\x03\x12\x18\n\x14TYPE_LOOKUP_ALL_PUBS\x10\x04*?\n\x07Weather\x12\t\n\x05sunny\x10\x00\x12\n\n\x06\x63loudy\x10\x01\x12\t\n\x05rainy\x10\x02\x12\t\n\x05\x66oggy\x10\x03\x12\x07\n\x03icy\x10\x04**\n\nAirQuality\x12\x08\n\x04good\x10\x00\x12\x08\n\x04smog\x10\x01\x12\x08\n\x04poor\x10\x02*H\n\x08Location\x12\x0b\n\x07\x41merica\x10\x00\x12\n\n\x06\x45urope\x10\x01\x12\x08\n\x04\x41sia\x10\x02\x12\n\n\x06\x41\x66rica\x10\x03\x12\r\n\tAustralia\x10\x04\x62\x06proto3')
 
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'CS6381_MW.discovery_pb2', globals())
 if _descriptor._USE_C_DESCRIPTORS == False:
 
   DESCRIPTOR._options = None
-  _ROLE._serialized_start=839
-  _ROLE._serialized_end=919
-  _STATUS._serialized_start=921
-  _STATUS._serialized_end=1013
-  _MSGTYPES._serialized_start=1015
-  _MSGTYPES._serialized_end=1136
+  _ROLE._serialized_start=1164
+  _ROLE._serialized_end=1244
+  _STATUS._serialized_start=1246
+  _STATUS._serialized_end=1338
+  _MSGTYPES._serialized_start=1340
+  _MSGTYPES._serialized_end=1461
+  _WEATHER._serialized_start=1463
+  _WEATHER._serialized_end=1526
+  _AIRQUALITY._serialized_start=1528
+  _AIRQUALITY._serialized_end=1570
+  _LOCATION._serialized_start=1572
+  _LOCATION._serialized_end=1644
   _REGISTRANTINFO._serialized_start=29
   _REGISTRANTINFO._serialized_end=113
   _REGISTERREQ._serialized_start=115
@@ -44,6 +50,14 @@ if _descriptor._USE_C_DESCRIPTORS == False:
   _DISCOVERYREQ._serialized_end=592
   _DISCOVERYRESP._serialized_start=595
   _DISCOVERYRESP._serialized_end=774
-  _PUBLICATION._serialized_start=776
-  _PUBLICATION._serialized_end=837
+  _DOUBLESERIES._serialized_start=776
+  _DOUBLESERIES._serialized_end=819
+  _INTSERIES._serialized_start=821
+  _INTSERIES._serialized_end=861
+  _CODESERIES._serialized_start=863
+  _CODESERIES._serialized_end=904
+  _PUBLICATION._serialized_start=907
+  _PUBLICATION._serialized_end=1114
+  _PUBLICATIONBATCH._serialized_start=1116
+  _PUBLICATIONBATCH._serialized_end=1162
 # @@protoc_insertion_point(module_scope)
@@ -37,9 +37,12 @@ import argparse  # for argument parsing
 import configparser  # for configuration parsing
 import logging  # for logging. Use it in place of print statements.
 
+# the topics to spread across the broker groups
+from topic_selector import TopicSelector
 
 # Now import our CS6381 Middleware
 from CS6381_MW.DiscoveryMW import DiscoveryMW
+from CS6381_MW.AsyncMW import AsyncDiscoveryMW
 # We also need the message formats to handle incoming responses.
 from CS6381_MW import discovery_pb2
 
@@ -64,9 +67,15 @@ class DiscoveryAppln():
         self.logger = logger
         self.lookup = None
         self.dissemination = None
+        self.flavor = "poller"
         self.topics_to_publishers = None
         self.publisher_to_ip = None
         self.broker = None
+        # load driven rebalancing of the broker groups
+        self.threshold = 1.5
+        self.cooldown = 30.0
+        self.handoff = 2.0
+        self.max_moves = 2
 
     def configure(self, args):
         try:
@@ -84,17 +93,22 @@ class DiscoveryAppln():
             config.read(args.config)
             self.lookup = config["Discovery"]["Strategy"]
             self.dissemination = config["Dissemination"]["Strategy"]
+            self.flavor = config.get("Middleware", "Flavor", fallback="poller")
+            self.threshold = config.getfloat("Rebalance", "Threshold", fallback=1.5)
+            self.cooldown = config.getfloat("Rebalance", "Cooldown", fallback=30.0)
+            self.handoff = config.getfloat("Rebalance", "Handoff", fallback=2.0)
+            self.max_moves = config.getint("Rebalance", "MaxMoves", fallback=2)
 
             # setup underlying middleware object
             self.logger.debug(
                 "DiscoveryAppln::configure - setup underlying middleware object")
-            self.mw_obj = DiscoveryMW(self.logger)
+            self.mw_obj = AsyncDiscoveryMW(self.logger) if self.flavor == "asyncio" else DiscoveryMW(self.logger)
             # setting upcall handle
             self.logger.debug("DiscoveryAppln::driver - setting upcall handle")
             self.mw_obj.set_upcall_handle(self)
 
             # pass remainder of the args to the m/w object
-            self.mw_obj.configure(args)
+            self.mw_obj.configure(args, self.threshold, self.cooldown, self.handoff, self.max_moves)
             self.logger.info("DiscoveryAppln::configure completed")
 
         except Exception as e:
@@ -108,7 +122,7 @@ class DiscoveryAppln():
             self.dump()
 
             self.state = self.State.ISREADY
-            self.mw_obj.create_broker_groups()
+            self.mw_obj.create_broker_groups(TopicSelector().all())
             self.mw_obj.setWatch()
             self.mw_obj.event_loop(timeout=0)
 
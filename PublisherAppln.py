@@ -49,6 +49,8 @@ import time   # for sleep
 import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
+import copy   # to derive per worker arguments
+import multiprocessing # for the pool of publisher workers
 
 # Import our topic selector. Feel free to use alternate way to
 # get your topics of interest
@@ -56,6 +58,8 @@ from topic_selector import TopicSelector
 
 # Now import our CS6381 Middleware
 from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.AsyncMW import AsyncPublisherMW
+from CS6381_MW.RateScheduler import RateScheduler
 # We also need the message formats to handle incoming responses.
 from CS6381_MW import discovery_pb2
 
@@ -90,8 +94,16 @@ class PublisherAppln ():
     self.num_topics = None # total num of topics we publish
     self.lookup = None # one of the diff ways we do lookup
     self.dissemination = None # direct or via broker
+    self.zero_copy = False # use zero-copy ZMQ sends
+    self.flavor = "poller" # middleware event loop flavor: poller or asyncio
     self.mw_obj = None # handle to the underlying Middleware object
     self.logger = logger  # internal logger for print statements
+    self.ts = None # topic selector generating our samples
+    self.samples = None # per topic stream of samples generated in blocks
+    self.scheduler = None # paces the dissemination ticks
+    self.iters_done = 0 # iterations disseminated so far
+    self.max_slice = 0.001 # max secs of back to back ticks before we yield to the event loop
+    self.stats = None # rate and ownership stats collected once dissemination completes
 
   ########################################
   # configure/initialize
@@ -118,17 +130,21 @@ class PublisherAppln ():
       config.read (args.config)
       self.lookup = config["Discovery"]["Strategy"]
       self.dissemination = config["Dissemination"]["Strategy"]
+      self.zero_copy = config.getboolean("Transport", "ZeroCopy", fallback=False)
+      self.flavor = config.get("Middleware", "Flavor", fallback="poller")
     
       # Now get our topic list of interest
       self.logger.debug ("PublisherAppln::configure - selecting our topic list")
-      ts = TopicSelector ()
-      self.topiclist = ts.interest (self.num_topics)  # let topic selector give us the desired num of topics
+      self.ts = TopicSelector ()
+      self.topiclist = self.ts.interest (self.num_topics)  # let topic selector give us the desired num of topics
+      # samples are precomputed in blocks per topic rather than drawn one call at a time
+      self.samples = {topic: self.ts.samples (topic) for topic in self.topiclist}
 
       # Now setup up our underlying middleware object to which we delegate
       # everything
       self.logger.debug ("PublisherAppln::configure - initialize the middleware object")
-      self.mw_obj = PublisherMW (self.logger)
-      self.mw_obj.configure (args) # pass remainder of the args to the m/w object
+      self.mw_obj = AsyncPublisherMW (self.logger) if self.flavor == "asyncio" else PublisherMW (self.logger)
+      self.mw_obj.configure (args, self.topiclist, self.zero_copy) # pass remainder of the args to the m/w object
       
       self.logger.info ("PublisherAppln::configure - configuration complete")
       
@@ -190,8 +206,8 @@ class PublisherAppln ():
     ''' Invoke operating depending on state  '''
 
     try:
-      self.logger.info ("PublisherAppln::invoke_operation")
-      self.logger.info ("PublisherAppln::invoke_operation - state = {}".format (self.state))
+      # we are called once per tick while disseminating, so keep this quiet
+      self.logger.debug ("PublisherAppln::invoke_operation - state = {}".format (self.state))
       # check what state are we in. If we are in REGISTER state,
       # we send register request to discovery service. If we are in
       # ISREADY state, then we keep checking with the discovery
@@ -200,6 +216,10 @@ class PublisherAppln ():
         # send a register msg to discovery service
         self.logger.debug ("PublisherAppln::invoke_operation - register with the discovery service")
         self.mw_obj.register (self.name, self.topiclist)
+        # compete for ownership of our topics and keep watching the ownership
+        # znodes so that dissemination can consult the cached view
+        self.mw_obj.try_leader (self.topiclist)
+        self.mw_obj.setWatch ()
         self.state = self.State.DISSEMINATE
         return 0
         # Remember that we were invoked by the event loop as part of the upcall.
@@ -212,28 +232,39 @@ class PublisherAppln ():
       elif (self.state == self.State.DISSEMINATE):
 
         # We are here because both registration and is ready is done. So the only thing
-        # left for us as a publisher is dissemination, which we do it actively here.
-        self.logger.debug ("PublisherAppln::invoke_operation - start Disseminating")
-
-        # Now disseminate topics at the rate at which we have configured ourselves.
-        ts = TopicSelector ()
-        for i in range (self.iters):
-          # I leave it to you whether you want to disseminate all the topics of interest in
-          # each iteration OR some subset of it. Please modify the logic accordingly.
-          # Here, we choose to disseminate on all topics that we publish.  Also, we don't care
-          # about their values. But in future assignments, this can change.
-          for topic in self.topiclist:
-            # For now, we have chosen to send info in the form "topic name: topic value"
-            # In later assignments, we should be using more complex encodings using
-            # protobuf.  In fact, I am going to do this once my basic logic is working.
-            dissemination_data = ts.gen_publication (topic)
-            self.mw_obj.disseminate (self.name, topic, dissemination_data)
-
-          # Now sleep for an interval of time to ensure we disseminate at the
-          # frequency that was configured.
-          time.sleep (1/float (self.frequency))  # ensure we get a floating point num
-
+        # left for us as a publisher is dissemination. Rather than running all the
+        # iterations here (which would starve the event loop), we run whatever is due
+        # and hand control back with a timeout equal to the time until the next deadline.
+        if (self.scheduler is None):
+          self.logger.debug ("PublisherAppln::invoke_operation - start Disseminating")
+          # The scheduler paces us against absolute deadlines so the time spent
+          # publishing does not make the real rate drift below the requested one.
+          self.scheduler = RateScheduler (self.frequency)
+          self.scheduler.start ()
+
+        # run the ticks that are due, including those due within the next msec which
+        # the poller cannot time for us. Bound the slice so the poller still gets a
+        # turn at very high rates.
+        slice_end = time.perf_counter () + self.max_slice
+        while (self.iters_done < self.iters):
+          delay = self.scheduler.delay ()
+          if (delay >= 0.001 or time.perf_counter () >= slice_end):
+            break
+          self.scheduler.wait ()
+          self.publish_tick ()
+          self.iters_done += 1
+
+        if (self.iters_done < self.iters):
+          # wake up a little early (floor) and spin the rest in the scheduler
+          return int (self.scheduler.delay () * 1000)
+
+        self.mw_obj.flush ()
         self.logger.debug ("PublisherAppln::invoke_operation - Dissemination completed")
+        self.stats = {"rate": self.scheduler.stats (), "ownership": self.mw_obj.ownership_stats (),
+                      "suppressed": self.mw_obj.suppression_stats ()}
+        self.logger.info ("PublisherAppln::invoke_operation - ownership stats = {}".format (self.stats["ownership"]))
+        self.logger.info ("PublisherAppln::invoke_operation - suppressed traffic = {}".format (self.stats["suppressed"]))
+        self.logger.info ("PublisherAppln::invoke_operation - rate stats = {}".format (self.stats["rate"]))
 
         # we are done. So we move to the completed state
         self.state = self.State.COMPLETED
@@ -256,6 +287,23 @@ class PublisherAppln ():
       raise e
 
   
+  ########################################
+  # publish one iteration worth of samples
+  ########################################
+  def publish_tick (self):
+    # I leave it to you whether you want to disseminate all the topics of interest in
+    # each iteration OR some subset of it. Please modify the logic accordingly.
+    # Here, we choose to disseminate on all topics that we publish.  Also, we don't care
+    # about their values. But in future assignments, this can change.
+    for topic in self.topiclist:
+      # For now, we have chosen to send info in the form "topic name: topic value"
+      # In later assignments, we should be using more complex encodings using
+      # protobuf.  In fact, I am going to do this once my basic logic is working.
+      dissemination_data = next (self.samples[topic])
+      self.mw_obj.disseminate (self.name, topic, dissemination_data)
+    # let the middleware ship the batch collected during this tick, if any
+    self.mw_obj.end_tick ()
+
   def set_state(self, state):
     self.state = state
   ########################################
@@ -307,7 +355,7 @@ def parseCmdLineArgs ():
 
   parser.add_argument ("-c", "--config", default="config.ini", help="configuration file (default: config.ini)")
 
-  parser.add_argument ("-f", "--frequency", type=int,default=1, help="Rate at which topics disseminated: default once a second - use integers")
+  parser.add_argument ("-f", "--frequency", type=float, default=1, help="Rate at which topics disseminated in iterations per second, may be fractional: default once a second")
 
   parser.add_argument ("-i", "--iters", type=int, default=1000, help="number of publication iterations (default: 1000)")
 
@@ -315,12 +363,93 @@ def parseCmdLineArgs ():
   
   parser.add_argument ("-z", "--zookeeper", default="localhost:2181", help="IP Addr:Port combo for the zookeeper service, default is localhost:2181")
 
-  parser.add_argument ("-hs", "--h_size", default="10", help="Size of the history buffer, default is 10")
+  parser.add_argument ("-hs", "--h_size", type=int, default=10, help="Size of the history buffer, default is 10")
+
+  parser.add_argument ("--delta", action="store_true", help="Send only the newest sample and a sequence number; subscribers rebuild the history window")
+
+  parser.add_argument ("--resync", type=int, default=0, help="With --delta, send the full history window every this many samples (default 0 = every 10*h_size samples)")
+
+  parser.add_argument ("--batch_size", type=int, default=1, help="Max publications packed into one frame, default 1 = no batching")
+
+  parser.add_argument ("--batch_window", type=float, default=0, help="With --batch_size, max time in msecs a publication waits in a batch (default 0 = one batch per iteration)")
+
+  parser.add_argument ("-w", "--workers", type=int, default=1, help="Number of publisher worker processes to run, each named <name>-<i> on port <port>+i (default 1 = this process only)")
 
 
   return parser.parse_args()
 
 
+###################################
+#
+# Run one publisher worker of the pool
+#
+# Each worker is a full publisher of its own: its own ZMQ context, PUB
+# socket, port, name and /publisher/<name> registration. Only the parsed
+# arguments are shared. The stats of the worker are handed back to the parent.
+###################################
+def run_worker (args, index):
+  # workers are started with spawn, so they set up their own logging
+  logging.basicConfig (level=logging.DEBUG,
+                       format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  wargs = copy.copy (args)
+  wargs.name = "{}-{}".format (args.name, index)
+  wargs.port = args.port + index
+  logger = logging.getLogger ("PublisherAppln.{}".format (wargs.name))
+  logger.setLevel (args.loglevel)
+  try:
+    pub_app = PublisherAppln (logger)
+    pub_app.configure (wargs)
+    pub_app.driver ()
+    return wargs.name, pub_app.stats
+  except Exception as e:
+    logger.error ("run_worker - exception in worker {} - {}".format (wargs.name, e))
+    return wargs.name, None
+
+###################################
+#
+# Aggregate the stats reported by the workers
+#
+###################################
+def aggregate_stats (results):
+  stats = [s for _, s in results if s is not None]
+  total = {"workers": len (results), "completed": len (stats),
+           "requested_rate": 0.0, "achieved_rate": 0.0, "ticks": 0, "skipped": 0,
+           "jitter_mean": 0.0, "jitter_max": 0.0, "ownership_changes": 0, "max_staleness": 0.0}
+  for s in stats:
+    rate = s["rate"]
+    total["requested_rate"] += rate["requested_rate"]
+    total["achieved_rate"] += rate["achieved_rate"]
+    total["ticks"] += rate["ticks"]
+    total["skipped"] += rate["skipped"]
+    # weight the mean lateness of every worker by its number of ticks
+    total["jitter_mean"] += rate["jitter_mean"] * rate["ticks"]
+    total["jitter_max"] = max (total["jitter_max"], rate["jitter_max"])
+    total["ownership_changes"] += s["ownership"]["changes"]
+    total["max_staleness"] = max (total["max_staleness"], s["ownership"]["max_staleness"])
+  if total["ticks"]:
+    total["jitter_mean"] /= total["ticks"]
+  return total
+
+###################################
+#
+# Run a pool of publisher workers and report their aggregated stats
+#
+###################################
+def run_pool (args, logger):
+  # spawn rather than fork so that no ZMQ context or kazoo thread is ever
+  # shared with the children
+  ctx = multiprocessing.get_context ("spawn")
+  logger.info ("run_pool - starting {} publisher workers".format (args.workers))
+  with ctx.Pool (processes=args.workers) as pool:
+    results = pool.starmap (run_worker, [(args, i) for i in range (args.workers)])
+
+  for name, stats in results:
+    if stats is None:
+      logger.warning ("run_pool - worker {} did not complete".format (name))
+    else:
+      logger.debug ("run_pool - worker {} stats = {}".format (name, stats))
+  logger.info ("run_pool - aggregated stats = {}".format (aggregate_stats (results)))
+
 ###################################
 #
 # Main program
@@ -341,6 +470,11 @@ def main ():
     logger.setLevel (args.loglevel)
     logger.debug ("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
 
+    # with more than one worker, this process only supervises the pool
+    if (args.workers > 1):
+      run_pool (args, logger)
+      return
+
     # Obtain a publisher application
     logger.debug ("Main: obtain the publisher appln object")
     pub_app = PublisherAppln (logger)
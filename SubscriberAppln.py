@@ -41,6 +41,8 @@ from topic_selector import TopicSelector
 
 # Now import our CS6381 Middleware
 from CS6381_MW.SubscriberMW import SubscriberMW
+from CS6381_MW.AsyncMW import AsyncSubscriberMW
+from CS6381_MW.ContentFilter import ContentFilter
 # We also need the message formats to handle incoming responses.
 from CS6381_MW import discovery_pb2
 
@@ -64,6 +66,13 @@ class SubscriberAppln():
         self.num_topics = None
         self.lookup = None
         self.dissemination = None
+        self.zero_copy = False
+        self.flavor = "poller"
+        self.recorder_format = "csv"
+        self.report_interval = 0
+        self.workers = 0
+        self.queue_size = 10000
+        self.filters = []
         self.mw_obj = None
         self.logger = logger 
 
@@ -86,18 +95,34 @@ class SubscriberAppln():
             config.read(args.config)
             self.lookup = config["Discovery"]["Strategy"]
             self.dissemination = config["Dissemination"]["Strategy"]
+            self.zero_copy = config.getboolean("Transport", "ZeroCopy", fallback=False)
+            self.flavor = config.get("Middleware", "Flavor", fallback="poller")
+            self.recorder_format = config.get("Recorder", "Format", fallback="csv")
+            self.report_interval = config.getfloat("Recorder", "ReportInterval", fallback=0)
+            self.workers = config.getint("Pipeline", "DecodeWorkers", fallback=0)
+            self.queue_size = config.getint("Pipeline", "QueueSize", fallback=10000)
             
             # get the topic list
             self.logger.debug("SubscriberAppln::configure - get the topic list")
             ts = TopicSelector()
             self.topiclist = ts.interest(self.num_topics)
+
+            # content filters on the samples of our topics
+            for text in args.filter or []:
+                content_filter = ContentFilter.parse(text)
+                if content_filter.topic not in self.topiclist:
+                    self.logger.warning("SubscriberAppln::configure - not subscribed to {}, ignoring {}".format(
+                        content_filter.topic, content_filter))
+                    continue
+                self.filters.append(content_filter)
             
             # Now setup our underlying middleware object
             self.logger.debug("SubscriberAppln::configure - setup the middleware object")
-            self.mw_obj = SubscriberMW(self.logger)
+            self.mw_obj = AsyncSubscriberMW(self.logger) if self.flavor == "asyncio" else SubscriberMW(self.logger)
             self.logger.debug("SubscriberAppln::driver - upcall handle")
             self.mw_obj.set_upcall_handle(self)
-            self.mw_obj.configure(args, self.dissemination, self.topiclist)
+            self.mw_obj.configure(args, self.dissemination, self.topiclist, self.zero_copy, self.recorder_format,
+                                 self.report_interval, self.workers, self.queue_size, self.filters)
             self.logger.info("SubscriberAppln::configure - completed")
             
         except Exception as e:
@@ -186,6 +211,8 @@ def parseCmdLineArgs():
     parser.add_argument ("-z", "--zookeeper", default="localhost:2181", help="IP Addr:Port combo for the zookeeper service, default is localhost:2181")
 
     parser.add_argument ("-hs", "--h_size", type=int, default=10, help="Size of the history buffer, default is 10")
+
+    parser.add_argument ("-F", "--filter", action="append", help="Only take samples of a topic that match, as topic:range:min:max, topic:eq:value or topic:in:v1,v2 (an empty bound is open); may be repeated")
     return parser.parse_args()
 # main program
 def main():
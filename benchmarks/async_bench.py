@@ -0,0 +1,171 @@
+###############################################
+#
+# Purpose: The asyncio flavor of the middleware (CS6381_MW/AsyncMW.py)
+# against the regular poller flavor, hosting a broker and many subscribers
+# in one process
+#
+# Usage: python3 benchmarks/async_bench.py [-r subs] [-t topics] [-f frequency] [-s secs]
+#
+# A publisher thread sends typed publications of every topic to a broker
+# forwarding in python, which the subscribers all subscribe to. The broker
+# and subscribers are the real middleware objects: BrokerMW/SubscriberMW,
+# each running its event_loop in a thread of its own, or
+# AsyncBrokerMW/AsyncSubscriberMW, all running event_loop_async in one
+# asyncio loop. Only configure() is skipped, since it needs ZooKeeper; we
+# set up the sockets it would have. The latencies are the ones the
+# subscribers record themselves (SubscriberMW.record_latency). We also
+# report the CPU time used per wall clock second.
+#
+###############################################
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import argparse
+import threading
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW import discovery_pb2
+from CS6381_MW.Common import FLAG_FULL, pack_header
+from CS6381_MW.Histogram import Histogram
+from CS6381_MW.BrokerMW import BrokerMW
+from CS6381_MW.SubscriberMW import SubscriberMW
+from CS6381_MW.AsyncMW import AsyncBrokerMW, AsyncSubscriberMW
+
+logger = logging.getLogger("bench")
+logger.setLevel(logging.WARNING)
+
+
+class Upcall():
+    ''' stands in for the appln; the event loops never time out to it here '''
+    def invoke_operation(self):
+        return None
+
+
+def publisher(ctx, topics, period, stop):
+    pub = ctx.socket(zmq.PUB)
+    pub.bind("inproc://publisher")
+    time.sleep(0.2)  # let the broker and the subscribers subscribe
+    seq = 0
+    wakeup = time.monotonic()
+    # we keep publishing until the event loops are out, so that none of them
+    # stays blocked in a poll without a timeout
+    while not stop.is_set():
+        seq += 1
+        for topic in topics:
+            msg = discovery_pb2.Publication()
+            msg.topic, msg.seq, msg.full, msg.pub_id = topic, seq, True, "pub1"
+            msg.ints.values.append(seq)
+            msg.timestamp = time.monotonic()
+            pub.send_multipart([topic.encode("utf-8"), pack_header(1, seq, FLAG_FULL), msg.SerializeToString()])
+        wakeup += period
+        time.sleep(max(0, wakeup - time.monotonic()))
+    pub.close(linger=0)
+
+
+def make_broker(cls, ctx, topics):
+    broker = cls(logger)
+    broker.upcall_obj = Upcall()
+    broker.req = ctx.socket(zmq.REQ)
+    broker.sub = ctx.socket(zmq.XSUB)
+    broker.pub = ctx.socket(zmq.XPUB)
+    broker.pub.setsockopt(zmq.XPUB_VERBOSER, 1)
+    broker.verboser = True
+    broker.sub.connect("inproc://publisher")
+    broker.pub.bind("inproc://broker")
+    broker.topics = set(topics)
+    broker.poller = zmq.Poller()
+    for socket in (broker.req, broker.sub, broker.pub):
+        broker.poller.register(socket, zmq.POLLIN)
+    return broker
+
+
+def make_subscriber(cls, ctx, topics):
+    sub = cls(logger)
+    sub.upcall_obj = Upcall()
+    sub.h_size = 1
+    sub.start_time = time.monotonic()
+    sub.req = ctx.socket(zmq.REQ)
+    sub.sub = ctx.socket(zmq.SUB)
+    sub.snap = ctx.socket(zmq.PULL)
+    sub.snap.bind(sub.snap_addr)
+    sub.topics = set(topics)
+    sub.topics_raw = {topic.encode("utf-8") for topic in topics}
+    for topic in topics:
+        sub.sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+    sub.sub.connect("inproc://broker")
+    sub.poller = zmq.Poller()
+    for socket in (sub.req, sub.sub, sub.snap):
+        sub.poller.register(socket, zmq.POLLIN)
+    return sub
+
+
+def run(flavor, args):
+    ctx = zmq.Context()
+    topics = ["topic{:02d}".format(i) for i in range(args.topics)]
+    stop = threading.Event()
+    feeder = threading.Thread(target=publisher, args=(ctx, topics, 1.0 / args.frequency, stop))
+    feeder.start()
+    if flavor == "poller":
+        roles = [make_broker(BrokerMW, ctx, topics)]
+        roles += [make_subscriber(SubscriberMW, ctx, topics) for _ in range(args.subs)]
+    else:
+        roles = [make_broker(AsyncBrokerMW, ctx, topics)]
+        roles += [make_subscriber(AsyncSubscriberMW, ctx, topics) for _ in range(args.subs)]
+
+    def stopper():
+        time.sleep(args.secs)
+        for role in roles:
+            role.handle_events = False
+    timer = threading.Thread(target=stopper)
+    cpu, wall = time.process_time(), time.monotonic()
+    timer.start()
+    if flavor == "poller":
+        threads = [threading.Thread(target=role.event_loop) for role in roles]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        async def main():
+            await asyncio.gather(*(role.event_loop_async() for role in roles))
+        asyncio.run(main())
+    cpu, wall = time.process_time() - cpu, time.monotonic() - wall
+    timer.join()
+    stop.set()
+    feeder.join()
+
+    hist = Histogram()
+    for sub in roles[1:]:
+        for h in sub.histograms.values():
+            hist.merge(h)
+    for role in roles:
+        for socket in (role.req, role.sub, getattr(role, "pub", None), getattr(role, "snap", None)):
+            if isinstance(socket, zmq.Socket):
+                socket.close(linger=0)
+    ctx.term()
+    return hist, cpu / wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description="asyncio versus poller flavor of the middleware")
+    parser.add_argument("-r", "--subs", type=int, default=20, help="subscribers, default 20")
+    parser.add_argument("-t", "--topics", type=int, default=5, help="topics, default 5")
+    parser.add_argument("-f", "--frequency", type=float, default=100, help="publications per sec per topic, default 100")
+    parser.add_argument("-s", "--secs", type=float, default=5, help="secs per run, default 5")
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>10} {:>10} {:>10}".format("flavor", "msgs", "p50 us", "p99 us", "cpu/wall"))
+    for flavor in ("poller", "asyncio"):
+        hist, load = run(flavor, args)
+        pct = hist.percentiles([50, 99])
+        print("{:>8} {:>10} {:>10} {:>10} {:>10.2f}".format(flavor, hist.total, pct[50], pct[99], load))
+
+
+if __name__ == "__main__":
+    main()
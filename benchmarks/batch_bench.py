@@ -0,0 +1,104 @@
+###############################################
+#
+# Purpose: Throughput of one publication per frame versus one batched
+# frame per tick (PublicationBatch), for 1, 9 and 1000 topics
+#
+# Usage: python3 benchmarks/batch_bench.py [-t ticks] [-s h_size]
+#
+# Runs a PUB and a SUB socket over inproc inside one process so that only
+# the serialization and ZMQ per-message costs are measured.
+#
+###############################################
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW import discovery_pb2
+from CS6381_MW.Common import BATCH_TOPIC
+
+
+def fill(msg, topic, seq, window):
+    msg.timestamp = time.monotonic()
+    msg.topic = topic
+    msg.seq = seq
+    msg.full = True
+    msg.data.extend(window)
+
+
+def consumer(ctx, endpoint, expected, done):
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVHWM, 0)
+    sub.setsockopt_string(zmq.SUBSCRIBE, "")
+    sub.connect(endpoint)
+    done["ready"].set()
+    received = 0
+    batch_topic = bytes(BATCH_TOPIC, "utf-8")
+    while received < expected:
+        frames = sub.recv_multipart()
+        if frames[0] == batch_topic:
+            batch = discovery_pb2.PublicationBatch()
+            batch.ParseFromString(frames[1])
+            received += len(batch.pubs)
+        else:
+            msg = discovery_pb2.Publication()
+            msg.ParseFromString(frames[1])
+            received += 1
+    done["end"] = time.perf_counter()
+    sub.close()
+
+
+def run(num_topics, ticks, h_size, batched):
+    ctx = zmq.Context.instance()
+    endpoint = "inproc://batch-bench-{}-{}".format(num_topics, int(batched))
+    pub = ctx.socket(zmq.PUB)
+    pub.setsockopt(zmq.SNDHWM, 0)
+    pub.bind(endpoint)
+    topics = ["topic{}".format(i) for i in range(num_topics)]
+    window = [str(i) for i in range(h_size)]
+    done = {"ready": threading.Event()}
+    thread = threading.Thread(target=consumer, args=(ctx, endpoint, ticks * num_topics, done))
+    thread.start()
+    done["ready"].wait()
+    time.sleep(0.2)  # let the subscription reach the PUB socket
+
+    batch_topic = bytes(BATCH_TOPIC, "utf-8")
+    start = time.perf_counter()
+    for seq in range(1, ticks + 1):
+        if batched:
+            batch = discovery_pb2.PublicationBatch()
+            for topic in topics:
+                fill(batch.pubs.add(), topic, seq, window)
+            pub.send_multipart([batch_topic, batch.SerializeToString()])
+        else:
+            for topic in topics:
+                msg = discovery_pb2.Publication()
+                fill(msg, topic, seq, window)
+                pub.send_multipart([bytes(topic, "utf-8"), msg.SerializeToString()])
+    thread.join()
+    pub.close()
+    return ticks * num_topics / (done["end"] - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched publication throughput")
+    parser.add_argument("-t", "--ticks", type=int, default=2000, help="ticks per run, default 2000")
+    parser.add_argument("-s", "--h_size", type=int, default=10, help="history window size, default 10")
+    args = parser.parse_args()
+
+    print("{:>8} {:>16} {:>16} {:>9}".format("topics", "single samples/s", "batched samples/s", "speedup"))
+    for num_topics in (1, 9, 1000):
+        ticks = max(1, args.ticks // max(1, num_topics // 9))
+        single = run(num_topics, ticks, args.h_size, False)
+        batched = run(num_topics, ticks, args.h_size, True)
+        print("{:>8} {:>16.0f} {:>16.0f} {:>8.1f}x".format(num_topics, single, batched, batched / single))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+###############################################
+#
+# Purpose: Broker forwarding throughput, python recv/send per message (as
+# BrokerMW.recv_data does) versus the ZMQ proxy device of ProxyForwarder
+#
+# Usage: python3 benchmarks/broker_bench.py [-m msgs] [-b bytes]
+#
+# Publisher -> broker -> subscriber over inproc in one process. The proxy
+# runs bare, with Capture on (the statistics thread counts every message)
+# and with Capture feeding a SnapshotCache, as Snapshot=True does. With
+# capture we also report the captured frames dropped because the
+# statistics thread fell behind; the forwarded messages are never dropped.
+#
+###############################################
+
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW.Common import FLAG_FULL, pack_header
+from CS6381_MW.ProxyForwarder import ProxyForwarder
+from CS6381_MW.SnapshotCache import SnapshotCache
+
+MODES = ("python", "proxy", "capture", "snapshot")
+
+
+def python_broker(ctx, sub, pub, count):
+    poller = zmq.Poller()
+    poller.register(sub, zmq.POLLIN)
+    forwarded = 0
+    while forwarded < count:
+        if dict(poller.poll(timeout=1000)):
+            pub.send_multipart(sub.recv_multipart())
+            forwarded += 1
+
+
+def run(mode, count, size):
+    ctx = zmq.Context()
+    front, back = "inproc://front-" + mode, "inproc://back-" + mode
+    pub = ctx.socket(zmq.PUB)
+    pub.setsockopt(zmq.SNDHWM, 0)
+    pub.bind(front)
+    bsub = ctx.socket(zmq.SUB)
+    bsub.setsockopt(zmq.RCVHWM, 0)
+    bsub.setsockopt(zmq.SUBSCRIBE, b"")
+    bsub.connect(front)
+    bpub = ctx.socket(zmq.PUB)
+    bpub.setsockopt(zmq.SNDHWM, 0)
+    bpub.bind(back)
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVHWM, 0)
+    sub.setsockopt(zmq.SUBSCRIBE, b"")
+    sub.connect(back)
+    time.sleep(0.2)  # let the subscriptions propagate
+
+    if mode == "python":
+        broker = threading.Thread(target=python_broker, args=(ctx, bsub, bpub, count))
+        broker.start()
+    else:
+        cache = SnapshotCache() if mode == "snapshot" else None
+        forwarder = ProxyForwarder(ctx, bsub, bpub, logging.getLogger("bench"), capture=mode != "proxy",
+                                   observer=cache and cache.observe)
+        forwarder.start()
+
+    header, payload = pack_header(1, 1, FLAG_FULL), b"x" * size
+    start = time.perf_counter()
+    for _ in range(count):
+        pub.send_multipart([b"temperature", header, payload])
+    for _ in range(count):
+        sub.recv_multipart()
+    rate = count / (time.perf_counter() - start)
+
+    dropped = None
+    if mode == "python":
+        broker.join()
+    else:
+        forwarder.stop()
+        if forwarder.capture:
+            # let the statistics thread catch up with what was captured
+            while True:
+                seen = forwarder.messages
+                time.sleep(0.2)
+                if forwarder.messages == seen:
+                    break
+            dropped = forwarder.stats()["dropped_frames"]
+    for socket in (pub, bsub, bpub, sub):
+        socket.close(linger=0)
+    ctx.term()
+    return rate, dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broker forwarding benchmark")
+    parser.add_argument("-m", "--msgs", type=int, default=200000, help="messages per run, default 200000")
+    parser.add_argument("-b", "--bytes", type=int, default=100, help="payload bytes, default 100")
+    args = parser.parse_args()
+
+    print("{:>10} {:>12} {:>8} {:>16}".format("mode", "msgs/s", "speedup", "frames dropped"))
+    base = None
+    for mode in MODES:
+        rate, dropped = run(mode, args.msgs, args.bytes)
+        base = base or rate
+        print("{:>10} {:>12.0f} {:>7.1f}x {:>16}".format(mode, rate, rate / base, "-" if dropped is None else dropped))
+
+
+if __name__ == "__main__":
+    main()
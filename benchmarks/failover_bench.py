@@ -0,0 +1,169 @@
+###############################################
+#
+# Purpose: Gap a subscriber sees when its broker fails over to a cold versus
+# a warm standby ([Broker] WarmStandby)
+#
+# Usage: python3 benchmarks/failover_bench.py [-f frequency] [-s h_size] [-r resync] [-n failovers]
+#
+# A publisher in delta mode (the real PublisherMW) feeds two BrokerMW
+# forwarding in python with a snapshot cache, all over inproc in one
+# process. The subscriber takes its data from the leader. We then stop the
+# leader, do what the standby's ZK watch does when the leader node goes
+# (notified_at, is_leader, promote) and move the subscriber over: it
+# subscribes to the new leader and fetches a snapshot. We report the secs
+# from the notification to the subscriber's first valid live sample, that
+# is one holding a full window.
+#
+# ZooKeeper is not involved, so the detection of a crash (up to the
+# broker's SessionTimeout) comes on top of these numbers.
+#
+###############################################
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import threading
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW import discovery_pb2
+from CS6381_MW.Common import FLAG_FULL, PAYLOAD_TYPECODE, payload_kind, unpack_header
+from CS6381_MW.HistoryBuffer import HistoryBuffer
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.BrokerMW import BrokerMW
+from CS6381_MW.SnapshotCache import SnapshotCache
+
+TOPIC = "humidity"  # a topic with a double payload
+
+logger = logging.getLogger("bench")
+logger.setLevel(logging.WARNING)
+
+
+def publisher(ctx, period, h_size, resync, stop):
+    mw = PublisherMW(logger)
+    mw.name, mw.delta, mw.resync = "pub1", True, resync
+    mw.pub = ctx.socket(zmq.XPUB)
+    mw.pub.bind("inproc://pub")
+    mw.payload = {TOPIC: payload_kind(TOPIC)}
+    mw.history = {TOPIC: HistoryBuffer(h_size, PAYLOAD_TYPECODE[mw.payload[TOPIC]])}
+    mw.seq, mw.since_full = {TOPIC: 0}, {TOPIC: resync}
+    sample = 0.0
+    wakeup = time.monotonic()
+    while not stop.is_set():
+        while mw.pub.poll(0):
+            mw.recv_subscription()
+        mw.history[TOPIC].append(sample)
+        msg = discovery_pb2.Publication()
+        mw.fill_publication(msg, TOPIC, sample)
+        mw.send_publication(msg)
+        sample += 1
+        wakeup += period
+        time.sleep(max(0, wakeup - time.monotonic()))
+    mw.pub.close(linger=0)
+
+
+def make_broker(ctx, name, leader, warm):
+    broker = BrokerMW(logger)
+    broker.is_leader, broker.warm_standby = leader, warm
+    broker.req = ctx.socket(zmq.REQ)
+    broker.sub = ctx.socket(zmq.XSUB)
+    broker.pub = ctx.socket(zmq.XPUB)
+    broker.pub.setsockopt(zmq.XPUB_VERBOSER, 1)
+    broker.verboser = True
+    broker.sub.connect("inproc://pub")
+    broker.pub.bind("inproc://{}-pub".format(name))
+    broker.cache = SnapshotCache()
+    broker.snap = ctx.socket(zmq.ROUTER)
+    broker.snap.bind("inproc://{}-snap".format(name))
+    broker.topics = {TOPIC}
+    broker.poller = zmq.Poller()
+    for socket in (broker.req, broker.sub, broker.pub, broker.snap):
+        broker.poller.register(socket, zmq.POLLIN)
+    if warm and not leader:
+        broker.warm_up(broker.topics)
+    return broker
+
+
+def stop_broker(broker, thread):
+    broker.handle_events = False
+    thread.join()
+    for socket in (broker.req, broker.sub, broker.pub, broker.snap):
+        socket.close(linger=0)
+
+
+def valid_after(ctx, name, sub):
+    ''' monotonic time of the first live sample that finds us holding a full window '''
+    sub.setsockopt_string(zmq.SUBSCRIBE, TOPIC)
+    sub.connect("inproc://{}-pub".format(name))
+    req = ctx.socket(zmq.REQ)
+    req.connect("inproc://{}-snap".format(name))
+    req.send_multipart([TOPIC.encode("utf-8")])
+    frames = req.recv_multipart()
+    req.close()
+    full = any(unpack_header(frames[i + 1])[2] & FLAG_FULL for i in range(1, len(frames) - 2, 3))
+    while True:
+        topic, header, payload = sub.recv_multipart()
+        full = full or bool(unpack_header(header)[2] & FLAG_FULL)
+        if full:
+            return time.monotonic()
+
+
+def failover(args, warm):
+    ctx = zmq.Context()
+    stop = threading.Event()
+    period = 1.0 / args.frequency
+    source = threading.Thread(target=publisher, args=(ctx, period, args.h_size, args.resync, stop))
+    source.start()
+    leader = make_broker(ctx, "a", True, warm)
+    standby = make_broker(ctx, "b", False, warm)
+    threads = [threading.Thread(target=broker.event_loop) for broker in (leader, standby)]
+    for thread in threads:
+        thread.start()
+
+    sub = ctx.socket(zmq.SUB)
+    valid_after(ctx, "a", sub)
+    # crash the leader at a random point of the resync cycle
+    time.sleep(args.resync * period * (1 + random.random()))
+    stop_broker(leader, threads[0])
+    sub.close(linger=0)
+
+    # what BrokerMW.setWatch does once ZK reports the leader node gone
+    standby.notified_at = time.monotonic()
+    standby.is_leader = True
+    standby.defer(standby.promote)
+    sub = ctx.socket(zmq.SUB)
+    gap = valid_after(ctx, "b", sub) - standby.notified_at
+
+    sub.close(linger=0)
+    stop.set()
+    source.join()
+    stop_broker(standby, threads[1])
+    ctx.term()
+    return gap, standby.takeovers[0], standby.buffered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Failover gap with a cold and a warm standby broker")
+    parser.add_argument("-f", "--frequency", type=float, default=100, help="publications per sec, default 100")
+    parser.add_argument("-s", "--h_size", type=int, default=10, help="samples in a window, default 10")
+    parser.add_argument("-r", "--resync", type=int, default=100, help="samples between full windows, default 100")
+    parser.add_argument("-n", "--failovers", type=int, default=10, help="failovers per mode, default 10")
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>10} {:>10} {:>14} {:>10}".format(
+        "standby", "mean ms", "p50 ms", "max ms", "promote ms", "buffered"))
+    for mode, warm in (("cold", False), ("warm", True)):
+        runs = [failover(args, warm) for _ in range(args.failovers)]
+        gaps = sorted(run[0] * 1000 for run in runs)
+        print("{:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>14.2f} {:>10.0f}".format(
+            mode, sum(gaps) / len(gaps), gaps[len(gaps) // 2], gaps[-1],
+            sum(run[1] for run in runs) * 1000 / len(runs), sum(run[2] for run in runs) / len(runs)))
+
+
+if __name__ == "__main__":
+    main()
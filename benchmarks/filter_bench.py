@@ -0,0 +1,169 @@
+###############################################
+#
+# Purpose: What a content filter (CS6381_MW/ContentFilter.py) saves a
+# selective subscriber, and what testing it costs the broker
+#
+# Usage: python3 benchmarks/filter_bench.py [-n samples] [-b bytes] [-e msgs] [-s h_size]
+#
+# Samples come from the publishers' generators (TopicSelector.single), with
+# the labels of categorical topics encoded to their codes. For every filter
+# we report the share of the publications still sent to its subscriber, the
+# downstream bytes that saves at the given payload size and the time the
+# broker spends per test of a sample.
+#
+# End to end, the same samples go through the real PublisherMW and a
+# BrokerMW forwarding in python over inproc, to a subscriber that either
+# takes the plain topic and tests the filter itself (as without a broker
+# applying filters) or subscribes to the filter's channel. We report what
+# reaches the subscriber, the CPU its thread spends parsing and testing,
+# and the secs until the last message arrived.
+#
+###############################################
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import threading
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW import discovery_pb2
+from CS6381_MW.Common import TOPIC_CODES, PAYLOAD_TYPECODE, payload_kind, payload_values
+from CS6381_MW.ContentFilter import ContentFilter
+from CS6381_MW.HistoryBuffer import HistoryBuffer
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.BrokerMW import BrokerMW
+from topic_selector import TopicSelector
+
+FILTERS = ["temperature:range:90:", "temperature:range:40:60", "light:eq:1600",
+           "weather:in:rainy,icy", "location:eq:Asia"]
+
+logger = logging.getLogger("bench")
+logger.setLevel(logging.WARNING)
+
+
+def draw(content_filter, count):
+    ''' count samples of the filter's topic, categorical ones as codes '''
+    gen = TopicSelector.single[content_filter.topic]
+    codes = TOPIC_CODES.get(content_filter.topic)
+    if codes is None:
+        return [gen() for _ in range(count)]
+    return [codes.index(gen()) for _ in range(count)]
+
+
+def subscriber(ctx, content_filter, channel, ready, result):
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVHWM, 0)
+    sub.setsockopt_string(zmq.SUBSCRIBE, content_filter.channel if channel else content_filter.topic)
+    sub.connect("inproc://back")
+    ready.set()
+    received, size, taken = 0, 0, 0
+    cpu, end = time.thread_time(), time.perf_counter()
+    # the publisher is done once nothing arrived for a while
+    while sub.poll(500):
+        frames = sub.recv_multipart()
+        received += 1
+        size += sum(len(frame) for frame in frames)
+        pub = discovery_pb2.Publication()
+        pub.ParseFromString(frames[2])
+        if content_filter.matches(payload_values(pub)):
+            taken += 1
+        end = time.perf_counter()
+    result.update(received=received, bytes=size, taken=taken, cpu=time.thread_time() - cpu, end=end)
+    sub.close()
+
+
+def end_to_end(content_filter, samples, h_size, channel):
+    ''' publish the samples through a broker; what reached the subscriber '''
+    topic = content_filter.topic
+    ctx = zmq.Context()
+    pub = PublisherMW(logger)
+    pub.name, pub.delta = "pub1", False
+    pub.pub = ctx.socket(zmq.XPUB)
+    pub.pub.setsockopt(zmq.SNDHWM, 0)
+    pub.pub.bind("inproc://front")
+    pub.payload = {topic: payload_kind(topic)}
+    pub.history = {topic: HistoryBuffer(h_size, PAYLOAD_TYPECODE[pub.payload[topic]])}
+    pub.seq, pub.since_full, pub.resync = {topic: 0}, {topic: 0}, 1
+
+    broker = BrokerMW(logger)
+    broker.req = ctx.socket(zmq.REQ)
+    broker.sub = ctx.socket(zmq.XSUB)
+    broker.pub = ctx.socket(zmq.XPUB)
+    broker.sub.setsockopt(zmq.RCVHWM, 0)
+    broker.pub.setsockopt(zmq.SNDHWM, 0)
+    broker.pub.setsockopt(zmq.XPUB_VERBOSER, 1)
+    broker.verboser = True
+    broker.sub.connect("inproc://front")
+    broker.pub.bind("inproc://back")
+    broker.topics = {topic}
+    if channel:
+        broker.set_filters({topic: {content_filter.fid: content_filter}})
+    broker.poller = zmq.Poller()
+    for socket in (broker.req, broker.sub, broker.pub):
+        broker.poller.register(socket, zmq.POLLIN)
+    forwarder = threading.Thread(target=broker.event_loop)
+    forwarder.start()
+
+    ready, result = threading.Event(), {}
+    receiver = threading.Thread(target=subscriber, args=(ctx, content_filter, channel, ready, result))
+    receiver.start()
+    ready.wait()
+    while not pub.wanted:
+        if pub.pub.poll(10):
+            pub.recv_subscription()
+
+    start = time.perf_counter()
+    for sample in samples:
+        pub.history[topic].append(sample)
+        msg = discovery_pb2.Publication()
+        pub.fill_publication(msg, topic, sample)
+        pub.send_publication(msg)
+    receiver.join()
+    broker.handle_events = False
+    forwarder.join()
+    for socket in (pub.pub, broker.req, broker.sub, broker.pub):
+        socket.close(linger=0)
+    ctx.term()
+    result["secs"] = result["end"] - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Content filter selectivity and cost")
+    parser.add_argument("-n", "--samples", type=int, default=200000, help="samples per filter, default 200000")
+    parser.add_argument("-b", "--bytes", type=int, default=120, help="bytes per publication, default 120")
+    parser.add_argument("-e", "--msgs", type=int, default=20000, help="publications per end to end run, default 20000")
+    parser.add_argument("-s", "--h_size", type=int, default=10, help="samples in a window, default 10")
+    args = parser.parse_args()
+
+    random.seed(6381)
+    print("{:>26} {:>9} {:>14} {:>12}".format("filter", "sent", "saved bytes", "ns/test"))
+    for text in FILTERS:
+        content_filter = ContentFilter.parse(text)
+        samples = [[sample] for sample in draw(content_filter, args.samples)]
+        start = time.perf_counter()
+        sent = sum(1 for values in samples if content_filter.matches(values))
+        secs = time.perf_counter() - start
+        print("{:>26} {:>8.1%} {:>14d} {:>12.0f}".format(
+            text, sent / args.samples, (args.samples - sent) * args.bytes, secs / args.samples * 1e9))
+
+    print()
+    print("{:>26} {:>8} {:>9} {:>9} {:>8} {:>10} {:>8}".format(
+        "end to end", "via", "received", "MB", "taken", "sub cpu s", "secs"))
+    for text in FILTERS:
+        content_filter = ContentFilter.parse(text)
+        samples = draw(content_filter, args.msgs)
+        for via, channel in (("topic", False), ("channel", True)):
+            result = end_to_end(content_filter, samples, args.h_size, channel)
+            print("{:>26} {:>8} {:>9} {:>9.2f} {:>8} {:>10.2f} {:>8.2f}".format(
+                text, via, result["received"], result["bytes"] / 1e6, result["taken"], result["cpu"], result["secs"]))
+
+
+if __name__ == "__main__":
+    main()
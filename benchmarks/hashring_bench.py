@@ -0,0 +1,71 @@
+###############################################
+#
+# Purpose: Topic to broker group assignment by contiguous slices (as
+# create_broker_groups used to do) versus the consistent hash ring of
+# CS6381_MW/HashRing.py, plain and with bounded loads
+#
+# Usage: python3 benchmarks/hashring_bench.py [-t topics] [-g groups] [-z zipf]
+#
+# For every strategy we report the share of topics that move when going from
+# g to g+1 groups, and the load of the busiest group relative to the mean when
+# topic rates follow a zipf distribution (a few hot topics).
+#
+###############################################
+
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW.HashRing import HashRing, moved_topics
+
+
+def slices(topics, groups, weights=None):
+    # the assignment as it used to be: contiguous ranges of the topic list
+    steps = -(-len(topics) // groups)
+    return {g: topics[g * steps:(g + 1) * steps] for g in range(groups)}
+
+
+def plain_ring(topics, groups, weights=None):
+    return HashRing(range(groups), load_factor=None).assign(topics)
+
+
+def bounded_ring(topics, groups, weights=None):
+    return HashRing(range(groups)).assign(topics, weights)
+
+
+def peak_load(assignment, weights):
+    loads = [sum(weights[t] for t in topics) for topics in assignment.values()]
+    return max(loads) / (sum(loads) / len(loads))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broker group assignment strategies")
+    parser.add_argument("-t", "--topics", type=int, default=1000, help="number of topics, default 1000")
+    parser.add_argument("-g", "--groups", type=int, default=3, help="groups before adding one, default 3")
+    parser.add_argument("-z", "--zipf", type=float, default=1.0, help="zipf exponent of the topic rates, default 1.0")
+    args = parser.parse_args()
+
+    topics = ["topic{:05d}".format(i) for i in range(args.topics)]
+    # rank the rates in a scrambled order so hot topics are not neighbours in the list
+    order = list(topics)
+    random.Random(6381).shuffle(order)
+    weights = {t: 1.0 / (rank + 1) ** args.zipf for rank, t in enumerate(order)}
+
+    print("{:>14} {:>10} {:>12} {:>12}".format("strategy", "moved", "peak/mean", "peak/mean"))
+    print("{:>14} {:>10} {:>12} {:>12}".format("", "g->g+1", "uniform", "zipf"))
+    for name, strategy in (("slices", slices), ("ring", plain_ring), ("ring+bounded", bounded_ring)):
+        before = strategy(topics, args.groups)
+        after = strategy(topics, args.groups + 1)
+        moved = len(moved_topics(before, after)) / len(topics)
+        uniform = peak_load(before, {t: 1.0 for t in topics})
+        zipf = peak_load(strategy(topics, args.groups, weights), weights)
+        print("{:>14} {:>9.1%} {:>12.2f} {:>12.2f}".format(name, moved, uniform, zipf))
+    print("ideal move share for {} -> {} groups: {:.1%}".format(
+        args.groups, args.groups + 1, 1.0 / (args.groups + 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+###############################################
+#
+# Purpose: Microbenchmark of the per-topic history store. Compares the
+# original list based window (insert(0, x) + pop() + copy on every send)
+# with the ring buffer in CS6381_MW/HistoryBuffer.py
+#
+# A send exports the window into a Publication as PublisherMW does: the
+# list of strings into data, the ring of floats either into the repeated
+# doubles (one conversion per sample) or as the raw block of a full window.
+#
+# Usage: python3 benchmarks/history_bench.py [-n samples]
+#
+###############################################
+
+import os
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW import discovery_pb2
+from CS6381_MW.Common import raw_series
+from CS6381_MW.HistoryBuffer import HistoryBuffer
+
+
+def list_store(h_size, prefill):
+    history = []
+    for value in prefill:
+        history.insert(0, value)
+        if len(history) > h_size:
+            history.pop()
+    return history
+
+
+def list_step(history, h_size, samples, export):
+    for value in samples:
+        history.insert(0, value)
+        if len(history) > h_size:
+            history.pop()
+        if export:
+            discovery_pb2.Publication().data.extend(history)
+
+
+def ring_store(h_size, prefill, typecode=None):
+    history = HistoryBuffer(h_size, typecode)
+    history.extend(prefill)
+    return history
+
+
+def ring_step(history, h_size, samples, export):
+    for value in samples:
+        history.append(value)
+        if export:
+            discovery_pb2.Publication().data.extend(history.view())
+
+
+def ring_values_step(history, h_size, samples, export):
+    for value in samples:
+        history.append(value)
+        discovery_pb2.Publication().doubles.values.extend(history.view())
+
+
+def ring_raw_step(history, h_size, samples, export):
+    for value in samples:
+        history.append(value)
+        discovery_pb2.Publication().doubles.raw = raw_series(history.view())
+
+
+def bench(step, store, h_size, samples, export, repeat=3):
+    return min(timeit.repeat(lambda: step(store, h_size, samples, export),
+                             number=1, repeat=repeat)) * 1e6 / len(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="History store microbenchmark")
+    parser.add_argument("-n", "--samples", type=int, default=2000,
+                        help="samples appended per measurement, default 2000")
+    args = parser.parse_args()
+
+    print("steady state cost per sample in microseconds (window already full)")
+    print("update = append only, send = append + export the window into a Publication")
+    print("{:>8} {:>12} {:>12} {:>12} {:>12} {:>14} {:>12}".format(
+        "h_size", "list update", "ring update", "list send", "ring send", "ring[d] values", "ring[d] raw"))
+    for h_size in (10, 100, 1000, 10000, 100000):
+        prefill = [str(i) for i in range(h_size)]
+        samples = [str(i) for i in range(args.samples)]
+        nums = [float(i) for i in range(args.samples)]
+        row = [h_size]
+        for export in (False, True):
+            row.append(bench(list_step, list_store(h_size, prefill), h_size, samples, export))
+            row.append(bench(ring_step, ring_store(h_size, prefill), h_size, samples, export))
+        row.append(bench(ring_values_step, ring_store(h_size, [0.0] * h_size, 'd'), h_size, nums, True))
+        row.append(bench(ring_raw_step, ring_store(h_size, [0.0] * h_size, 'd'), h_size, nums, True))
+        print("{:>8} {:>12.3f} {:>12.3f} {:>12.3f} {:>12.3f} {:>14.3f} {:>12.3f}".format(*row))
+
+
+if __name__ == "__main__":
+    main()
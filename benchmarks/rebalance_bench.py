@@ -0,0 +1,62 @@
+###############################################
+#
+# Purpose: How far the load driven rebalancing of CS6381_MW/Rebalancer.py
+# brings the busiest broker group down, and how many topics it moves for it
+#
+# Usage: python3 benchmarks/rebalance_bench.py [-t topics] [-g groups] [-z zipf] [-r rounds]
+#
+# Topics start out on the hash ring (by count, as create_broker_groups does)
+# and get zipf distributed rates. Every round is one rebalancing decision of
+# the discovery leader, as if a fresh load report had come in.
+#
+###############################################
+
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW.HashRing import HashRing
+from CS6381_MW.Rebalancer import Rebalancer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load driven rebalancing of broker groups")
+    parser.add_argument("-t", "--topics", type=int, default=100, help="number of topics, default 100")
+    parser.add_argument("-g", "--groups", type=int, default=4, help="number of groups, default 4")
+    parser.add_argument("-z", "--zipf", type=float, default=1.0, help="zipf exponent of the topic rates, default 1.0")
+    parser.add_argument("-r", "--rounds", type=int, default=10, help="rebalancing decisions, default 10")
+    parser.add_argument("--threshold", type=float, default=1.5, help="imbalance threshold, default 1.5")
+    parser.add_argument("--max-moves", type=int, default=2, help="topics moved per decision, default 2")
+    parser.add_argument("-s", "--seed", type=int, default=6381, help="seed of the rate ranking")
+    args = parser.parse_args()
+
+    topics = ["topic{:05d}".format(i) for i in range(args.topics)]
+    order = list(topics)
+    random.Random(args.seed).shuffle(order)
+    # messages per sec, the hottest topic at 1000
+    rates = {t: 1000.0 / (rank + 1) ** args.zipf for rank, t in enumerate(order)}
+
+    assignment = HashRing(range(args.groups)).assign(topics)
+    rebalancer = Rebalancer(args.threshold, args.max_moves)
+    loads = Rebalancer.loads(assignment, rates)
+    print("{:>6} {:>10} {:>14} {:>8}".format("round", "imbalance", "peak msgs/s", "moved"))
+    print("{:>6} {:>10.2f} {:>14.1f} {:>8}".format(0, Rebalancer.imbalance(loads), max(loads.values()), 0))
+    moved = 0
+    for round in range(1, args.rounds + 1):
+        moves = rebalancer.plan(assignment, rates)
+        if not moves:
+            break
+        for topic, src, dst in moves:
+            assignment[src].remove(topic)
+            assignment[dst].append(topic)
+        moved += len(moves)
+        loads = Rebalancer.loads(assignment, rates)
+        print("{:>6} {:>10.2f} {:>14.1f} {:>8}".format(round, Rebalancer.imbalance(loads), max(loads.values()), moved))
+    print("mean load {:.1f} msgs/s, threshold {}".format(sum(loads.values()) / len(loads), args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+###############################################
+#
+# Purpose: Cost on the receive path of writing one latency sample, the
+# original open/append/close per message versus the buffered LatencyRecorder
+#
+# Usage: python3 benchmarks/recorder_bench.py [-n samples]
+#
+###############################################
+
+import os
+import sys
+import csv
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW.LatencyRecorder import LatencyRecorder, read_binary
+
+
+# what SubscriberMW.write_csv used to do for every message
+def write_csv(file_name, data):
+    with open(file_name, "a", newline='') as f:
+        writer = csv.writer(f)
+        x, y = data
+        writer.writerow([x, y])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency recorder benchmark")
+    parser.add_argument("-n", "--samples", type=int, default=100000, help="samples recorded, default 100000")
+    args = parser.parse_args()
+
+    n = args.samples
+    tmp = tempfile.mkdtemp()
+    samples = [(i * 0.001, 0.0005 + (i % 100) * 1e-6) for i in range(n)]
+
+    path = os.path.join(tmp, "legacy.csv")
+    start = time.perf_counter()
+    for sample in samples:
+        write_csv(path, sample)
+    legacy = time.perf_counter() - start
+    print("{:>10} {:>10.2f} us/sample".format("per msg", legacy * 1e6 / n))
+
+    for fmt in ("csv", "binary"):
+        path = os.path.join(tmp, "rec." + fmt)
+        recorder = LatencyRecorder(path, fmt)
+        recorder.start()
+        start = time.perf_counter()
+        for when, latency in samples:
+            recorder.record(when, latency)
+        hot = time.perf_counter() - start
+        recorder.close()
+        total = time.perf_counter() - start
+        print("{:>10} {:>10.2f} us/sample on the receive path, {:.2f} incl. close, {} bytes, {}".format(
+            fmt, hot * 1e6 / n, total * 1e6 / n, os.path.getsize(path), recorder.stats()))
+    times, latencies = read_binary(os.path.join(tmp, "rec.binary"))
+    assert len(times) == n and latencies[-1] == samples[-1][1]
+
+
+if __name__ == "__main__":
+    main()
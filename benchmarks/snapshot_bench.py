@@ -0,0 +1,151 @@
+###############################################
+#
+# Purpose: Time from joining a broker to the first valid sample, waiting for
+# the next full window (as subscribers used to) versus fetching a snapshot
+# of the broker's cache (CS6381_MW/SnapshotCache.py)
+#
+# Usage: python3 benchmarks/snapshot_bench.py [-f frequency] [-s h_size] [-r resync] [-c max_frames] [-j joins]
+#
+# A publisher in delta mode (the real PublisherMW.fill_publication and
+# send_publication) sends a full window every resync samples and deltas in
+# between, through a broker keeping a SnapshotCache, all over inproc in one
+# process. Subscribers join at random times; a sample is valid once the
+# subscriber holds a full window. With resync above max_frames the cache
+# compacts, and the size of the snapshot replies shows it stays bounded.
+#
+###############################################
+
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import threading
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW import discovery_pb2
+from CS6381_MW.Common import FLAG_FULL, PAYLOAD_TYPECODE, payload_kind, unpack_header
+from CS6381_MW.HistoryBuffer import HistoryBuffer
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.SnapshotCache import SnapshotCache, SNAPSHOT_MARKER
+
+TOPIC = b"humidity"  # a topic with a double payload
+
+logger = logging.getLogger("bench")
+logger.setLevel(logging.WARNING)
+
+
+def publisher(ctx, period, h_size, resync, stop):
+    mw = PublisherMW(logger)
+    topic = TOPIC.decode("utf-8")
+    mw.name, mw.delta, mw.resync = "pub1", True, resync
+    mw.pub = ctx.socket(zmq.PUB)
+    mw.pub.bind("inproc://pub")
+    mw.payload = {topic: payload_kind(topic)}
+    mw.history = {topic: HistoryBuffer(h_size, PAYLOAD_TYPECODE[mw.payload[topic]])}
+    mw.seq, mw.since_full = {topic: 0}, {topic: resync}
+    sample = 0.0
+    wakeup = time.monotonic()
+    while not stop.is_set():
+        mw.history[topic].append(sample)
+        msg = discovery_pb2.Publication()
+        mw.fill_publication(msg, topic, sample)
+        mw.send_publication(msg)
+        sample += 1
+        wakeup += period
+        time.sleep(max(0, wakeup - time.monotonic()))
+    mw.pub.close()
+
+
+def broker(ctx, cache, stop):
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt(zmq.SUBSCRIBE, TOPIC)
+    sub.connect("inproc://pub")
+    pub = ctx.socket(zmq.PUB)
+    pub.bind("inproc://broker")
+    snap = ctx.socket(zmq.ROUTER)
+    snap.bind("inproc://snapshot")
+    poller = zmq.Poller()
+    poller.register(sub, zmq.POLLIN)
+    poller.register(snap, zmq.POLLIN)
+    while not stop.is_set():
+        events = dict(poller.poll(timeout=100))
+        if sub in events:
+            msg = sub.recv_multipart()
+            cache.update(*msg)
+            pub.send_multipart(msg)
+        if snap in events:
+            frames = snap.recv_multipart()
+            snap.send_multipart([frames[0], b"", SNAPSHOT_MARKER] + cache.snapshot(frames[2:]))
+    for socket in (sub, pub, snap):
+        socket.close()
+
+
+def join(ctx, use_snapshot, reply):
+    ''' secs from joining to holding a full window; reply gets the snapshot frames and bytes '''
+    start = time.monotonic()
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt(zmq.SUBSCRIBE, TOPIC)
+    sub.connect("inproc://broker")
+    try:
+        if use_snapshot:
+            req = ctx.socket(zmq.REQ)
+            req.connect("inproc://snapshot")
+            req.send_multipart([TOPIC])
+            frames = req.recv_multipart()
+            req.close()
+            reply.append(((len(frames) - 1) // 3, sum(len(frame) for frame in frames)))
+            if any(unpack_header(frames[i + 1])[2] & FLAG_FULL for i in range(1, len(frames) - 2, 3)):
+                return time.monotonic() - start
+        while True:
+            topic, header, payload = sub.recv_multipart()
+            if unpack_header(header)[2] & FLAG_FULL:
+                return time.monotonic() - start
+    finally:
+        sub.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to first valid sample after joining a broker")
+    parser.add_argument("-f", "--frequency", type=float, default=10, help="publications per sec, default 10")
+    parser.add_argument("-s", "--h_size", type=int, default=5, help="samples in a window, default 5")
+    parser.add_argument("-r", "--resync", type=int, default=50, help="samples between full windows, default 50")
+    parser.add_argument("-c", "--max_frames", type=int, default=1024, help="deltas the cache keeps, default 1024")
+    parser.add_argument("-j", "--joins", type=int, default=10, help="joins per mode, default 10")
+    args = parser.parse_args()
+
+    ctx = zmq.Context()
+    cache = SnapshotCache(args.max_frames)
+    stop = threading.Event()
+    threads = [threading.Thread(target=broker, args=(ctx, cache, stop)),
+               threading.Thread(target=publisher, args=(ctx, 1.0 / args.frequency, args.h_size, args.resync, stop))]
+    for thread in threads:
+        thread.start()
+    # let the cache see two full windows, so that its compactions keep h_size samples
+    time.sleep(2 * args.resync / args.frequency)
+
+    print("{:>10} {:>10} {:>10} {:>10} {:>12} {:>12}".format(
+        "mode", "mean ms", "p50 ms", "max ms", "max frames", "max bytes"))
+    for mode, use_snapshot in (("wait", False), ("snapshot", True)):
+        secs, reply = [], []
+        for _ in range(args.joins):
+            time.sleep(random.uniform(0, args.resync / args.frequency))
+            secs.append(join(ctx, use_snapshot, reply) * 1000)
+        secs.sort()
+        print("{:>10} {:>10.1f} {:>10.1f} {:>10.1f} {:>12} {:>12}".format(
+            mode, sum(secs) / len(secs), secs[len(secs) // 2], secs[-1],
+            max((r[0] for r in reply), default=0), max((r[1] for r in reply), default=0)))
+    print(cache.stats())
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    ctx.term()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+###############################################
+#
+# Purpose: Cost of generating samples with the original per call if/elif
+# generator versus the dispatch table and the bulk (NumPy) block streams
+# of TopicSelector
+#
+# Usage: python3 benchmarks/topicgen_bench.py [-n samples] [-b block]
+#
+# The speedup compares the streams with the dispatch table, which returns
+# the same native values (float, int or label) one call at a time; we check
+# that both give samples of the same type and range before timing them. The
+# if/elif chain stringified its numbers and is shown for reference only.
+# Samples are taken with next() one at a time, as PublisherAppln does.
+#
+###############################################
+
+import os
+import sys
+import random
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import topic_selector
+from topic_selector import TopicSelector
+
+
+# the generator as it used to be, kept here as the baseline
+def chain_gen_publication(topic):
+    if (topic == "weather"):
+        return random.choice(["sunny", "cloudy", "rainy", "foggy", "icy"])
+    elif (topic == "humidity"):
+        return str(random.uniform(10.0, 100.0))
+    elif (topic == "airquality"):
+        return random.choice(["good", "smog", "poor"])
+    elif (topic == "light"):
+        return random.choice(["450", "800", "1100", "1600"])
+    elif (topic == "pressure"):
+        return str(random.randint(870, 1084))
+    elif (topic == "temperature"):
+        return str(random.randint(-100, 100))
+    elif (topic == "sound"):
+        return str(random.randint(30, 95))
+    elif (topic == "altitude"):
+        return str(random.randint(0, 40000))
+    elif (topic == "location"):
+        return random.choice(["America", "Europe", "Asia", "Africa", "Australia"])
+
+
+def check(ts, topic, n=10000):
+    '''the stream gives samples like the dispatch table's'''
+    stream = ts.samples(topic)
+    single = [ts.gen_publication(topic) for _ in range(n)]
+    block = [next(stream) for _ in range(n)]
+    if {type(v) for v in single} != {type(v) for v in block}:
+        raise SystemExit("{}: the stream gives {} instead of {}".format(
+            topic, {type(v) for v in block}, {type(v) for v in single}))
+    if len(set(single)) <= 10:
+        # a fixed set of choices, all of which the dispatch table drew
+        if not set(block) <= set(single):
+            raise SystemExit("{}: the stream gives {}".format(topic, sorted(set(block) - set(single))))
+    else:
+        # a range; both draw close to its ends
+        low, high = min(single), max(single)
+        slack = (high - low) / 100
+        if not all(low - slack <= v <= high + slack for v in block):
+            raise SystemExit("{}: the stream leaves {}..{}".format(topic, low, high))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sample generation benchmark")
+    parser.add_argument("-n", "--samples", type=int, default=100000, help="samples per topic, default 100000")
+    parser.add_argument("-b", "--block", type=int, default=1024, help="block size of the streams, default 1024")
+    args = parser.parse_args()
+
+    ts = TopicSelector()
+    n = args.samples
+    print("numpy available: {}".format(topic_selector.np is not None))
+    print("{:>12} {:>12} {:>12} {:>12} {:>9}".format("topic", "chain ns", "dispatch ns", "stream ns", "speedup"))
+    for topic in ts.all():
+        check(ts, topic)
+        chain = min(timeit.repeat(lambda: [chain_gen_publication(topic) for _ in range(n)], number=1, repeat=3))
+        dispatch = min(timeit.repeat(lambda: [ts.gen_publication(topic) for _ in range(n)], number=1, repeat=3))
+        stream = ts.samples(topic, args.block)
+        blocks = min(timeit.repeat(lambda: [next(stream) for _ in range(n)], number=1, repeat=3))
+        print("{:>12} {:>12.0f} {:>12.0f} {:>12.0f} {:>8.1f}x".format(
+            topic, chain * 1e9 / n, dispatch * 1e9 / n, blocks * 1e9 / n, dispatch / blocks))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+###############################################
+#
+# Purpose: Scaling of a broker's partitioned forwarding (BrokerMW with
+# [Broker] Workers=N) from 1 to 8 forwarding workers
+#
+# Usage: python3 benchmarks/workers_bench.py [-p pubs] [-s subs] [-t topics]
+#            [-i io_threads] [-d secs] [-b bytes]
+#
+# Publisher and subscriber processes talk over tcp on localhost to a broker
+# in this process. As in BrokerMW.create_workers every worker is a proxy
+# device with its own SUB/PUB pair, subscribed to the topics the hash ring
+# gives it, and all of them share one ZMQ context. The subscribers connect to
+# every worker port. We report the messages delivered per sec.
+#
+###############################################
+
+import os
+import sys
+import time
+import logging
+import argparse
+import multiprocessing
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW.HashRing import HashRing
+from CS6381_MW.ProxyForwarder import ProxyForwarder
+
+
+def publisher(port, topics, until, size):
+    ctx = zmq.Context()
+    pub = ctx.socket(zmq.PUB)
+    pub.bind("tcp://127.0.0.1:{}".format(port))
+    header, payload = b"\0" * 13, b"x" * size
+    frames = [[topic.encode("utf-8"), header, payload] for topic in topics]
+    time.sleep(0.5)  # let the broker subscribe
+    i = 0
+    while time.monotonic() < until:
+        # check the clock only every so often
+        for _ in range(1000):
+            pub.send_multipart(frames[i % len(frames)])
+            i += 1
+    pub.close(linger=0)
+    ctx.term()
+
+
+def subscriber(ports, start, until, results):
+    ctx = zmq.Context()
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVHWM, 0)
+    sub.setsockopt(zmq.SUBSCRIBE, b"")
+    for port in ports:
+        sub.connect("tcp://127.0.0.1:{}".format(port))
+    poller = zmq.Poller()
+    poller.register(sub, zmq.POLLIN)
+    count = 0
+    while time.monotonic() < until:
+        if dict(poller.poll(timeout=100)):
+            sub.recv_multipart()
+            # only count the steady state, after everybody connected
+            if time.monotonic() >= start:
+                count += 1
+    results.put(count)
+    sub.close(linger=0)
+    ctx.term()
+
+
+def run(workers, args, base):
+    topics = ["topic{:03d}".format(i) for i in range(args.topics)]
+    pub_ports = [base + i for i in range(args.pubs)]
+    worker_ports = [base + 100 + i for i in range(workers)]
+    warmup = 1.0
+    start = time.monotonic() + warmup
+    until = start + args.secs
+
+    ctx = zmq.Context(io_threads=args.io_threads)
+    ring = HashRing(range(workers), load_factor=None)
+    forwarders = []
+    for i, port in enumerate(worker_ports):
+        sub = ctx.socket(zmq.SUB)
+        pub = ctx.socket(zmq.PUB)
+        pub.bind("tcp://127.0.0.1:{}".format(port))
+        for topic in topics:
+            if ring.lookup(topic) == i:
+                sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+        for pub_port in pub_ports:
+            sub.connect("tcp://127.0.0.1:{}".format(pub_port))
+        forwarders.append(ProxyForwarder(ctx, sub, pub, logging.getLogger("bench")))
+    for forwarder in forwarders:
+        forwarder.start()
+
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=subscriber, args=(worker_ports, start, until, results))
+             for _ in range(args.subs)]
+    procs += [multiprocessing.Process(target=publisher, args=(port, topics, until, args.bytes))
+              for port in pub_ports]
+    for proc in procs:
+        proc.start()
+    counts = [results.get() for _ in range(args.subs)]
+    for proc in procs:
+        proc.join()
+    for forwarder in forwarders:
+        forwarder.stop()
+        forwarder.frontend.close(linger=0)
+        forwarder.backend.close(linger=0)
+    ctx.term()
+    return sum(counts) / args.secs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Partitioned broker forwarding benchmark")
+    parser.add_argument("-p", "--pubs", type=int, default=4, help="publisher processes, default 4")
+    parser.add_argument("-s", "--subs", type=int, default=2, help="subscriber processes, default 2")
+    parser.add_argument("-t", "--topics", type=int, default=32, help="number of topics, default 32")
+    parser.add_argument("-i", "--io-threads", type=int, default=2, help="io_threads of the broker context, default 2")
+    parser.add_argument("-d", "--secs", type=float, default=5, help="secs measured per run, default 5")
+    parser.add_argument("-b", "--bytes", type=int, default=100, help="payload bytes, default 100")
+    args = parser.parse_args()
+
+    print("{:>8} {:>14} {:>8}".format("workers", "delivered/s", "speedup"))
+    baseline = None
+    for n, workers in enumerate((1, 2, 4, 8)):
+        rate = run(workers, args, 20000 + 200 * n)
+        baseline = baseline or rate
+        print("{:>8} {:>14.0f} {:>7.2f}x".format(workers, rate, rate / baseline))
+
+
+if __name__ == "__main__":
+    main()
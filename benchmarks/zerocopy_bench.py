@@ -0,0 +1,143 @@
+###############################################
+#
+# Purpose: Copying versus zero-copy (copy=False) ZMQ send/receive along the
+# publisher -> broker -> subscriber path for growing history payloads
+#
+# Usage: python3 benchmarks/zerocopy_bench.py [-m msgs]
+#
+# The three hops are the real middleware code over inproc: the publisher's
+# PublisherMW.send_publication, a BrokerMW forwarding in python (its
+# event_loop, recv_data and forward) and the subscriber's
+# SubscriberMW.recv_frames. All of them send the [topic, header, payload]
+# frames the middleware uses. The subscriber does not parse the payload, so
+# the protobuf parse does not hide what the transport costs. The payload is
+# a full window of doubles, shipped as the raw block PublisherMW uses.
+#
+# pyzmq copies frames below zmq.COPY_THRESHOLD (64 kB) even with
+# copy=False, and a zero-copy frame costs a Frame object and, on send, a
+# reference handed to libzmq. So zero copy only has something to save for
+# large windows. We report the messages and payload MB/s delivered in each
+# mode.
+#
+###############################################
+
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+
+import zmq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from CS6381_MW import discovery_pb2
+from CS6381_MW.Common import PAYLOAD_TYPECODE, payload_kind
+from CS6381_MW.HistoryBuffer import HistoryBuffer
+from CS6381_MW.PublisherMW import PublisherMW
+from CS6381_MW.BrokerMW import BrokerMW
+from CS6381_MW.SubscriberMW import SubscriberMW
+
+TOPIC = "humidity"  # a topic with a double payload
+
+logger = logging.getLogger("bench")
+logger.setLevel(logging.WARNING)
+
+
+def make_publisher(ctx, h_size, copy, addr):
+    pub = PublisherMW(logger)
+    pub.name, pub.copy, pub.delta = "pub1", copy, False
+    pub.pub = ctx.socket(zmq.XPUB)
+    pub.pub.setsockopt(zmq.SNDHWM, 0)
+    pub.pub.bind(addr)
+    pub.payload = {TOPIC: payload_kind(TOPIC)}
+    pub.history = {TOPIC: HistoryBuffer(h_size, PAYLOAD_TYPECODE[pub.payload[TOPIC]])}
+    pub.history[TOPIC].extend(float(i) for i in range(h_size))
+    pub.seq, pub.since_full, pub.resync = {TOPIC: 0}, {TOPIC: 0}, 1
+    return pub
+
+
+def make_broker(ctx, copy, front, back):
+    broker = BrokerMW(logger)
+    broker.copy = copy
+    broker.req = ctx.socket(zmq.REQ)
+    broker.sub = ctx.socket(zmq.XSUB)
+    broker.pub = ctx.socket(zmq.XPUB)
+    broker.sub.setsockopt(zmq.RCVHWM, 0)
+    broker.pub.setsockopt(zmq.SNDHWM, 0)
+    broker.pub.setsockopt(zmq.XPUB_VERBOSER, 1)
+    broker.verboser = True
+    broker.sub.connect(front)
+    broker.pub.bind(back)
+    broker.topics = {TOPIC}
+    broker.poller = zmq.Poller()
+    for socket in (broker.req, broker.sub, broker.pub):
+        broker.poller.register(socket, zmq.POLLIN)
+    return broker
+
+
+def subscriber(ctx, copy, back, count, ready, result):
+    sub = SubscriberMW(logger)
+    sub.copy = copy
+    sub.sub = ctx.socket(zmq.SUB)
+    sub.sub.setsockopt(zmq.RCVHWM, 0)
+    sub.sub.setsockopt_string(zmq.SUBSCRIBE, TOPIC)
+    sub.sub.connect(back)
+    ready.set()
+    size = 0
+    for _ in range(count):
+        topic, header, payload = sub.recv_frames()
+        size += len(payload)
+    result["end"], result["bytes"] = time.perf_counter(), size
+    sub.sub.close()
+
+
+def run(h_size, count, copy):
+    ctx = zmq.Context()
+    front, back = "inproc://front", "inproc://back"
+    pub = make_publisher(ctx, h_size, copy, front)
+    broker = make_broker(ctx, copy, front, back)
+    forwarder = threading.Thread(target=broker.event_loop)
+    forwarder.start()
+    ready, result = threading.Event(), {}
+    receiver = threading.Thread(target=subscriber, args=(ctx, copy, back, count, ready, result))
+    receiver.start()
+    ready.wait()
+    # the subscription travels up through the broker; wait until it reaches us
+    while not pub.wanted:
+        if pub.pub.poll(10):
+            pub.recv_subscription()
+
+    start = time.perf_counter()
+    for _ in range(count):
+        msg = discovery_pb2.Publication()
+        pub.fill_publication(msg, TOPIC, 0.0)
+        pub.send_publication(msg)
+    receiver.join()
+    broker.handle_events = False
+    forwarder.join()
+    for socket in (pub.pub, broker.req, broker.sub, broker.pub):
+        socket.close(linger=0)
+    ctx.term()
+    secs = result["end"] - start
+    return count / secs, result["bytes"] / secs / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Zero copy benchmark")
+    parser.add_argument("-m", "--msgs", type=int, default=2000, help="messages per run, default 2000")
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>12} {:>12} {:>12} {:>12}".format(
+        "h_size", "bytes", "copy msg/s", "zc msg/s", "copy MB/s", "zc MB/s"))
+    for h_size in (10, 1000, 10000, 100000):
+        count = max(50, args.msgs // max(1, h_size // 1000))
+        copy_rate, copy_mb = run(h_size, count, True)
+        zc_rate, zc_mb = run(h_size, count, False)
+        print("{:>8} {:>10} {:>12.0f} {:>12.0f} {:>12.1f} {:>12.1f}".format(
+            h_size, 8 * h_size, copy_rate, zc_rate, copy_mb, zc_mb))
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,24 @@
 # since we are going to publish or subscribe to a random sampling of topics,
 # we need this package
 import random
+import itertools # to chain the blocks of a stream
+
+# labels of the categorical topics, shared with the middleware's code tables
+from CS6381_MW.Common import TOPIC_CODES
+
+# NumPy is only needed for the bulk generators; without it gen_block falls
+# back to drawing one sample at a time
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+# vectorized generator drawing n samples from a fixed set of choices. The
+# choices are kept in an array once, so a block is one integers () draw and a
+# gather; an object array hands the label strings themselves back from tolist ()
+def pick_block (choices):
+  table = np.array (choices, dtype=object if isinstance (choices[0], str) else None)
+  return lambda rng, n: table[rng.integers (0, len (table), n)].tolist ()
 
 # define a helper class to hold all the topics that we support in our system
 class TopicSelector ():
@@ -39,35 +57,60 @@ class TopicSelector ():
     return random.sample (self.topiclist, num)
   def all(self):
     return self.topiclist
+
+  # generators of a single sample per topic, used through a dispatch table
+  # rather than a chain of string comparisons. Samples are returned with their
+  # native type (float, int, or a label for categorical topics); the
+  # middleware encodes them into a typed payload.
+  single = {
+    "weather": lambda: random.choice (TOPIC_CODES["weather"]),
+    "humidity": lambda: random.uniform (10.0, 100.0),
+    "airquality": lambda: random.choice (TOPIC_CODES["airquality"]),
+    # in lumens
+    "light": lambda: random.choice ([450, 800, 1100, 1600]),
+    # in millibars (lowest recorded to highest recorded)
+    "pressure": lambda: random.randint (870, 1084),
+    # in fahrenheit
+    "temperature": lambda: random.randint (-100, 100),
+    # in decibels
+    "sound": lambda: random.randint (30, 95),
+    # in feet
+    "altitude": lambda: random.randint (0, 40000),
+    "location": lambda: random.choice (TOPIC_CODES["location"]),
+  }
+
   # generate a publication on a given topic
   def gen_publication (self, topic):
-    if (topic == "weather"):
-      return random.choice (["sunny", "cloudy", "rainy", "foggy", "icy"])
-    elif (topic == "humidity"):
-      return str (random.uniform (10.0, 100.0))
-    elif (topic == "airquality"):
-      return random.choice (["good", "smog", "poor"])
-    elif (topic == "light"):
-      # in lumens
-      return random.choice (["450", "800", "1100", "1600"])
-    elif (topic == "pressure"):
-      # in millibars (lowest recorded to highest recorded)
-      return str (random.randint (870, 1084))
-    elif (topic == "temperature"):
-      # in fahrenheit
-      return str (random.randint (-100, 100))
-    elif (topic == "sound"):
-      # in decibels
-      return str (random.randint (30, 95))
-    elif (topic == "altitude"):
-      # in feet
-      return str (random.randint (0, 40000))
-    elif (topic == "location"):
-      return random.choice (["America", "Europe", "Asia", "Africa", "Australia"])
-                            
-        
-
+    gen = self.single.get (topic)
+    return gen () if gen else None
 
+  # generate n samples of a topic at once
+  #
+  # With NumPy the whole block is drawn in one vectorized call; without it we
+  # fall back to the per sample generators.
+  def gen_block (self, topic, n):
+    if np is None:
+      gen = self.single[topic]
+      return [gen () for _ in range (n)]
+    return self.bulk[topic] (self.rng, n)
 
+  # endless stream of samples of a topic, drawn block by block. next () on a
+  # chain of list iterators stays in C, unlike resuming a generator per sample
+  def samples (self, topic, block=1024):
+    return itertools.chain.from_iterable (map (self.gen_block, itertools.repeat (topic), itertools.repeat (block)))
 
-    
+  # vectorized block generators; they mirror the ranges of the single ones
+  # (randint is inclusive at both ends, integers excludes the high end)
+  if np is not None:
+    rng = np.random.default_rng ()
+    bulk = {
+      "weather": pick_block (TOPIC_CODES["weather"]),
+      "humidity": lambda rng, n: rng.uniform (10.0, 100.0, n).tolist (),
+      "airquality": pick_block (TOPIC_CODES["airquality"]),
+      "light": pick_block ([450, 800, 1100, 1600]),
+      "pressure": lambda rng, n: rng.integers (870, 1085, n).tolist (),
+      "temperature": lambda rng, n: rng.integers (-100, 101, n).tolist (),
+      "sound": lambda rng, n: rng.integers (30, 96, n).tolist (),
+      "altitude": lambda rng, n: rng.integers (0, 40001, n).tolist (),
+      "location": pick_block (TOPIC_CODES["location"]),
+    }